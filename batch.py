@@ -0,0 +1,152 @@
+"""Scores many positions with an engine at once, for analysis and simulation
+
+Positions are /move game states, read as JSON lines. Every position is searched with the engine's `evaluate`, which
+works out the move the same way as a /move request (without the opening book, pondering or the game's state) and also
+reports the score of every move and search stats. Results are JSON lines in the same order as the positions:
+    {"index": 0, "move": "up", "scores": {"up": {"depth": 5, "value": 1.8}, ...}, "stats": {"nodes": 812, "ms": 31.2}}
+A position that can't be read or searched gets {"index": ..., "error": ...} instead.
+
+Positions are searched by a pool of worker processes, sent to them in chunks so that a quick search isn't outweighed by
+passing it between processes. At most `max_pending` chunks are read ahead of the results that have been consumed, so a
+slow reader of the results slows down the reading of positions instead of letting them pile up in memory. The same evaluation is served by `/move/batch` on the snake server.
+
+Usage:
+    python batch.py --engine game_theory --workers 4 < positions.jsonl > scores.jsonl
+"""
+from typing import Dict, List, Iterable, Iterator, Optional, Any
+from collections import deque
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+import engines
+from decoding import decode_game_state
+
+DEFAULT_CHUNK_SIZE = 8
+"""The number of positions sent to a worker at once"""
+
+_engine: Any = None
+
+
+def _init_worker(spec: str):
+    global _engine
+    # Engines print every move, which would only slow evaluation down
+    sys.stdout = open(os.devnull, "w")
+    _engine = engines.load_engine(spec)
+
+
+def _evaluate(index: int, position: bytes) -> Dict[str, Any]:
+    try:
+        return {"index": index, **_engine.evaluate(decode_game_state(position))}
+    except Exception as e:
+        return {"index": index, "error": f"{type(e).__name__}: {e}"}
+
+
+def _evaluate_chunk(index: int, positions: List[bytes]) -> List[Dict[str, Any]]:
+    return [_evaluate(index + i, position) for i, position in enumerate(positions)]
+
+
+class BatchEvaluator:
+    """A pool of worker processes that evaluate positions with one engine
+
+    Args:
+        spec: The engine spec (see engines.py)
+        workers: The number of worker processes. Defaults to the number of CPUs
+        max_pending: The number of chunks read ahead of the results. Defaults to 2 per worker
+        chunk_size: The number of positions sent to a worker at once
+    """
+    def __init__(self, spec: str, workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        if not hasattr(engines.load_engine(spec), "evaluate"):
+            raise ValueError(f"{spec} can't evaluate positions")
+        self.spec = spec
+        """The engine spec"""
+        self.workers = workers or os.cpu_count() or 1
+        """The number of worker processes"""
+        self.max_pending = max_pending or 2 * self.workers
+        """The number of chunks read ahead of the results"""
+        self.chunk_size = chunk_size
+        """The number of positions sent to a worker at once"""
+        # Workers are spawned rather than forked, since the server forks from a process that is running threads
+        self.pool = multiprocessing.get_context("spawn").Pool(self.workers, initializer=_init_worker, initargs=(spec,))
+        """The worker processes"""
+
+    def evaluate(self, positions: Iterable[bytes]) -> Iterator[Dict[str, Any]]:
+        """Evaluates positions, reading them only as fast as the results are consumed
+
+        Args:
+            positions: Encoded /move game states, e.g. the lines of a JSON lines file. Blank lines are skipped
+
+        Yields:
+            The result of every position, in the order of the positions
+        """
+        pending: deque = deque()
+        chunk: List[bytes] = []
+        index = 0
+        for position in positions:
+            if not position.strip():
+                continue
+            chunk.append(position)
+            if len(chunk) < self.chunk_size:
+                continue
+            pending.append(self.pool.apply_async(_evaluate_chunk, (index, chunk)))
+            index += len(chunk)
+            chunk = []
+            if len(pending) >= self.max_pending:
+                yield from pending.popleft().get()
+        if chunk:
+            pending.append(self.pool.apply_async(_evaluate_chunk, (index, chunk)))
+        while pending:
+            yield from pending.popleft().get()
+
+    def close(self):
+        """Stops the worker processes"""
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self) -> "BatchEvaluator":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def evaluate_positions(spec: str, game_states: Iterable[Dict[str, Any]], workers: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Evaluates game states with an engine in a pool of worker processes
+
+    Args:
+        spec: The engine spec (see engines.py)
+        game_states: The /move game states to evaluate
+        workers: The number of worker processes. Defaults to the number of CPUs
+
+    Yields:
+        The result of every game state, in order
+    """
+    with BatchEvaluator(spec, workers) as evaluator:
+        yield from evaluator.evaluate(json.dumps(game_state).encode() for game_state in game_states)
+
+
+def encode_result(result: Dict[str, Any]) -> bytes:
+    """Encodes a result as a JSON line"""
+    return json.dumps(result, separators=(",", ":")).encode() + b"\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", default="game_theory", help="the engine spec, e.g. game_theory:NUM_LAYERS=4")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (default: one per CPU)")
+    parser.add_argument("--max-pending", type=int, default=0, help="chunks read ahead of the results (default: 2 per worker)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="positions sent to a worker at once")
+    args = parser.parse_args()
+
+    out = sys.stdout.buffer
+    with BatchEvaluator(args.engine, args.workers or None, args.max_pending or None, args.chunk_size) as evaluator:
+        for result in evaluator.evaluate(sys.stdin.buffer):
+            out.write(encode_result(result))
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
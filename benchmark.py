@@ -0,0 +1,435 @@
+"""Reproducible benchmarks for both snakes, replayed from a corpus of recorded /move requests
+
+Usage:
+    python benchmark.py generate              # fill the corpus with synthetic positions for every category
+    python benchmark.py run --save-baseline   # benchmark the corpus and store the result as the baseline
+    python benchmark.py run --compare         # benchmark again and flag regressions against the baseline
+    python benchmark.py coldstart             # time-to-first-move of each snake's server, with and without warm-up
+
+Real positions are recorded by running a snake with BATTLESNAKE_RECORD_CORPUS set to the corpus directory.
+"""
+from typing import Dict, List, Any, Callable, Tuple
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.request
+
+from profiler import safe_file_name
+
+DEFAULT_CORPUS_DIR = os.path.join("benchmarks", "corpus")
+"""Where recorded and generated positions are stored"""
+DEFAULT_BASELINE_PATH = os.path.join("benchmarks", "baseline.json")
+"""Where the baseline results are stored"""
+REGRESSION_THRESHOLD = 0.2
+"""Relative slowdown (or memory growth) over the baseline that is flagged as a regression"""
+BOARD_SIZES = (7, 11, 19)
+"""Board sizes covered by the corpus"""
+SNAKE_COUNTS = (2, 4)
+"""Numbers of snakes covered by the corpus"""
+PHASES = {"early": (0, 20), "mid": (20, 100), "late": (100, 10**9)}
+"""Turn ranges of each phase of the game"""
+POSITIONS_PER_CATEGORY = 3
+"""Number of synthetic positions generated for each category"""
+COLD_START_ENGINES = ("game_theory", "metaheuristics")
+"""The engines whose time-to-first-move is measured by default"""
+
+
+def phase_of(turn: int) -> str:
+    """Gets the phase of the game that a turn belongs to"""
+    for phase, (first, last) in PHASES.items():
+        if first <= turn < last:
+            return phase
+    return "late"
+
+
+def category_of(game_state: Dict[str, Any]) -> str:
+    """Gets the corpus category of a /move request, e.g. "mid-11x11-2"
+
+    Args:
+        game_state: The /move request
+
+    Returns:
+        The phase, board size and number of snakes joined into a directory name
+    """
+    board = game_state["board"]
+    return f"{phase_of(game_state['turn'])}-{board['width']}x{board['height']}-{len(board['snakes'])}"
+
+
+def record_position(corpus_dir: str, game_state: Dict[str, Any]):
+    """Saves a /move request to the corpus under its category. The game id is cleaned up before it goes into the file
+    name, since it comes from the request
+
+    Args:
+        corpus_dir: The corpus directory
+        game_state: The /move request
+    """
+    category_dir = os.path.join(corpus_dir, category_of(game_state))
+    os.makedirs(category_dir, exist_ok=True)
+    name = safe_file_name(f"{game_state['game']['id']}-{game_state['turn']}") + ".json"
+    with open(os.path.join(category_dir, name), "w") as f:
+        json.dump(game_state, f)
+
+
+def load_corpus(corpus_dir: str) -> Dict[str, List[Dict[str, Any]]]:
+    """Loads every position in the corpus
+
+    Returns:
+        The positions of each category, in a stable order
+    """
+    corpus: Dict[str, List[Dict[str, Any]]] = {}
+    for category in sorted(os.listdir(corpus_dir)):
+        category_dir = os.path.join(corpus_dir, category)
+        if not os.path.isdir(category_dir):
+            continue
+        for name in sorted(os.listdir(category_dir)):
+            with open(os.path.join(category_dir, name)) as f:
+                corpus.setdefault(category, []).append(json.load(f))
+    return corpus
+
+
+def _random_body(rng: random.Random, size: int, length: int, occupied: set) -> List[Dict[str, int]]:
+    # Grows a self avoiding walk from a random free cell. Retries from scratch if the walk gets stuck
+    for _ in range(100):
+        x, y = rng.randrange(size), rng.randrange(size)
+        if (x, y) in occupied:
+            continue
+        cells = [(x, y)]
+        while len(cells) < length:
+            cx, cy = cells[-1]
+            options = [(cx + dx, cy + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                       if 0 <= cx + dx < size and 0 <= cy + dy < size
+                       and (cx + dx, cy + dy) not in occupied and (cx + dx, cy + dy) not in cells]
+            if not options:
+                break
+            cells.append(rng.choice(options))
+        if len(cells) == length:
+            occupied.update(cells)
+            return [{"x": cx, "y": cy} for cx, cy in cells]
+    raise RuntimeError("Could not place snake")
+
+
+def generate_position(rng: random.Random, phase: str, size: int, num_snakes: int, index: int) -> Dict[str, Any]:
+    """Generates a synthetic /move request for a category
+
+    Args:
+        rng: The random stream the position is drawn from
+        phase: The phase of the game
+        size: The width and height of the board
+        num_snakes: The number of snakes on the board
+        index: The index of the position within its category
+
+    Returns:
+        A /move request in the format sent by the Battlesnake engine
+    """
+    first, last = PHASES[phase]
+    turn = rng.randrange(first, min(last, first + 150))
+    max_length = max(3, (size * size) // (num_snakes * 3))
+    lengths = {"early": (3, 4), "mid": (5, 12), "late": (12, 30)}[phase]
+    occupied: set = set()
+    snakes = []
+    for i in range(num_snakes):
+        length = min(max_length, rng.randint(*lengths))
+        body = _random_body(rng, size, length, occupied)
+        snakes.append({
+            "id": f"snake-{i}", "name": f"snake-{i}", "health": rng.randint(10, 100), "body": body,
+            "latency": "0", "head": body[0], "length": length, "shout": "", "squad": "",
+            "customizations": {"color": "#888888", "head": "default", "tail": "default"},
+        })
+    food = []
+    for _ in range(rng.randint(1, num_snakes + 2)):
+        x, y = rng.randrange(size), rng.randrange(size)
+        if (x, y) not in occupied:
+            occupied.add((x, y))
+            food.append({"x": x, "y": y})
+    game_id = f"bench-{phase}-{size}-{num_snakes}-{index}"
+    return {
+        "game": {"id": game_id, "ruleset": {"name": "standard", "version": "v1.2.3", "settings": {}},
+                 "map": "standard", "source": "custom", "timeout": 500},
+        "turn": turn,
+        "board": {"height": size, "width": size, "food": food, "hazards": [], "snakes": snakes},
+        "you": snakes[0],
+    }
+
+
+def generate_corpus(corpus_dir: str, seed: int = 0):
+    """Fills the corpus with synthetic positions for every phase, board size and number of snakes"""
+    rng = random.Random(seed)
+    for phase in PHASES:
+        for size in BOARD_SIZES:
+            for num_snakes in SNAKE_COUNTS:
+                for index in range(POSITIONS_PER_CATEGORY):
+                    record_position(corpus_dir, generate_position(rng, phase, size, num_snakes, index))
+
+
+def _targets(raw_payloads: Dict[int, bytes]) -> Dict[str, Callable[[Dict[str, Any]], int]]:
+    # Every target takes a /move request and returns the number of search nodes it expanded (0 if not applicable).
+    # raw_payloads holds the encoded body of every request, keyed by the id of its game state
+    import main_game_theory as gt
+    import main_metaheuristics as mh
+    from decoding import decode_game_state
+
+    # Pondering would keep searching in the background between calls and skew the timings
+    gt.ENABLE_PONDERING = False
+
+    def json_decode(game_state):
+        json.loads(raw_payloads[id(game_state)])
+        return 0
+
+    def compact_decode(game_state):
+        decode_game_state(raw_payloads[id(game_state)])
+        return 0
+
+    def gt_move(game_state):
+        response = gt.move(game_state)
+        gt.turn_history.pop(gt.game_key(game_state), None)
+        return response["stats"].get("nodes", 0)
+
+    def gt_tree(game_state):
+        state_tree = gt.State(gt.simplify_game_state(game_state), None, 0, gt.Player.YOU)
+        gt.generate_state_tree(state_tree, gt.NUM_LAYERS, is_root=True)
+        # The tree is generated lazily, so walk it the way move does
+        gt.get_next_moves(state_tree)
+        return gt.nodes_expanded(state_tree)
+
+    def gt_can_fit(game_state):
+        state = gt.simplify_game_state(game_state)
+        root = gt.State(state, None, 0, gt.Player.YOU)
+        for direction in gt.get_possible_moves(root, gt.Player.YOU):
+            gt.can_fit(state, state["you"]["length"], gt.get_snake_move_coord(state, direction, gt.Player.YOU))
+        return 0
+
+    def mh_move(game_state):
+        mh.game_rngs.clear()
+        mh.move(game_state)
+        return 0
+
+    def mh_assess_cost(game_state):
+        rng = random.Random(game_state["game"]["id"])
+        num_steps = len(game_state["you"]["body"])
+        for _ in range(20):
+            mh.assess_cost(game_state, mh.generate_moves(game_state, num_steps, rng))
+        return 0
+
+    return {
+        "decode.json": json_decode,
+        "decode.compact": compact_decode,
+        "game_theory.move": gt_move,
+        "game_theory.generate_state_tree": gt_tree,
+        "game_theory.can_fit": gt_can_fit,
+        "metaheuristics.move": mh_move,
+        "metaheuristics.assess_cost": mh_assess_cost,
+    }
+
+
+def benchmark(corpus: Dict[str, List[Dict[str, Any]]], repeats: int = 3, name_filter: str = "") -> Dict[str, Dict[str, float]]:
+    """Replays the corpus through every target
+
+    Args:
+        corpus: The positions of each category
+        repeats: The number of times each position is replayed. The fastest run is kept
+        name_filter: Only run the benchmarks whose name contains this
+
+    Returns:
+        For each "target/category", the mean time per call in milliseconds, the search nodes per second and the peak
+        memory allocated during a call in kilobytes
+    """
+    results: Dict[str, Dict[str, float]] = {}
+    raw_payloads = {id(game_state): json.dumps(game_state).encode() for positions in corpus.values() for game_state in positions}
+    targets = _targets(raw_payloads)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for target_name, target in targets.items():
+            for category, positions in corpus.items():
+                if name_filter not in f"{target_name}/{category}":
+                    continue
+                times: List[float] = []
+                nodes = 0
+                peak = 0
+                for game_state in positions:
+                    best = float("inf")
+                    for _ in range(repeats):
+                        started = time.perf_counter()
+                        nodes_expanded = target(game_state)
+                        best = min(best, time.perf_counter() - started)
+                    times.append(best)
+                    nodes += nodes_expanded
+
+                    tracemalloc.start()
+                    target(game_state)
+                    peak = max(peak, tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+                total = sum(times)
+                results[f"{target_name}/{category}"] = {
+                    "ms_per_call": 1000 * statistics.fmean(times),
+                    "nodes_per_sec": nodes / total if total > 0 else 0.0,
+                    "peak_kb": peak / 1024,
+                }
+    return results
+
+
+def compare(baseline: Dict[str, Dict[str, float]], results: Dict[str, Dict[str, float]],
+            threshold: float = REGRESSION_THRESHOLD) -> List[Tuple[str, str, float, float]]:
+    """Finds the benchmarks that got slower or use more memory than the baseline
+
+    Args:
+        baseline: The stored baseline results
+        results: The new results
+        threshold: The relative increase that counts as a regression
+
+    Returns:
+        The regressions as (benchmark, metric, baseline value, new value)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("ms_per_call", "peak_kb"):
+            old, new = baseline[name][metric], result[metric]
+            if old > 0 and (new - old) / old > threshold:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def print_results(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]):
+    print(f"{'benchmark':60} {'ms/call':>10} {'nodes/s':>10} {'peak kB':>10} {'vs base':>8}")
+    for name, result in results.items():
+        change = ""
+        if name in baseline and baseline[name]["ms_per_call"] > 0:
+            change = f"{result['ms_per_call'] / baseline[name]['ms_per_call'] - 1:+.0%}"
+        print(f"{name:60} {result['ms_per_call']:10.3f} {result['nodes_per_sec']:10.0f} {result['peak_kb']:10.1f} {change:>8}")
+
+
+
+def _post(url: str, payload: Dict[str, Any]) -> Tuple[float, bytes]:
+    request = urllib.request.Request(url, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+    started = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        body = response.read()
+    return time.perf_counter() - started, body
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_first_move(spec: str, size: int = 11, moves: int = 5) -> Dict[str, float]:
+    """Starts a snake server in a new process, the way a new container does, and times it up to its first moves
+
+    Args:
+        spec: The engine spec to serve (see engines.py), e.g. "game_theory:WARM_UP_ON_START=false"
+        size: The width and height of the board
+        moves: The number of moves to make. Moves after the first are reported as their median
+
+    Returns:
+        In milliseconds: the time until the server answers, the /start request, the first /move, the later moves
+        and the total from launching the process to the first move
+    """
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    code = f"import engines, server; server.run_server(engines.handlers(engines.load_engine({spec!r})), {port})"
+    launched = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                with urllib.request.urlopen(url, timeout=1):
+                    break
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError(f"the server for {spec} exited with {process.returncode}")
+                time.sleep(0.005)
+        ready = time.perf_counter() - launched
+
+        from simulator import Game
+        game = Game("coldstart", [("you", "you"), ("opponent", "opponent")], size, size, random.Random(0))
+        start_time, _ = _post(f"{url}/start", game.game_state("you"))
+        move_times = []
+        while len(move_times) < moves and not game.over:
+            move_time, body = _post(f"{url}/move", game.game_state("you"))
+            move_times.append(move_time)
+            game.step({"you": json.loads(body)["move"]})
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        "ready_ms": 1000 * ready,
+        "start_ms": 1000 * start_time,
+        "first_move_ms": 1000 * move_times[0],
+        "later_move_ms": 1000 * statistics.median(move_times[1:] or move_times),
+        "total_ms": 1000 * (ready + start_time + move_times[0]),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS_DIR)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="generate synthetic positions for every category")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = subparsers.add_parser("run", help="benchmark the corpus")
+    run_parser.add_argument("--repeats", type=int, default=3)
+    run_parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    run_parser.add_argument("--save-baseline", action="store_true")
+    run_parser.add_argument("--compare", action="store_true")
+    run_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+
+    coldstart_parser = subparsers.add_parser("coldstart", help="measure the time from launching each snake's server to its first move")
+    coldstart_parser.add_argument("--engines", nargs="+", default=list(COLD_START_ENGINES))
+    coldstart_parser.add_argument("--size", type=int, default=11, help="board width and height")
+    coldstart_parser.add_argument("--repeats", type=int, default=5)
+
+    args = parser.parse_args()
+
+    if args.command == "coldstart":
+        specs = []
+        for engine in args.engines:
+            specs += [engine, f"{engine}{',' if ':' in engine else ':'}WARM_UP_ON_START=false"]
+        print(f"{'engine':50} {'ready ms':>10} {'/start ms':>10} {'1st move':>10} {'later':>10} {'total':>10}")
+        for spec in specs:
+            runs = [time_to_first_move(spec, args.size) for _ in range(args.repeats)]
+            times = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+            print(f"{spec:50} {times['ready_ms']:10.1f} {times['start_ms']:10.1f} {times['first_move_ms']:10.1f} "
+                  f"{times['later_move_ms']:10.1f} {times['total_ms']:10.1f}")
+        return
+
+    if args.command == "generate":
+        generate_corpus(args.corpus, args.seed)
+        return
+
+    corpus = load_corpus(args.corpus)
+    results = benchmark(corpus, args.repeats, args.filter)
+
+    baseline: Dict[str, Dict[str, float]] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({**baseline, **results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        regressions = compare(baseline, results, args.threshold)
+        for name, metric, old, new in regressions:
+            print(f"REGRESSION {name} {metric}: {old:.3f} -> {new:.3f}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+from typing import Dict, List, Optional, Any, Callable, Set, Tuple
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import threading
+import time
+import traceback
+
+import metrics
+
+DEFAULT_TIMEOUT_MS = 500
+"""The move timeout assumed when a game state doesn't have one, the same as the engine's default"""
+DEFAULT_MARGIN_MS = 150
+"""Time kept back from the game's timeout for the response to reach the engine"""
+DIRECTION_VECTORS = {"up": (0, 1), "down": (0, -1), "left": (-1, 0), "right": (1, 0)}
+"""The change in head position for each move"""
+
+_current = threading.local()
+
+
+def cancel_event() -> Optional[threading.Event]:
+    """Gets the event that is set once the move being worked out on this thread has run out of time. Engines pass it to
+    their search or check it between steps. It is None outside a guarded move, e.g. when an engine is called directly"""
+    return getattr(_current, "cancel", None)
+
+
+def cancelled() -> bool:
+    """Whether the move being worked out on this thread has run out of time"""
+    cancel = getattr(_current, "cancel", None)
+    return cancel is not None and cancel.is_set()
+
+
+def remaining() -> Optional[float]:
+    """Gets the seconds left until the deadline of the move being worked out on this thread, which is negative once it
+    has passed. It is None outside a guarded move"""
+    at = getattr(_current, "deadline", None)
+    return None if at is None else at - time.perf_counter()
+
+
+def fallback_move(game_state: Dict[str, Any]) -> str:
+    """Picks a move without searching, in a few microseconds, for when the engine can't answer in time
+
+    The move stays on the board and out of every body (tails that will move away don't count), avoids the cells next
+    to the head of a snake at least as long as ours where it can, and otherwise goes where there are the most free
+    cells next to the new head
+
+    Args:
+        game_state: The game state of the move request
+
+    Returns:
+        The move, or "up" if every move is deadly
+    """
+    width, height = game_state["board"]["width"], game_state["board"]["height"]
+    you = game_state["you"]
+    blocked: Set[Tuple[int, int]] = set()
+    threats: Set[Tuple[int, int]] = set()
+    for snake in game_state["board"]["snakes"]:
+        body = snake["body"]
+        # The tail moves out of the way unless the snake just ate, which leaves two segments on the tail cell
+        keep = len(body) if len(body) > 1 and body[-1] == body[-2] else len(body) - 1
+        blocked.update((segment["x"], segment["y"]) for segment in body[:keep])
+        if snake["id"] != you["id"] and len(body) >= len(you["body"]):
+            head = body[0]
+            threats.update((head["x"] + dx, head["y"] + dy) for dx, dy in DIRECTION_VECTORS.values())
+
+    def free(cell: Tuple[int, int]) -> bool:
+        return 0 <= cell[0] < width and 0 <= cell[1] < height and cell not in blocked
+
+    head = you["body"][0]
+    options: List[Tuple[bool, int, str]] = []
+    for direction, (dx, dy) in DIRECTION_VECTORS.items():
+        cell = (head["x"] + dx, head["y"] + dy)
+        if not free(cell):
+            continue
+        space = sum(free((cell[0] + nx, cell[1] + ny)) for nx, ny in DIRECTION_VECTORS.values())
+        options.append((cell not in threats, space, direction))
+    if not options:
+        return "up"
+    # max keeps the first of equal options, so ties go to the order of DIRECTION_VECTORS
+    return max(options, key=lambda option: option[:2])[2]
+
+
+class DeadlineGuard:
+    """Makes sure every /move gets an answer within the game's timeout
+
+    The engine runs on a thread of its own while the request waits for it until the deadline: the game's timeout less
+    a margin for the response to reach the engine. If the engine hasn't answered by then (or fails), the request answers
+    with fallback_move instead and the engine's cancel event is set, so a search that checks it stops straight away.
+    A search that doesn't check it runs to the end and its answer is thrown away.
+
+    Args:
+        margin_ms: Time kept back from the game's timeout
+    """
+    def __init__(self, margin_ms: float = DEFAULT_MARGIN_MS) -> None:
+        self.margin_ms = margin_ms
+        """Time kept back from the game's timeout"""
+        self.moves = 0
+        """The number of moves guarded"""
+        self.fallbacks = 0
+        """The number of moves answered with the fallback move"""
+
+    def run(self, game_state: Dict[str, Any], search: Callable[[], Dict[str, Any]], started: float) -> Dict[str, Any]:
+        """Runs the engine under the deadline of a move request
+
+        Args:
+            game_state: The game state of the move request
+            search: Works out the move response with the engine
+            started: When the request started (from time.perf_counter). The deadline counts from here
+
+        Returns:
+            The engine's response, or a fallback move response
+        """
+        self.moves += 1
+        timeout_ms = game_state["game"].get("timeout") or DEFAULT_TIMEOUT_MS
+        at = started + (timeout_ms - self.margin_ms) / 1000
+        cancel = threading.Event()
+        future: Future = Future()
+        threading.Thread(target=self._search, args=(search, cancel, future, at), name="move", daemon=True).start()
+        try:
+            return future.result(max(at - time.perf_counter(), 0))
+        except FutureTimeout:
+            reason = "deadline"
+        except Exception:
+            traceback.print_exc()
+            reason = "error"
+        cancel.set()
+        self.fallbacks += 1
+        metrics.inc("battlesnake_fallback_moves_total", 1, "Moves answered with the fallback move instead of the engine's", reason=reason)
+        move = fallback_move(game_state)
+        print(f"MOVE {game_state['turn']}: {move} | fallback after {(time.perf_counter() - started) * 1000:.0f}ms ({reason})")
+        return {"move": move}
+
+    def _search(self, search: Callable[[], Dict[str, Any]], cancel: threading.Event, future: Future, at: float):
+        _current.cancel = cancel
+        _current.deadline = at
+        try:
+            future.set_result(search())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            _current.cancel = None
+            _current.deadline = None
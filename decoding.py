@@ -0,0 +1,69 @@
+from typing import Dict, Any, Callable
+import json
+
+try:
+    import orjson
+    loads: Callable[[bytes], Any] = orjson.loads
+    """The JSON parser used for requests. orjson when it is installed, otherwise the standard library"""
+except ImportError:
+    loads = json.loads
+
+SNAKE_FIELDS = ("id", "name", "health", "body", "head", "length", "latency")
+"""The snake fields that the engines read. Everything else (customizations, shout, squad) is dropped"""
+
+
+def compact_snake(snake: Dict[str, Any]) -> Dict[str, Any]:
+    """Copies only the fields of a snake that the engines use
+
+    Args:
+        snake: The snake as sent by the Battlesnake engine
+
+    Returns:
+        The compact snake
+    """
+    return {field: snake[field] for field in SNAKE_FIELDS if field in snake}
+
+
+def compact_game_state(game_state: Dict[str, Any]) -> Dict[str, Any]:
+    """Copies only the parts of a game state that the engines use. The result keeps the same layout as the request,
+    so it can be passed to any handler, but without the ruleset settings, map, hazards and snake customizations
+
+    Args:
+        game_state: The game state as sent by the Battlesnake engine
+
+    Returns:
+        The compact game state
+    """
+    game = game_state["game"]
+    board = game_state["board"]
+    return {
+        "game": {"id": game["id"], "timeout": game["timeout"]},
+        "turn": game_state["turn"],
+        "board": {
+            "height": board["height"],
+            "width": board["width"],
+            "food": board["food"],
+            "snakes": [compact_snake(snake) for snake in board["snakes"]],
+        },
+        "you": compact_snake(game_state["you"]),
+    }
+
+
+def decode_game_state(raw: bytes) -> Dict[str, Any]:
+    """Decodes the body of a /start, /move or /end request straight into the compact game state
+
+    Args:
+        raw: The request body
+
+    Returns:
+        The compact game state
+
+    Raises:
+        ValueError: If the body isn't JSON or is missing part of the game state
+    """
+    # orjson's and the standard library's decode errors are both ValueErrors
+    game_state = loads(raw)
+    try:
+        return compact_game_state(game_state)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"not a game state, missing {e}") from e
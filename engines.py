@@ -0,0 +1,87 @@
+"""Loads the snake engines by name, optionally as variants with some of their constants changed
+
+An engine spec is an engine name, optionally followed by settings, e.g. `game_theory:AGGRESSION_MULTIPLIER=0.5,NUM_LAYERS=4`
+or `metaheuristics_tuned:food_benefit=6`. A setting is either a module constant of the engine or, for the tuned
+metaheuristics engine, one of its `Global.hyper_parameters`. Every variant is loaded as a separate copy of the engine's
+module, so variants (and the engine itself) can play in the same process without sharing any state.
+
+An engine's move returns the move and, under "stats", what it knows about how it chose it (e.g. the depth and value of
+its search). The stats belong to the response of that one move, so moves of other games can't overwrite them. The
+server takes them out of the response before sending it, and records them with the game (see recorder.py).
+"""
+from typing import Dict, Any, Callable, Tuple
+from types import ModuleType
+import importlib
+import importlib.util
+import json
+import os
+
+ENGINE_MODULES = {
+    "game_theory": "main_game_theory",
+    "metaheuristics": "main_metaheuristics",
+    "metaheuristics_tuned": "metaheuristic_withHyperParams",
+    "portfolio": "portfolio",
+}
+"""The module of every engine, by engine name"""
+
+_variants: Dict[str, ModuleType] = {}
+
+
+def parse_spec(spec: str) -> Tuple[str, Dict[str, Any]]:
+    """Splits an engine spec into the engine name and its settings. Values are parsed as JSON where possible
+
+    Args:
+        spec: The engine spec
+
+    Returns:
+        The engine name and the settings
+    """
+    name, _, settings = spec.partition(":")
+    if name not in ENGINE_MODULES:
+        raise ValueError(f"unknown engine {name}, expected one of {', '.join(ENGINE_MODULES)}")
+    overrides: Dict[str, Any] = {}
+    for setting in filter(None, settings.split(",")):
+        key, _, value = setting.partition("=")
+        try:
+            overrides[key.strip()] = json.loads(value)
+        except ValueError:
+            overrides[key.strip()] = value
+    return name, overrides
+
+
+def load_engine(spec: str) -> ModuleType:
+    """Gets the module of an engine spec, loading a separate copy of the engine for a variant
+
+    Args:
+        spec: The engine spec
+
+    Returns:
+        The engine module
+    """
+    name, overrides = parse_spec(spec)
+    if not overrides:
+        return importlib.import_module(ENGINE_MODULES[name])
+    if spec in _variants:
+        return _variants[spec]
+
+    module_name = ENGINE_MODULES[name]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{module_name}.py")
+    module_spec = importlib.util.spec_from_file_location(f"{module_name}__variant{len(_variants)}", path)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    for key, value in overrides.items():
+        if hasattr(module, key):
+            setattr(module, key, value)
+        elif hasattr(module, "Global") and key in module.Global.hyper_parameters["value"]:
+            # Copy the hyper parameters so the variant doesn't share them with other copies of the class
+            hyper_parameters = {**module.Global.hyper_parameters, "value": {**module.Global.hyper_parameters["value"], key: value}}
+            module.Global.set_hyper_parameters(hyper_parameters)
+        else:
+            raise ValueError(f"{name} has no setting {key}")
+    _variants[spec] = module
+    return module
+
+
+def handlers(module: ModuleType) -> Dict[str, Callable]:
+    """Gets the handlers of an engine in the form run_server takes"""
+    return {"info": module.info, "start": module.start, "move": module.move, "end": module.end}
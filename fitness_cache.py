@@ -0,0 +1,177 @@
+from typing import Dict, Optional, Any, Tuple
+from collections import OrderedDict
+import hashlib
+import json
+import os
+
+DEFAULT_CACHE_PATH = "fitness_cache.json"
+"""Where the fitness cache is persisted between tuning runs"""
+DEFAULT_MAX_ENTRIES = 10000
+"""Maximum number of evaluations kept before the least recently used ones are evicted"""
+FLOAT_QUANTUM = 0.01
+"""Step that float hyperparameters are snapped to, so near-identical parameter sets share cache entries"""
+CACHE_FORMAT_VERSION = 1
+"""Bumped whenever the layout of the cache file changes"""
+
+
+def quantize_params(params: Dict[str, Any], quantum: float = FLOAT_QUANTUM) -> Dict[str, Any]:
+    """Snaps float hyperparameters onto a grid so that equivalent parameter sets compare equal
+
+    Args:
+        params: The hyperparameter values to quantize
+        quantum: The grid step for float values
+
+    Returns:
+        A copy of the parameters with every float rounded to the nearest multiple of the quantum
+    """
+    quantized = {}
+    for name, value in params.items():
+        if isinstance(value, float):
+            value = round(round(value / quantum) * quantum, 10)
+        quantized[name] = value
+    return quantized
+
+
+def engine_version(*source_paths: str) -> str:
+    """Gets a version tag for the engine by hashing every file its fitness depends on. Any change to them produces a
+    new tag
+
+    Args:
+        source_paths: The files that make up the engine, e.g. its modules and the rules binary. A file that doesn't
+            exist is hashed by name
+
+    Returns:
+        A short hex digest of the files
+    """
+    digest = hashlib.sha1()
+    for path in sorted(source_paths):
+        digest.update(os.path.basename(path).encode() + b"\0")
+        if not os.path.exists(path):
+            digest.update(b"missing\0")
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def make_key(params: Dict[str, Any], seed: Optional[int], opponent: str, version: str) -> str:
+    """Builds the cache key for a single evaluated game
+
+    Args:
+        params: The hyperparameter values that were played
+        seed: The seed of the game
+        opponent: The opponent that was played against
+        version: The engine version tag
+
+    Returns:
+        A string key that is stable across processes
+    """
+    return json.dumps([quantize_params(params), seed, opponent, version], sort_keys=True)
+
+
+class FitnessCache:
+    """A persistent LRU cache of fitness results for (hyperparameters, seed, opponent, engine version). Only seeded games
+    are cached, since a game without a seed can't be played again the same way"""
+    def __init__(self, path: Optional[str] = DEFAULT_CACHE_PATH, version: str = "", max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        self.path = path
+        """The file the cache is persisted to. If None, the cache only lives in memory"""
+        self.version = version
+        """The engine version that results are stored for. Entries from other versions are invalidated"""
+        self.max_entries = max_entries
+        """The number of entries kept before evicting the least recently used"""
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        """The cached results, ordered from least to most recently used"""
+        self.hits = 0
+        """The number of lookups answered from the cache"""
+        self.misses = 0
+        """The number of lookups that required playing a game"""
+        self.load()
+
+    def get(self, params: Dict[str, Any], seed: Optional[int], opponent: str) -> Optional[Dict[str, Any]]:
+        """Gets the stored result for a game
+
+        Args:
+            params: The hyperparameter values
+            seed: The seed of the game
+            opponent: The opponent that was played against
+
+        Returns:
+            The stored result containing "fitness" and "metrics", or None on a miss or if the game has no seed
+        """
+        if seed is None:
+            self.misses += 1
+            return None
+        key = make_key(params, seed, opponent, self.version)
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, params: Dict[str, Any], seed: Optional[int], opponent: str, fitness: float, metrics: Dict[str, Any]):
+        """Stores the result of a game, evicting the least recently used entries if the cache is full. Games without a
+        seed aren't stored
+
+        Args:
+            params: The hyperparameter values
+            seed: The seed of the game
+            opponent: The opponent that was played against
+            fitness: The fitness calculated for the game
+            metrics: The snake performance metrics of the game
+        """
+        if seed is None:
+            return
+        key = make_key(params, seed, opponent, self.version)
+        self.entries[key] = {"fitness": fitness, "metrics": dict(metrics)}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, version: Optional[str] = None):
+        """Drops cached results. If a version is given, only results from that engine version are kept
+
+        Args:
+            version: The engine version to keep. If None, every entry is dropped
+        """
+        if version is None:
+            self.entries.clear()
+            return
+        suffix = json.dumps(version) + "]"
+        stale = [key for key in self.entries if not key.endswith(suffix)]
+        for key in stale:
+            del self.entries[key]
+
+    def load(self):
+        """Loads the cache from disk, discarding anything written by a different engine version"""
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("format") != CACHE_FORMAT_VERSION:
+            return
+        self.entries = OrderedDict((key, value) for key, value in data.get("entries", []))
+        self.invalidate(self.version)
+
+    def save(self):
+        """Writes the cache to disk atomically"""
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"format": CACHE_FORMAT_VERSION, "entries": list(self.entries.items())}, f)
+        os.replace(tmp_path, self.path)
+
+    def stats(self) -> Tuple[int, int, int]:
+        """Gets the hit, miss and size counts of the cache
+
+        Returns:
+            A tuple of (hits, misses, entries)
+        """
+        return self.hits, self.misses, len(self.entries)
+
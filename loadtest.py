@@ -0,0 +1,299 @@
+"""Load tests a snake server by playing many games against it at once, like the Battlesnake engine would
+
+Every game follows the real lifecycle: /start for each snake, then /move for each live snake every turn (all snakes of
+a turn at once), then /end. The games are played by simulator.Game, and every snake in a game is played by the server
+under test. Requests go through an asyncio client that keeps a pool of keep-alive connections. For each concurrency
+level the report shows the throughput, the latency percentiles of /move and the fraction of moves that missed the
+game timeout.
+
+Usage:
+    python main_game_theory.py &
+    python loadtest.py --url http://127.0.0.1:8080 --concurrency 1 2 4 8 --games 8
+    python loadtest.py --url http://127.0.0.1:8080/snakes/aggressive   # a snake hosted by `python server.py`
+"""
+from typing import Dict, List, Optional, Any, Tuple
+from urllib.parse import urlsplit
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from simulator import Game
+
+DEFAULT_URL = "http://127.0.0.1:8080"
+"""The server that is tested by default"""
+DEFAULT_CONCURRENCY = (1, 2, 4, 8, 16)
+"""The numbers of games played at once by default"""
+PERCENTILES = (50, 95, 99)
+"""The latency percentiles that are reported"""
+
+
+class HTTPError(Exception):
+    """A request got a response other than 200 OK"""
+
+
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 connections to one server, shared by all games
+
+    Connections are reused while the server keeps them open. If it closes them a new one is opened for the next
+    request, which is what happens with server.run_server: the Werkzeug development server closes every connection
+    after one response. At most `size` requests are in flight at once.
+    """
+    def __init__(self, url: str, size: int) -> None:
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        """The host of the server"""
+        self.port = parts.port or 80
+        """The port of the server"""
+        self.prefix = parts.path.rstrip("/")
+        """The path of the snake on the server, e.g. /snakes/<name> for a snake hosted by a server.SnakeRegistry"""
+        self.idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        """Open connections that aren't in use"""
+        self.slots = asyncio.Semaphore(size)
+        """Limits the number of requests in flight"""
+        self.opened = 0
+        """The number of connections opened, to check how well they are reused"""
+
+    async def request(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None) -> Any:
+        """Posts a JSON payload and returns the decoded response body
+
+        Args:
+            path: The path to post to, relative to the snake's URL
+            payload: The request body
+            timeout: Seconds to wait for the response. On a timeout the connection is dropped, since it may still get a response
+
+        Returns:
+            The decoded response, or the response text if it isn't JSON
+        """
+        body = json.dumps(payload).encode()
+        async with self.slots:
+            if self.idle:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                self.opened += 1
+            try:
+                status, keep_alive, data = await asyncio.wait_for(self._exchange(reader, writer, path, body), timeout)
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+        if status != 200:
+            raise HTTPError(f"{path} returned {status}")
+        try:
+            return json.loads(data)
+        except ValueError:
+            return data.decode(errors="replace")
+
+    async def _exchange(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, path: str,
+                        body: bytes) -> Tuple[int, bool, bytes]:
+        writer.write(
+            f"POST {self.prefix}{path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("the server closed the connection")
+        version, status = status_line.decode().split()[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+        if "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return int(status), keep_alive, data
+
+    def close(self):
+        """Closes every idle connection"""
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+
+class LevelStats:
+    """What happened while playing at one concurrency level"""
+    def __init__(self, concurrency: int) -> None:
+        self.concurrency = concurrency
+        """The number of games played at once"""
+        self.games = 0
+        """The number of games finished"""
+        self.turns = 0
+        """The number of turns played"""
+        self.latencies: List[float] = []
+        """The latency of every /move that got a response in time, in milliseconds"""
+        self.timeouts = 0
+        """The number of /move requests that didn't get a response within the game timeout"""
+        self.errors = 0
+        """The number of requests that failed or got an invalid move"""
+        self.elapsed = 0.0
+        """The wall time of the level, in seconds"""
+        self.connections = 0
+        """The number of connections opened"""
+
+    @property
+    def moves(self) -> int:
+        """The number of /move requests that got a response or timed out"""
+        return len(self.latencies) + self.timeouts
+
+    def report(self) -> Dict[str, Any]:
+        """Summarizes the level as a dict of plain values"""
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+        return {
+            "concurrency": self.concurrency,
+            "games": self.games,
+            "moves": self.moves,
+            "moves_per_sec": self.moves / self.elapsed if self.elapsed else 0.0,
+            "turns_per_sec": self.turns / self.elapsed if self.elapsed else 0.0,
+            **{f"p{p}_ms": percentile(p) for p in PERCENTILES},
+            "timeout_rate": self.timeouts / self.moves if self.moves else 0.0,
+            "errors": self.errors,
+            "connections": self.connections,
+        }
+
+
+async def play_game(pool: ConnectionPool, stats: LevelStats, game_id: str, num_snakes: int, size: int,
+                    timeout_ms: int, max_turns: int, rng: random.Random):
+    """Plays one game against the server, recording the latency of every move
+
+    Args:
+        pool: The connections to the server
+        stats: Where the results are recorded
+        game_id: The id of the game
+        num_snakes: The number of snakes in the game, all played by the server
+        size: The width and height of the board
+        timeout_ms: The move timeout of the game
+        max_turns: The turn at which the game is stopped if it is still going
+        rng: The random stream of the game
+    """
+    game = Game(game_id, [(f"{game_id}-{i}", f"snake-{i}") for i in range(num_snakes)], size, size, rng, timeout_ms)
+    snake_ids = [snake["id"] for snake in game.snakes]
+    timeout = timeout_ms / 1000
+
+    async def call(path: str, snake_id: str):
+        try:
+            await pool.request(path, game.game_state(snake_id))
+        except (OSError, HTTPError, asyncio.IncompleteReadError):
+            stats.errors += 1
+
+    async def move(snake_id: str) -> Tuple[str, Optional[str]]:
+        started = time.perf_counter()
+        try:
+            response = await pool.request("/move", game.game_state(snake_id), timeout)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            return snake_id, None
+        except (OSError, HTTPError, asyncio.IncompleteReadError):
+            stats.errors += 1
+            return snake_id, None
+        stats.latencies.append((time.perf_counter() - started) * 1000)
+        if not isinstance(response, dict) or response.get("move") not in ("up", "down", "left", "right"):
+            stats.errors += 1
+            return snake_id, None
+        return snake_id, response["move"]
+
+    await asyncio.gather(*(call("/start", snake_id) for snake_id in snake_ids))
+    while not game.over and game.turn < max_turns:
+        moves = await asyncio.gather(*(move(snake["id"]) for snake in game.snakes))
+        game.step({snake_id: direction for snake_id, direction in moves if direction is not None})
+        stats.turns += 1
+    await asyncio.gather(*(call("/end", snake_id) for snake_id in snake_ids))
+    stats.games += 1
+
+
+async def run_level(url: str, concurrency: int, games: int, num_snakes: int, size: int, timeout_ms: int,
+                    max_turns: int, seed: int) -> LevelStats:
+    """Plays a number of games with a fixed number in progress at once
+
+    Args:
+        url: The server under test
+        concurrency: The number of games in progress at once
+        games: The number of games to play
+        num_snakes: The number of snakes in each game
+        size: The width and height of the board
+        timeout_ms: The move timeout of each game
+        max_turns: The turn at which games are stopped
+        seed: Seeds the games, so every level plays the same ones
+
+    Returns:
+        The results of the level
+    """
+    stats = LevelStats(concurrency)
+    pool = ConnectionPool(url, concurrency * num_snakes)
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(games):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            await play_game(pool, stats, f"load-{seed}-{concurrency}-{i}", num_snakes, size, timeout_ms, max_turns,
+                            random.Random(f"{seed}:{i}"))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    stats.elapsed = time.perf_counter() - started
+    stats.connections = pool.opened
+    pool.close()
+    return stats
+
+
+def format_report(reports: List[Dict[str, Any]]) -> str:
+    """Formats the reports of every level as a table"""
+    lines = [f"{'games at once':>13} {'moves/s':>9} {'turns/s':>9} "
+             + " ".join(f"{f'p{p} ms':>9}" for p in PERCENTILES) + f" {'timeouts':>9} {'errors':>7}"]
+    for report in reports:
+        lines.append(f"{report['concurrency']:>13} {report['moves_per_sec']:>9.1f} {report['turns_per_sec']:>9.1f} "
+                     + " ".join(f"{report[f'p{p}_ms']:>9.1f}" for p in PERCENTILES)
+                     + f" {report['timeout_rate']:>8.1%} {report['errors']:>7}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(DEFAULT_CONCURRENCY),
+                        help="the numbers of games to play at once, one level each")
+    parser.add_argument("--games", type=int, default=0, help="games per level (default: twice the concurrency)")
+    parser.add_argument("--snakes", type=int, default=2, help="snakes per game")
+    parser.add_argument("--size", type=int, default=11, help="board width and height")
+    parser.add_argument("--timeout", type=int, default=500, help="move timeout in milliseconds")
+    parser.add_argument("--max-turns", type=int, default=100, help="stop games that reach this turn")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the reports as JSON lines")
+    args = parser.parse_args()
+
+    reports = []
+    for concurrency in args.concurrency:
+        stats = asyncio.run(run_level(args.url, concurrency, args.games or 2 * concurrency, args.snakes, args.size,
+                                      args.timeout, args.max_turns, args.seed))
+        report = stats.report()
+        reports.append(report)
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print(f"{concurrency} games at once: {report['moves']} moves in {stats.elapsed:.1f}s over {stats.connections} connections")
+    if not args.json:
+        print(format_report(reports))
+
+
+if __name__ == "__main__":
+    main()
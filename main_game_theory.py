@@ -10,10 +10,21 @@
 # To get you started we've included code to prevent your Battlesnake from moving backwards.
 # For more info see docs.battlesnake.com
 
-from typing import Dict, List, Set, Optional, Any, Tuple
+from typing import Dict, List, Set, Optional, Any, Tuple, Iterator
 import enum
+import os
+import threading
+import time
 from copy import deepcopy
 
+import deadline
+import metrics
+from opening_book import load_book
+from node_arena import NodeArena, PLAYERS, UNEXPANDED, apply_move
+from pondering import Ponderer, PonderSignal
+from profiler import safe_file_name
+from territory import board_masks, evaluate_state
+
 NUM_LAYERS = 5
 """Number of layers to generate in the state tree"""
 LAYER_REWARD_DECAY = 0.5 
@@ -30,6 +41,26 @@ BESIDE_FOOD_REWARD = 10
 """The reward for moving to the food when the snake is already beside it"""
 AVOID_HEAD_REWARD = -100
 """The penalty for moving towards the opponent's head when the opponent is larger"""
+USE_TERRITORY_EVALUATION = True
+"""Score moves with a single simultaneous BFS from every head (territory, reachable area and nearest food) instead of
+can_fit, aggression_reward and the distance to every food"""
+TERRITORY_REWARD_MULTIPLIER = 0.05
+"""The reward for every cell of territory the player controls beyond what the opponent controls"""
+OPENING_BOOK_PATH = "opening_book.bin"
+"""The opening book consulted before searching. Positions that aren't in the book (or if there is no book) are searched as usual"""
+ENABLE_PONDERING = True
+"""Keep searching the positions that follow each opponent reply while waiting for the next request"""
+PONDER_LAYERS = NUM_LAYERS + 2
+"""Number of layers to generate when pondering. Deeper than a live search, since there is no deadline"""
+ORDER_CHILDREN = True
+"""Generate all children of a state at once and visit them best reward first, instead of one at a time as they are needed.
+Finding a good line early lets get_max_depth stop sooner and get_max_reward skip more of the tree"""
+TRACE_DIR = os.environ.get("BATTLESNAKE_TRACE_DIR")
+"""Where the search trees of every game are written when it ends (see tracing.py). Trees are only kept if this is set"""
+WARM_UP_ON_START = True
+"""Search the start position once when a game starts, so the first move doesn't pay for first use of the search"""
+WARM_UP_LAYERS = 2
+"""Number of layers searched by the warm-up. Enough to run every part of the search once, without spending the whole /start on it"""
 
 class Player(enum.Enum):
     """The player that is making the move"""
@@ -43,22 +74,86 @@ class Direction(enum.Enum):
     LEFT = "left"
     RIGHT = "right"
 
+DIRECTIONS = list(Direction)
+"""Every direction, indexed by the move stored in a NodeArena"""
+
 class State:
-    """A state in the state tree"""
+    """A state in the state tree
+
+    The tree lives in a NodeArena, and a State is only a view of one of its nodes. Creating a State from a game state
+    starts a new tree with it at the root. Views of the other nodes are created as the tree is walked, and the game
+    state of a node is rebuilt from the root when it is first read from a view.
+    """
     def __init__(self, state: Dict[str, Any], move_made: Optional[Direction], reward: float, player_turn: Player) -> None:
-        self.state = state
+        self.arena = NodeArena(state, PLAYERS.index(player_turn.value), reward, -1 if move_made is None else DIRECTIONS.index(move_made))
+        """The tree the state belongs to"""
+        self.index = 0
+        """The node of the state in the tree"""
+        self._state: Optional[Dict[str, Any]] = state
+
+    @classmethod
+    def view(cls, arena: NodeArena, index: int) -> "State":
+        """Gets a view of a node of a tree"""
+        state = cls.__new__(cls)
+        state.arena = arena
+        state.index = index
+        state._state = None
+        return state
+
+    @property
+    def state(self) -> Dict[str, Any]:
         """The state of the game"""
-        self.player_turn = player_turn
+        if self._state is None:
+            self._state = self.arena.state(self.index)
+        return self._state
+
+    @property
+    def player_turn(self) -> Player:
         """The player that is making the move"""
-        self.reward = reward
-        """The reward the player gets for making the move"""
-        self.move_made = move_made
-        """The move that was made to get to this state"""
-        self.next_states: List[State] = []
-        """The next states that can be reached from this state"""
+        return Player(PLAYERS[self.arena.player[self.index]])
 
+    @property
+    def reward(self) -> float:
+        """The reward the player gets for making the move"""
+        return self.arena.reward[self.index]
 
-turn_history: List[State] = []
+    @property
+    def move_made(self) -> Optional[Direction]:
+        """The move that was made to get to this state"""
+        move = self.arena.move[self.index]
+        return None if move < 0 else DIRECTIONS[move]
+
+    @property
+    def layers(self) -> int:
+        """The number of layers below this state that can still be generated"""
+        return max(self.arena.layers - self.arena.depth[self.index], 0)
+
+    @property
+    def expanded_states(self) -> List["State"]:
+        """The next states that have been generated so far"""
+        return [State.view(self.arena, child) for child in self.arena.children(self.index)]
+
+    @property
+    def next_states(self) -> List["State"]:
+        """The next states that can be reached from this state, generating any that haven't been yet"""
+        return list(self.iter_next_states())
+
+    def iter_next_states(self) -> Iterator["State"]:
+        """Iterates over the next states, only generating each one when it is reached"""
+        arena = self.arena
+        last = -1
+        while True:
+            child = arena.first_child[self.index] if last < 0 else arena.next_sibling[last]
+            if child < 0:
+                if not expand_next_state(self):
+                    return
+                continue
+            yield State.view(arena, child)
+            last = child
+
+
+turn_history: Dict[str, List[State]] = {}
+"""The search tree of every turn of every game being played, keyed by game_key, kept only while tracing"""
 
 def info() -> Dict[str, Any]:
     print("INFO")
@@ -72,66 +167,155 @@ def info() -> Dict[str, Any]:
     }
 
 
+def game_key(game_state: Dict[str, Any]) -> str:
+    """Gets the key of the game and snake a request is for. Pondering and traces are kept per snake, since one server
+    can play several snakes in the same game"""
+    return f"{game_state['game']['id']}:{game_state['you']['id']}"
+
+
 # start is called when your Battlesnake begins a game
 def start(game_state: Dict[str, Any]):
     print("GAME START")
-    turn_history.clear()
+    if TRACE_DIR:
+        turn_history[game_key(game_state)] = []
+    if WARM_UP_ON_START:
+        warm_up(game_state)
 
 
-# end is called when your Battlesnake finishes a game
-def end(game_state: Dict[str, Any]):
-    print(f"GAME OVER. Turns Done: {len(turn_history)}\n\n")
-    while True:
-        turn = input("Select turn to view: ")
-        if turn == "q":
-            break
-        depth = input("Select depth to view: ")
+def warm_up(game_state: Dict[str, Any]):
+    """Runs everything the first move of a game uses once, so the move doesn't pay for it: the territory masks of the
+    board size if territory evaluation is on, the opening book and a search of the position. Nothing is recorded and
+    nothing is pondered
 
-        visualize_game_state(turn_history[int(turn)], int(depth))
+    Args:
+        game_state: The game state sent to /start
+    """
+    game_state = simplify_game_state(game_state)
+    if USE_TERRITORY_EVALUATION:
+        board_masks(game_state["board"]["width"], game_state["board"]["height"])
+    book = load_book(OPENING_BOOK_PATH)
+    if book is not None:
+        book.lookup(game_state)
+    state_tree = State(game_state, None, 0, Player.YOU)
+    generate_state_tree(state_tree, WARM_UP_LAYERS, is_root=True)
+    get_next_moves(state_tree)
 
 
-def generate_state_tree(root_state: State, layers: int, is_root = False):
-    """Generates a tree of states for the given root state
+# end is called when your Battlesnake finishes a game
+def end(game_state: Dict[str, Any]):
+    key = game_key(game_state)
+    ponderer.end_game(key)
+    print(f"GAME OVER. Turns Done: {game_state['turn']}\n\n")
+    history = turn_history.pop(key, None)
+    if TRACE_DIR and history:
+        # Write the trace in the background so the request returns straight away. View it with tracing.py
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_DIR, safe_file_name(f"{game_state['game']['id']}.{game_state['you']['id']}") + ".trace")
+        from tracing import write_trace
+        threading.Thread(target=write_trace, args=(path, history), name="trace").start()
+        print(f"Writing trace to {path}")
+
+
+def generate_state_tree(root_state: State, layers: int, is_root = False, cancel: Optional[threading.Event] = None):
+    """Sets up a tree of states for the given root state. The tree is generated lazily: the next states of a state are
+    only created when they are first visited (see State.iter_next_states), so a search only pays for what it looks at
 
     Args:
         root_state: The state to generate the tree from
         layers: The number of layers to generate
         is_root: Whether or not the given state is the root state. This is important because the child states of the root are always the player's states
+        cancel: Stops the generation as soon as it is set, leaving the tree incomplete
 
     Returns:
         The generated state tree
     """
-    # If we've reached the end of the tree, return the root state
-    if layers == 0:
-        return root_state
+    arena = root_state.arena
+    arena.layers = arena.depth[root_state.index] + layers
+    arena.cancel = cancel
+    arena.root_moves_first = is_root
+    return root_state
 
-    player_turn = root_state.player_turn
+def get_next_player_turn(root_state: State) -> Player:
+    """Gets the player that moves in the next states of a state"""
     # If an opponent exists, we need to alternate between players
-    if "opponent" in root_state.state:
-        if is_root:
-            player_turn = Player.YOU
-            next_player_turn = Player.YOU
-        else:
-            next_player_turn = Player.YOU if player_turn == Player.OPPONENT else Player.OPPONENT
-    else:
-        next_player_turn = player_turn
+    if "opponent" not in root_state.state:
+        return root_state.player_turn
+    if root_state.index == 0 and root_state.arena.root_moves_first:
+        return Player.YOU
+    return Player.YOU if root_state.player_turn == Player.OPPONENT else Player.OPPONENT
 
-    next_possible_moves = get_possible_moves(root_state, next_player_turn)
+def expand_next_state(root_state: State) -> bool:
+    """Generates the next unexpanded state of a state (all of them if ORDER_CHILDREN is set)
 
-    for next_move in next_possible_moves:
+    Args:
+        root_state: The state to expand
+
+    Returns:
+        Whether any new next states were generated
+    """
+    arena = root_state.arena
+    index = root_state.index
+    pending = arena.pending[index]
+    if pending == 0:
+        return False
+    # If we've reached the end of the tree (or been cancelled), there is nothing to generate
+    if root_state.layers == 0 or (arena.cancel is not None and arena.cancel.is_set()):
+        arena.pending[index] = 0
+        return False
+
+    next_player_turn = get_next_player_turn(root_state)
+    if pending == UNEXPANDED:
+        pending = 0
+        for next_move in get_possible_moves(root_state, next_player_turn):
+            pending |= 1 << DIRECTIONS.index(next_move)
+
+    next_moves = [move for i, move in enumerate(DIRECTIONS) if pending & (1 << i)]
+    if not ORDER_CHILDREN:
+        next_moves = next_moves[:1]
+    for next_move in next_moves:
+        pending &= ~(1 << DIRECTIONS.index(next_move))
+    arena.pending[index] = pending
+
+    children = []
+    for next_move in next_moves:
         coords = get_snake_move_coord(root_state.state, next_move, next_player_turn)
-        move_reward = coord_to_reward(root_state, coords, next_player_turn)
-        next_state = move_snake(root_state.state, next_move, next_player_turn)
-        state = State(next_state, next_move, move_reward, next_player_turn)
-        root_state.next_states.append(state)
+        ate = coords in root_state.state["board"]["food"]
+        next_state = apply_move(root_state.state, next_player_turn.value, coords, ate)
+        move_reward = coord_to_reward(root_state, coords, next_player_turn, next_state)
+        children.append((move_reward, next_move, coords, ate))
+
+    if ORDER_CHILDREN:
+        children.sort(key=lambda child: child[0], reverse=True)
+    player = PLAYERS.index(next_player_turn.value)
+    for move_reward, next_move, coords, ate in children:
+        arena.add_child(index, DIRECTIONS.index(next_move), player, coords, ate, move_reward)
+    return len(next_moves) > 0
+
+def nodes_expanded(state_tree: State) -> int:
+    """Gets the number of states a search has generated below the root of its tree. Every search has its own tree,
+    so the count isn't mixed with the other searches running at the same time"""
+    return len(state_tree.arena) - 1
+
+def max_move_reward(game_state: Dict[str, Any]) -> float:
+    """Gets an upper bound on the reward of any single move from a state or the states below it (see coord_to_reward).
+    Food is never added to the tree, so the bound only shrinks further down
 
-    for next_state in root_state.next_states:
-        generate_state_tree(next_state, layers-1)
+    Args:
+        game_state: The state of the game
 
-    return root_state
+    Returns:
+        The upper bound
+    """
+    board = game_state["board"]
+    if USE_TERRITORY_EVALUATION:
+        # Only the nearest food counts besides the food eaten
+        food_reward = BESIDE_FOOD_REWARD + 1 if board["food"] else 0
+        return food_reward + TERRITORY_REWARD_MULTIPLIER * board["width"] * board["height"]
+    food_reward = BESIDE_FOOD_REWARD + len(board["food"]) if board["food"] else 0
+    return food_reward + AGGRESSION_MULTIPLIER * (board["width"] + board["height"])
 
 def get_max_depth(state: State) -> int:
-    """Gets the maximum depth of the state tree
+    """Gets the maximum depth of the state tree. Stops as soon as a line reaches the bottom of the tree, so the rest of the tree isn't generated
 
     Args:
         state: The state to get the maximum depth from
@@ -139,22 +323,43 @@ def get_max_depth(state: State) -> int:
     Returns:
         The maximum depth of the state tree
     """
-    if len(state.next_states) == 0:
-        return 1
-    return 1 + max(get_max_depth(next_state) for next_state in state.next_states)
+    max_depth = 0
+    for next_state in state.iter_next_states():
+        max_depth = max(max_depth, get_max_depth(next_state))
+        if max_depth == state.layers:
+            break
+    return 1 + max_depth
 
 def get_max_reward(state: State) -> float:
     """Gets the maximum reward that can be achieved from the given state
 
+    Next states whose reward plus the most the layers below them could add can't beat the best line found so far are
+    not searched (or generated) any further. The result is the same as searching the whole tree
+
     Args:
         state: The state to get the maximum reward from
 
     Returns:
         The maximum reward that can be achieved from the given state
     """
-    if len(state.next_states) == 0:
-        return state.reward
-    return state.reward + LAYER_REWARD_DECAY * max(get_max_reward(next_state) for next_state in state.next_states)
+    best = None
+    bound = None
+    for next_state in state.iter_next_states():
+        if best is not None:
+            if bound is None:
+                decay = sum(LAYER_REWARD_DECAY ** layer for layer in range(1, next_state.layers + 1))
+                bound = max_move_reward(state.state) * decay
+            if next_state.reward + bound <= best:
+                # Next states are in decreasing order of reward when ordered, so none of the rest can beat it either
+                if ORDER_CHILDREN:
+                    break
+                continue
+        reward = get_max_reward(next_state)
+        if best is None or reward > best:
+            best = reward
+    value = state.reward if best is None else state.reward + LAYER_REWARD_DECAY * best
+    state.arena.value[state.index] = value
+    return value
         
 def get_next_moves(state_tree: State) -> Dict[Direction, Tuple[int, float]]:
     """Gets the next moves that can be made from the given state and their rewards
@@ -179,21 +384,152 @@ def get_next_moves(state_tree: State) -> Dict[Direction, Tuple[int, float]]:
 # Valid moves are "up", "down", "left", or "right"
 # See https://docs.battlesnake.com/api/example-move for available data
 def move(game_state: Dict[str, Any]) -> Dict[str, Any]:
+    game_id = game_key(game_state)
+    # Stop pondering the game and pause the other games' pondering, so the search has the CPU to itself
+    with ponderer.live_move(game_id):
+        return choose_move(game_id, game_state)
+
+
+def choose_move(game_id: str, game_state: Dict[str, Any]) -> Dict[str, Any]:
+    """Chooses the move of a request from the opening book, the pondered positions or a search, and ponders the next
+    turn from it
+
+    Args:
+        game_id: The key of the game and snake (see game_key)
+        game_state: The game state of the request
+
+    Returns:
+        The move and its stats
+    """
     game_state = simplify_game_state(game_state)
+
+    book = load_book(OPENING_BOOK_PATH)
+    if book is not None:
+        book_move = book.lookup(game_state)
+        metrics.record_cache("opening_book", book_move is not None)
+        if book_move is not None:
+            if TRACE_DIR:
+                turn_history.setdefault(game_id, []).append(State(game_state, None, 0, Player.YOU))
+            print(f"MOVE {game_state['turn']}: {book_move[0]} | book {book_move[1]}/{book_move[2]:2f}")
+            return {"move": book_move[0], "stats": {"depth": book_move[1], "value": book_move[2], "source": "book"}}
+
     state_tree = State(game_state, None, 0, Player.YOU)
-    generate_state_tree(state_tree, NUM_LAYERS, is_root=True)
-    turn_history.append(state_tree)
+    pondered = ponderer.lookup(game_id, game_state) if ENABLE_PONDERING else None
+    if ENABLE_PONDERING:
+        metrics.record_cache("ponder", pondered is not None)
+    if pondered is not None:
+        # The move is already known, only the opponent's replies are needed to ponder the next turn
+        generate_state_tree(state_tree, 2, is_root=True)
+        if TRACE_DIR:
+            turn_history.setdefault(game_id, []).append(state_tree)
+        best_move = Direction(pondered[0])
+        print(f"MOVE {game_state['turn']}: {best_move.value} | pondered {pondered[1]}/{pondered[2]:2f}")
+        ponder(game_id, state_tree, best_move)
+        return {"move": best_move.value, "stats": {"depth": pondered[1], "value": pondered[2], "source": "ponder"}}
+
+    # Set by the server's deadline guard once the move has run out of time
+    cancel = deadline.cancel_event()
+    generate_state_tree(state_tree, NUM_LAYERS, is_root=True, cancel=cancel)
+    if TRACE_DIR:
+        turn_history.setdefault(game_id, []).append(state_tree)
 
     next_moves = get_next_moves(state_tree)
+    nodes = nodes_expanded(state_tree)
+    metrics.inc("battlesnake_nodes_expanded_total", nodes, "Search tree nodes expanded", engine="game_theory")
+    metrics.set_gauge("battlesnake_search_depth", max((depth for depth, _ in next_moves.values()), default=0), "Depth reached by the last search", engine="game_theory")
 
     if len(next_moves) == 0:
         print(f"MOVE {game_state['turn']}: No safe moves detected! Moving down")
-        return {"move": Direction.DOWN.value}
+        return {"move": Direction.DOWN.value, "stats": {"depth": 0, "value": None, "source": "none", "nodes": nodes}}
 
     best_move = max(next_moves, key=lambda k: next_moves.get(k, (0, 0)))
     print(f"MOVE {game_state['turn']}: {best_move.value} |{'|'.join(f' {move.value}: {next_moves[move][0]}/{next_moves[move][1]:2f}' for move in next_moves)}")   
+    # A cancelled search has already been answered with the fallback move, so its tree isn't worth pondering from
+    if cancel is None or not cancel.is_set():
+        ponder(game_id, state_tree, best_move)
     # print(f"Adjacent move rewards: {'|'.join(f' {move.value}: {coord_to_reward(state_tree, get_snake_move_coord(state_tree, move, Player.YOU), Player.YOU):2f} ' for move in next_moves)}")
-    return {"move": best_move.value}
+    depth, value = next_moves[best_move]
+    return {"move": best_move.value, "stats": {"depth": depth, "value": value, "source": "search", "nodes": nodes}}
+
+
+def evaluate(game_state: Dict[str, Any]) -> Dict[str, Any]:
+    """Searches a position for offline analysis (see batch.py). The search is the same as in move, but the opening book
+    and the ponderer aren't used and nothing is recorded for the game
+
+    Args:
+        game_state: The game state of a /move request
+
+    Returns:
+        The chosen move, the depth and value of every safe move (as from get_next_moves) and the nodes expanded and
+        time taken by the search
+    """
+    started = time.perf_counter()
+    state_tree = State(simplify_game_state(game_state), None, 0, Player.YOU)
+    generate_state_tree(state_tree, NUM_LAYERS, is_root=True)
+    next_moves = get_next_moves(state_tree)
+    best_move = max(next_moves, key=lambda k: next_moves[k]) if next_moves else Direction.DOWN
+    return {
+        "move": best_move.value,
+        "scores": {move.value: {"depth": depth, "value": value} for move, (depth, value) in next_moves.items()},
+        "stats": {"nodes": nodes_expanded(state_tree), "ms": (time.perf_counter() - started) * 1000},
+    }
+
+
+def ponder_search(game_state: Dict[str, Any], cancel: PonderSignal) -> Optional[Tuple[str, int, float]]:
+    """Searches a predicted position to PONDER_LAYERS layers for the ponderer
+
+    Args:
+        game_state: The simplified game state to search
+        cancel: Set when the game's next request arrives
+
+    Returns:
+        The best move, its depth and its value, or None if there are no safe moves or the search was cancelled
+    """
+    state_tree = State(game_state, None, 0, Player.YOU)
+    generate_state_tree(state_tree, PONDER_LAYERS, is_root=True, cancel=cancel)
+    next_moves = get_next_moves(state_tree)
+    if cancel.is_set() or not next_moves:
+        return None
+    best_move = max(next_moves, key=lambda k: next_moves.get(k, (0, 0)))
+    depth, value = next_moves[best_move]
+    return best_move.value, depth, value
+
+ponderer = Ponderer(ponder_search)
+"""Searches the next turn's positions in the background between requests"""
+
+def predict_next_states(state_tree: State, best_move: Direction) -> List[Dict[str, Any]]:
+    """Gets the positions the next request could have after making a move, one for every reply of the opponent
+
+    Food that spawns during the turn can't be predicted, so a position with new food won't match any prediction.
+
+    Args:
+        state_tree: A state tree at least 2 layers deep
+        best_move: The move that was made
+
+    Returns:
+        The simplified game states of the next turn, with the opponent's best replies first
+    """
+    made = next((state for state in state_tree.next_states if state.move_made == best_move), None)
+    if made is None:
+        return []
+    # Without an opponent the position after the move is the next turn
+    replies = made.next_states if "opponent" in state_tree.state else [made]
+    next_states = []
+    for reply in sorted(replies, key=lambda state: state.reward, reverse=True):
+        next_state = deepcopy(reply.state)
+        next_state["turn"] += 1
+        for player in Player:
+            if player.value in next_state:
+                snake = next_state[player.value]
+                ate = snake["length"] > state_tree.state[player.value]["length"]
+                snake["health"] = 100 if ate else snake["health"] - 1
+        next_states.append(next_state)
+    return next_states
+
+def ponder(game_id: str, state_tree: State, best_move: Direction):
+    """Starts pondering the positions that follow a move, if pondering is enabled"""
+    if ENABLE_PONDERING:
+        ponderer.start(game_id, predict_next_states(state_tree, best_move))
 
 
 def get_possible_moves(game_state: State, player: Player) -> Set[Direction]:
@@ -305,13 +641,14 @@ def get_manhattan_distance(x1: int, y1: int, x2: int, y2: int) -> int:
     """
     return abs(x2 - x1) + abs(y2 - y1)
     
-def coord_to_reward(game_state: State, coords: Dict[str, int], player_turn: Player) -> float:
+def coord_to_reward(game_state: State, coords: Dict[str, int], player_turn: Player, next_state: Optional[Dict[str, Any]] = None) -> float:
     """Gets the reward for a player if they move to the given coordinates
 
     Args:
         game_state: The state of the game
         coords: The coordinates to get the reward for
         player_turn: The player that is making the move
+        next_state: The state after the move. If given and USE_TERRITORY_EVALUATION is set, it is scored with territory_reward instead of aggression_reward, can_fit and the distance to every food
 
     Returns:
         _description_
@@ -319,11 +656,18 @@ def coord_to_reward(game_state: State, coords: Dict[str, int], player_turn: Play
     reward = 0
     player = player_turn.value
     opponent = Player.YOU.value if player_turn == Player.OPPONENT else Player.OPPONENT.value
+    use_territory = USE_TERRITORY_EVALUATION and next_state is not None
     
     # Reward from moving closer to food
     # Only add reward if the snake is smaller or equal to the opponent, or hungry
-    if game_state.state[player_turn.value]["health"] < HUNGER_THRESHOLD or \
-          ("opponent" in game_state.state and game_state.state[player]["length"] <= game_state.state[opponent]["length"]):
+    wants_food = game_state.state[player_turn.value]["health"] < HUNGER_THRESHOLD or \
+          ("opponent" in game_state.state and game_state.state[player]["length"] <= game_state.state[opponent]["length"])
+    if use_territory:
+        # The territory pass finds the distance to the nearest food, which stands in for the distance to every food
+        if wants_food and coords in game_state.state["board"]["food"]:
+            reward += BESIDE_FOOD_REWARD
+        reward += territory_reward(next_state, player_turn, wants_food)
+    elif wants_food:
         for food_coord in game_state.state["board"]["food"]:
             food_x = food_coord["x"]
             food_y = food_coord["y"]
@@ -337,7 +681,7 @@ def coord_to_reward(game_state: State, coords: Dict[str, int], player_turn: Play
                 reward += 1/dist
 
     # Reward from moving closer to opponent
-    if "opponent" in game_state.state:
+    if "opponent" in game_state.state and not use_territory:
         reward += AGGRESSION_MULTIPLIER * aggression_reward(game_state, player_turn)
 
     # Penalty if the snake is moving towards the opponent's head when the opponent is larger
@@ -353,7 +697,7 @@ def coord_to_reward(game_state: State, coords: Dict[str, int], player_turn: Play
 
     # Penalty if the snake is moving into a dangerous enclosed space
     snake_size = game_state.state[player_turn.value]["length"]
-    if not can_fit(game_state.state, snake_size, coords):
+    if not use_territory and not can_fit(game_state.state, snake_size, coords):
         reward += DANGEROUS_ENCLOSED_SPACE_REWARD
 
     # Penalty if the snake is moving towards the edge of the board
@@ -362,6 +706,30 @@ def coord_to_reward(game_state: State, coords: Dict[str, int], player_turn: Play
 
     return reward
 
+def territory_reward(game_state: Dict[str, Any], player: Player, wants_food: bool = False) -> float:
+    """Gets the reward for a player from the territory they control, using one simultaneous BFS from every head
+
+    Args:
+        game_state: The state of the game after the player's move
+        player: The player that made the move
+        wants_food: Whether the player is rewarded for getting closer to food
+
+    Returns:
+        The penalty for being stuck in a space smaller than the snake, plus the reward for controlling more of the board
+        than the opponent, plus the reward for being close to the nearest food the player reaches first if it wants food
+    """
+    length = game_state[player.value]["length"]
+    territory, players = evaluate_state(game_state, length)
+    me = players.index(player.value)
+    reward = 0.0
+    if territory.reachable[me] < length:
+        reward += DANGEROUS_ENCLOSED_SPACE_REWARD
+    if len(players) > 1:
+        reward += TERRITORY_REWARD_MULTIPLIER * (territory.territory[me] - territory.territory[1 - me])
+    if wants_food and territory.nearest_food[me] > 0:
+        reward += 1 / territory.nearest_food[me]
+    return reward
+
 def simplify_snake(snake: Dict[str, Any]) -> Dict[str, Any]:
     """Simplies the snake object to only contain the relevant information
 
@@ -376,7 +744,6 @@ def simplify_snake(snake: Dict[str, Any]) -> Dict[str, Any]:
         "body": snake["body"],
         "length": snake["length"],
         "latency": snake["latency"],
-        "health": snake["health"],
     }
     return simplified_snake
 
@@ -445,13 +812,13 @@ def visualize_game_state(game_state: State, max_depth: int = NUM_LAYERS):
         if "opponent" in state.state:
             snake_positions += f"\n{state.state['opponent']['body'][0]}"
 
-        dot.node(str(id(state)), f"Snake heads: {snake_positions}\nReward: {state.reward:3f}\nMove: {state.move_made}\nPlayer: {state.player_turn.value}")
+        dot.node(str(state.index), f"Snake heads: {snake_positions}\nReward: {state.reward:3f}\nMove: {state.move_made}\nPlayer: {state.player_turn.value}")
         next_depth = depth + 1
         if next_depth >= max_depth:
             continue
         for next_state in state.next_states:
             q.append((next_state, next_depth))
-            dot.edge(str(id(state)), str(id(next_state)))
+            dot.edge(str(state.index), str(next_state.index))
 
     dot.render('game_state.gv', view=True)
     
@@ -475,4 +842,4 @@ def aggression_reward(game_state: State, player: Player) -> float:
 if __name__ == "__main__":
     from server import run_server
 
-    run_server({"info": info, "start": start, "move": move, "end": end},  8080)
+    run_server({"info": info, "start": start, "move": move, "end": end, "spec": "game_theory"},  8080)
@@ -13,6 +13,34 @@
 import random
 import typing
 import copy
+import time
+
+import deadline
+import metrics
+
+# Random stream used by the planner when no per-game stream is passed in
+default_rng = random.Random()
+# Seeded random stream for every game being played, keyed by game id and snake id
+game_rngs: typing.Dict[str, random.Random] = {}
+# Whether start plans a few throwaway move sets, so the first move doesn't pay for first use of the planner
+WARM_UP_ON_START = True
+# The number of move sets planned by the warm-up
+WARM_UP_CANDIDATES = 64
+# The number of generations planned for every move
+GENERATIONS = 10
+
+
+# get_game_rng returns the random stream for the game, creating it on first use.
+# Streams are seeded from the seed (or the game id if there is none) and the snake's name,
+# so the same game replays the same planner decisions
+def get_game_rng(game_state: typing.Dict, seed: typing.Optional[int] = None) -> random.Random:
+    key = f"{game_state['game']['id']}:{game_state['you']['id']}"
+    rng = game_rngs.get(key)
+    if rng is None:
+        base = game_state["game"]["id"] if seed is None else seed
+        rng = random.Random(f"{base}:{game_state['you']['name']}")
+        game_rngs[key] = rng
+    return rng
 
 
 # info is called when you create your Battlesnake on play.battlesnake.com
@@ -33,11 +61,26 @@ def info() -> typing.Dict:
 # start is called when your Battlesnake begins a game
 def start(game_state: typing.Dict):
     print("GAME START")
+    get_game_rng(game_state)
+    if WARM_UP_ON_START:
+        warm_up(game_state)
+
+
+# warm_up plans and mutates move sets for the start position the way move does.
+# It uses its own random stream, so the game's stream and the moves it leads to are unchanged
+def warm_up(game_state: typing.Dict):
+    rng = random.Random(0)
+    num_steps = len(game_state["you"]["body"])
+    for _ in range(WARM_UP_CANDIDATES):
+        move_set = generate_moves(game_state, num_steps, rng)
+        assess_cost(game_state, move_set)
+        assess_cost(game_state, mutate(move_set, 0.3, rng))
 
 
 # end is called when your Battlesnake finishes a game
 def end(game_state: typing.Dict):
     print("GAME OVER\n")
+    game_rngs.pop(f"{game_state['game']['id']}:{game_state['you']['id']}", None)
 
 
 # move is called on every turn and returns your next move
@@ -45,44 +88,83 @@ def end(game_state: typing.Dict):
 # See https://docs.battlesnake.com/api/example-move for available data
 def move(game_state: typing.Dict) -> typing.Dict:
     
-    iter, mutation_prob = 10, 0.3
+    rng = get_game_rng(game_state)
+    iter, mutation_prob = GENERATIONS, 0.3
+    result = plan(game_state, rng, iter, mutation_prob)
+    generations, candidates, next_move, best_cost = result["generations"], result["candidates"], result["move"], result["cost"]
+
+    metrics.inc("battlesnake_ga_generations_total", generations, "GA generations run", engine="metaheuristics")
+    metrics.inc("battlesnake_ga_candidates_total", candidates, "GA candidate move sets assessed", engine="metaheuristics")
+
+    print(f"MOVE {game_state['turn']}: {next_move}")
+    return {"move": next_move, "stats": {"value": best_cost, "generations": generations, "candidates": candidates}}
+
+# evaluate plans a move for offline analysis (see batch.py) and returns it with the best cost found for each
+# first move and the work it took. It leaves the game's random stream alone: every position is
+# planned with its own stream, seeded from the game, turn and snake, so it always gets the same answer
+def evaluate(game_state: typing.Dict) -> typing.Dict:
+    started = time.perf_counter()
+    rng = random.Random(f"{game_state['game']['id']}:{game_state['turn']}:{game_state['you']['id']}")
+    result = plan(game_state, rng, GENERATIONS, 0.3)
+    return {
+        "move": result["move"],
+        "scores": {move: {"value": cost} for move, cost in result["scores"].items()},
+        "stats": {"generations": result["generations"], "candidates": result["candidates"],
+                  "ms": (time.perf_counter() - started) * 1000},
+    }
+
+# plan runs the genetic search for a move set. It returns the move to make, the cost of the best move set,
+# the best cost found for each first move and how many generations and candidates it took
+def plan(game_state: typing.Dict, rng: random.Random, iter: int, mutation_prob: float) -> typing.Dict:
     max_while = 25
     best_move_set, best_cost = None, -1
-    safe_moves = [generate_moves(game_state,1),
-                  generate_moves(game_state,1),
-                  generate_moves(game_state,1),
-                  generate_moves(game_state,1),
-                  generate_moves(game_state,1),
-                  generate_moves(game_state,1),
-                  generate_moves(game_state,1),
-                  generate_moves(game_state,1)]
-
-    while best_move_set is None and max_while > 0:
+    generations, candidates = 0, 0
+    scores: typing.Dict[str, float] = {}
+    safe_moves = [generate_moves(game_state,1,rng),
+                  generate_moves(game_state,1,rng),
+                  generate_moves(game_state,1,rng),
+                  generate_moves(game_state,1,rng),
+                  generate_moves(game_state,1,rng),
+                  generate_moves(game_state,1,rng),
+                  generate_moves(game_state,1,rng),
+                  generate_moves(game_state,1,rng)]
+
+    # every move set is assessed against the same game state, so they all share one trie of simulated prefixes
+    costs = CostTrie(game_state)
+    # stop early once the server's deadline guard has answered for us, checked every generation since the
+    # first pass of generations always finds a move set and ends the while
+    while best_move_set is None and max_while > 0 and not deadline.cancelled():
         for i in range(iter):
+            if deadline.cancelled():
+                break
             max = -1
             next_move = "down"
             num_steps = len(game_state["you"]["body"])
 
             if best_move_set is None:
-                moves = [generate_moves(game_state,num_steps),
-                         generate_moves(game_state,num_steps),
-                         generate_moves(game_state,num_steps),
-                         generate_moves(game_state,num_steps),  
-                         generate_moves(game_state,num_steps),
-                         generate_moves(game_state,num_steps)]
+                moves = [generate_moves(game_state,num_steps,rng),
+                         generate_moves(game_state,num_steps,rng),
+                         generate_moves(game_state,num_steps,rng),
+                         generate_moves(game_state,num_steps,rng),  
+                         generate_moves(game_state,num_steps,rng),
+                         generate_moves(game_state,num_steps,rng)]
             else:
                 moves = [best_move_set,
-                         generate_moves(game_state,num_steps),
-                         generate_moves(game_state,num_steps),
-                         generate_moves(game_state,num_steps),
-                         mutate(best_move_set, mutation_prob),
-                         mutate(best_move_set, mutation_prob),
-                         mutate(best_move_set, mutation_prob)]
+                         generate_moves(game_state,num_steps,rng),
+                         generate_moves(game_state,num_steps,rng),
+                         generate_moves(game_state,num_steps,rng),
+                         mutate(best_move_set, mutation_prob, rng),
+                         mutate(best_move_set, mutation_prob, rng),
+                         mutate(best_move_set, mutation_prob, rng)]
         
+            generations += 1
             for move in moves:
                 if len(move) == 0:
                     continue
-                move_val = assess_cost(game_state, move)
+                candidates += 1
+                move_val = costs.assess(move)
+                if move[0] not in scores or move_val > scores[move[0]]:
+                    scores[move[0]] = move_val
                 if move_val > max:
                     max = move_val
                     best_move_set = copy.copy(move)
@@ -93,17 +175,16 @@ def move(game_state: typing.Dict) -> typing.Dict:
     if best_move_set is not None:
         next_move = best_move_set[0]
     else:
-        next_move = random.choice(safe_moves)
+        next_move = rng.choice(safe_moves)
         next_move = next_move[0]  
 
-    print(f"MOVE {game_state['turn']}: {next_move}")
-    return {"move": next_move}
+    return {"move": next_move, "cost": best_cost, "scores": scores, "generations": generations, "candidates": candidates}
 
-def mutate(best_moves: typing.List, mutation_prob: float) -> typing.List:
+def mutate(best_moves: typing.List, mutation_prob: float, rng: random.Random = default_rng) -> typing.List:
     if len(best_moves) <= 2:
         return best_moves
     random_moveset = ["up", "down", "left", "right"]
-    mutation_point = random.choice([*range(len(best_moves) - 1)])
+    mutation_point = rng.choice([*range(len(best_moves) - 1)])
     mutation_point = 1 if mutation_point == 0 else (len(best_moves) - 2 if mutation_point == len(best_moves) - 1 else 1)
 
     if best_moves[mutation_point + 1] == "left" or best_moves[mutation_point - 1] == "left":
@@ -115,12 +196,12 @@ def mutate(best_moves: typing.List, mutation_prob: float) -> typing.List:
     elif best_moves[mutation_point + 1] == "down" or best_moves[mutation_point - 1] == "down":
         random_moveset.remove("up")
     
-    if random.uniform(0,1) > mutation_point:
-        best_moves[mutation_point] = random.choice(random_moveset)
+    if rng.uniform(0,1) > mutation_point:
+        best_moves[mutation_point] = rng.choice(random_moveset)
     
     return best_moves
 
-def generate_moves(game_state: typing.Dict, k: int) -> typing.List:
+def generate_moves(game_state: typing.Dict, k: int, rng: random.Random = default_rng) -> typing.List:
     moves = ["up","down","right","left"]
     x_max = game_state["board"]["width"] - 1
     y_max = game_state["board"]["height"] - 1
@@ -142,7 +223,7 @@ def generate_moves(game_state: typing.Dict, k: int) -> typing.List:
             safe_moves.remove("up")
 
         if k_i == 0:
-            moves_out.append(random.choice(safe_moves))
+            moves_out.append(rng.choice(safe_moves))
         else:
             if "left" in safe_moves and (moves_out[-1] == "right" or is_in_body(body, [pos_x - 1, pos_y])):
                 safe_moves.remove("left")
@@ -155,7 +236,7 @@ def generate_moves(game_state: typing.Dict, k: int) -> typing.List:
             
             if len(safe_moves) == 0:
                 return moves_out
-            moves_out.append(random.choice(safe_moves))
+            moves_out.append(rng.choice(safe_moves))
         
         if moves_out[-1] == "up":
             pos_y += 1
@@ -203,17 +284,36 @@ def enemy_proximity(game_state: typing.Dict, cell: typing.List) -> int:
                         ret = 3 # Indicate that you want to eat them as a nice little treat
     return ret
 
-def assess_cost(game_state: typing.Dict, proposed_moves: typing.List):
-    if len(proposed_moves) == 0:
-        return -1
-    est_cost = 0
-    grow = False
-    x_max = game_state["board"]["width"] - 1
-    y_max = game_state["board"]["height"] - 1
-    body = copy.copy(game_state["you"]["body"])
-    pos_x = copy.copy(body[0]["x"])
-    pos_y = copy.copy(body[0]["y"])
-    for move in proposed_moves:
+# CostTrie assesses move sets for one game state. Every prefix of a move set it has seen is kept in a trie with
+# the snake's body, whether it has grown and the cost so far after that prefix, or None if the snake died on it.
+# Mutants, fresh move sets and the best move set of a generation share long prefixes, so assessing a move set
+# only simulates the moves after the longest prefix seen before
+class CostTrie:
+    def __init__(self, game_state: typing.Dict):
+        self.game_state = game_state
+        self.x_max = game_state["board"]["width"] - 1
+        self.y_max = game_state["board"]["height"] - 1
+        body = game_state["you"]["body"]
+        # A node is [pos_x, pos_y, body, grow, est_cost, children], children keyed by the next move
+        self.root = [body[0]["x"], body[0]["y"], body, False, 0, {}]
+
+    def assess(self, proposed_moves: typing.List):
+        if len(proposed_moves) == 0:
+            return -1
+        node = self.root
+        for move in proposed_moves:
+            children = node[5]
+            if move in children:
+                node = children[move]
+            else:
+                node = children[move] = self.step(node, move)
+            if node is None:
+                return -1
+        return node[4]
+
+    # step simulates one move from a prefix, the same way as a step of assess_cost
+    def step(self, node: typing.List, move: str) -> typing.Optional[typing.List]:
+        pos_x, pos_y, body, grow, est_cost, _ = node
         if move == "up":
             pos_y += 1
         elif move == "down":
@@ -223,30 +323,36 @@ def assess_cost(game_state: typing.Dict, proposed_moves: typing.List):
         elif move == "left":
             pos_x -= 1
 
-        adj_risk = enemy_proximity(game_state, [pos_x, pos_y])
+        adj_risk = enemy_proximity(self.game_state, [pos_x, pos_y])
 
-        if pos_y > y_max or pos_y < 0 or pos_x > x_max or pos_x < 0 or is_in_body(body, [pos_x, pos_y]) or adj_risk == 2:
-            return -1
+        if pos_y > self.y_max or pos_y < 0 or pos_x > self.x_max or pos_x < 0 or is_in_body(body, [pos_x, pos_y]) or adj_risk == 2:
+            return None
 
         if adj_risk == 1:
             est_cost -= 8
         elif adj_risk == 3:
             est_cost += 15
 
-        body.insert(0,{"x": pos_x, "y": pos_y})
-        for food_pos in game_state["board"]["food"]:
+        # The body after the move is a new list, since the prefix's body is shared by every move set that continues it
+        body = [{"x": pos_x, "y": pos_y}] + body
+        for food_pos in self.game_state["board"]["food"]:
             if food_pos["x"] == pos_x and food_pos["y"] == pos_y:
                 est_cost += 5
                 grow = True
         if grow is False:
             body.pop()
-        
+
         est_cost += 1
-        
-    return est_cost
+
+        return [pos_x, pos_y, body, grow, est_cost, {}]
+
+# assess_cost simulates a move set from the current position and scores it, or returns -1 if the snake dies on it.
+# plan shares one CostTrie between all the move sets it assesses instead
+def assess_cost(game_state: typing.Dict, proposed_moves: typing.List):
+    return CostTrie(game_state).assess(proposed_moves)
 
 # Start server when `python main.py` is run
 if __name__ == "__main__":
     from server import run_server
 
-    run_server({"info": info, "start": start, "move": move, "end": end}, 8081)
\ No newline at end of file
+    run_server({"info": info, "start": start, "move": move, "end": end, "spec": "metaheuristics"}, 8081)
\ No newline at end of file
@@ -0,0 +1,211 @@
+from typing import Dict, List, Tuple
+from collections import deque
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+"""Upper bounds (in seconds) of the latency histogram buckets"""
+TIMEOUT_RATIO_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+"""Upper bounds of the buckets for the fraction of the game timeout used by a request"""
+QUANTILES = (0.5, 0.95, 0.99)
+"""Quantiles reported for every histogram"""
+QUANTILE_WINDOW = 1024
+"""Number of most recent observations the quantiles are computed over"""
+
+enabled = True
+"""Whether engines should record their internal counters. Checked before every update so disabled metrics cost one attribute lookup"""
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value: str, quotes: bool = True) -> str:
+    # Backslashes and newlines are escaped in help texts and label values, and quotes in label values only
+    value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quotes else value
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """A monotonically increasing value"""
+    def __init__(self) -> None:
+        self.value = 0.0
+        """The current count"""
+        self.lock = threading.Lock()
+        """Held while incrementing, since += is a read and a write that two threads can interleave"""
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    """A value that can go up and down"""
+    def __init__(self) -> None:
+        self.value = 0.0
+        """The current value"""
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram:
+    """A bucketed distribution of observations that also keeps a window of recent samples for quantiles"""
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        """The upper bounds of the buckets"""
+        self.counts = [0] * (len(buckets) + 1)
+        """The number of observations in each bucket. The last bucket is +Inf"""
+        self.sum = 0.0
+        """The sum of every observation"""
+        self.count = 0
+        """The number of observations"""
+        self.window: "deque[float]" = deque(maxlen=QUANTILE_WINDOW)
+        """The most recent observations"""
+        self.lock = threading.Lock()
+        """Held while observing, so the window isn't changed while a scrape copies it"""
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+            self.window.append(value)
+
+    def quantiles(self) -> Dict[float, float]:
+        """Gets the quantiles of the recent observations
+
+        Returns:
+            The value at each of QUANTILES, or an empty dictionary if nothing has been observed
+        """
+        with self.lock:
+            samples = list(self.window)
+        samples.sort()
+        if not samples:
+            return {}
+        return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in QUANTILES}
+
+
+class Registry:
+    """Holds every metric and renders them in the Prometheus text exposition format"""
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Tuple[str, str, Dict[Labels, object]]] = {}
+        """Maps metric names to their type, help text and labelled instances"""
+        self.lock = threading.Lock()
+        """Held while creating a metric, so two threads asking for the same new series get the same instance"""
+
+    def _get(self, kind: str, name: str, help_text: str, labels: Dict[str, str], factory):
+        key: Labels = tuple(sorted(labels.items()))
+        entry = self.metrics.get(name)
+        metric = entry[2].get(key) if entry is not None else None
+        if metric is None:
+            with self.lock:
+                if name not in self.metrics:
+                    self.metrics[name] = (kind, help_text, {})
+                instances = self.metrics[name][2]
+                metric = instances.get(key)
+                if metric is None:
+                    metric = instances[key] = factory()
+        return metric
+
+    def counter(self, name: str, help_text: str = "", **labels: str) -> Counter:
+        return self._get("counter", name, help_text, labels, Counter)
+
+    def gauge(self, name: str, help_text: str = "", **labels: str) -> Gauge:
+        return self._get("gauge", name, help_text, labels, Gauge)
+
+    def histogram(self, name: str, help_text: str = "", buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels: str) -> Histogram:
+        return self._get("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format (version 0.0.4)
+
+        Histograms are followed by a `<name>_quantile` gauge with the p50/p95/p99 of their recent observations
+        """
+        lines: List[str] = []
+        for name, (kind, help_text, instances) in sorted(list(self.metrics.items())):
+            instances = dict(instances)
+            lines.append(f"# HELP {name} {_escape(help_text, quotes=False)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in instances.items():
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), metric.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        bucket_labels = _format_labels(labels, 'le="' + le + '"')
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {metric.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {metric.count}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+            if kind == "histogram":
+                lines.append(f"# HELP {name}_quantile Recent quantiles of {name}")
+                lines.append(f"# TYPE {name}_quantile gauge")
+                for labels, metric in instances.items():
+                    for q, value in metric.quantiles().items():
+                        quantile_labels = _format_labels(labels, 'quantile="' + str(q) + '"')
+                        lines.append(f"{name}_quantile{quantile_labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+"""The registry shared by the server and the engines"""
+
+
+def inc(name: str, amount: float = 1, help_text: str = "", **labels: str):
+    """Increments an engine counter if metrics are enabled"""
+    if enabled:
+        REGISTRY.counter(name, help_text, **labels).inc(amount)
+
+
+def set_gauge(name: str, value: float, help_text: str = "", **labels: str):
+    """Sets an engine gauge if metrics are enabled"""
+    if enabled:
+        REGISTRY.gauge(name, help_text, **labels).set(value)
+
+
+def record_cache(cache: str, hit: bool):
+    """Counts a cache lookup. Hit rates are hits / (hits + misses)"""
+    if enabled:
+        REGISTRY.counter("battlesnake_cache_lookups_total", "Cache lookups by cache and result",
+                         cache=cache, result="hit" if hit else "miss").inc()
+
+
+class RouteTimer:
+    """The latency histograms of a single server route, registered up front so recording a request is just a few additions"""
+    def __init__(self, route: str, registry: Registry = REGISTRY) -> None:
+        phase_help = "Time spent parsing, handling and serializing each request"
+        self.parse = registry.histogram("battlesnake_request_phase_seconds", phase_help, route=route, phase="parse")
+        """Time spent decoding the request body"""
+        self.handler = registry.histogram("battlesnake_request_phase_seconds", phase_help, route=route, phase="handler")
+        """Time spent in the snake's handler"""
+        self.serialize = registry.histogram("battlesnake_request_phase_seconds", phase_help, route=route, phase="serialize")
+        """Time spent encoding the response"""
+        self.total = registry.histogram("battlesnake_request_seconds", "Total time spent on each request", route=route)
+        """Time spent on the whole request"""
+        self.timeout_ratio = registry.histogram("battlesnake_request_timeout_ratio", "Fraction of the game timeout used by each request",
+                                                buckets=TIMEOUT_RATIO_BUCKETS, route=route)
+        """Fraction of the game's timeout that the request used"""
+
+    def record(self, started: float, parsed: float, handled: float, finished: float, timeout_ms: float = 0):
+        """Records the phase timestamps (from time.perf_counter) of a request
+
+        Args:
+            started: When the request started
+            parsed: When the body finished decoding
+            handled: When the handler returned
+            finished: When the response finished encoding
+            timeout_ms: The game's timeout in milliseconds. Skipped if 0
+        """
+        self.parse.observe(parsed - started)
+        self.handler.observe(handled - parsed)
+        self.serialize.observe(finished - handled)
+        self.total.observe(finished - started)
+        if timeout_ms:
+            self.timeout_ratio.observe((finished - started) * 1000 / timeout_ms)
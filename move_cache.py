@@ -0,0 +1,116 @@
+from typing import Dict, Any, Callable, Tuple
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+import metrics
+
+DEFAULT_MAX_ENTRIES = 256
+"""The number of moves kept. The least recently used move is dropped first"""
+DEFAULT_TTL = 10.0
+"""Seconds a move is kept after it was computed. Retries come well within a game's timeout, so this only bounds memory"""
+
+MoveKey = Tuple[str, int, str, str]
+"""The game id, turn and snake id of a /move request, and the name of the snake configuration it was sent to"""
+
+
+def move_key(game_state: Dict[str, Any], snake: str = "") -> MoveKey:
+    """Gets the key a /move request is cached under
+
+    Args:
+        game_state: The game state of the request
+        snake: The name the snake is hosted under (see server.SnakeRegistry), or "" for the snake at the root
+    """
+    return game_state["game"]["id"], game_state["turn"], game_state["you"]["id"], snake
+
+
+class MoveCache:
+    """Remembers the response to every /move request for a short time, so that a retried or duplicated request gets
+    the same move without searching again
+
+    A request is identified by its game, turn and snake (see move_key). The first request for a key computes the move
+    and stores its future straight away, so a duplicate that arrives while the search is still running waits on that
+    search instead of starting a second one. A move that fails isn't cached, so a retry of it searches again.
+
+    Args:
+        max_entries: The number of moves kept
+        ttl: Seconds a move is kept after it was computed
+    """
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL) -> None:
+        self.max_entries = max_entries
+        """The number of moves kept"""
+        self.ttl = ttl
+        """Seconds a move is kept after it was computed"""
+        self.entries: "OrderedDict[MoveKey, Tuple[float, Future]]" = OrderedDict()
+        """When each move expires and its future, least recently used first. Moves still being computed never expire"""
+        self.lock = threading.Lock()
+        """Guards the entries, since requests are handled on several threads"""
+
+    def get_or_compute(self, key: MoveKey, compute: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """Gets the cached move for a key, waits for the move if it is being computed, or computes it
+
+        Args:
+            key: The key of the request
+            compute: Computes the move. Only called if the key has no move and none is being computed
+
+        Returns:
+            The move response
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1].done() and entry[0] < now:
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                future = entry[1]
+            else:
+                future = Future()
+                self.entries[key] = (float("inf"), future)
+                self._evict()
+
+        if entry is not None:
+            metrics.record_cache("move", True)
+            if not future.done():
+                metrics.inc("battlesnake_move_coalesced_total", 1, "Duplicate /move requests that waited on a search already running")
+            return future.result()
+
+        metrics.record_cache("move", False)
+        try:
+            move = compute()
+        except BaseException as e:
+            with self.lock:
+                if self.entries.get(key, (0, None))[1] is future:
+                    del self.entries[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            if self.entries.get(key, (0, None))[1] is future:
+                self.entries[key] = (time.monotonic() + self.ttl, future)
+        future.set_result(move)
+        return move
+
+    def _evict(self):
+        # Called with the lock held. Drops expired moves, then the least recently used ones beyond the limit.
+        # Moves being computed are skipped, since requests are waiting on them
+        now = time.monotonic()
+        for key, (expires, _) in list(self.entries.items()):
+            if expires < now:
+                del self.entries[key]
+        for key, (_, future) in list(self.entries.items()):
+            if len(self.entries) <= self.max_entries:
+                break
+            if future.done():
+                del self.entries[key]
+
+    def end_game(self, game_id: str):
+        """Drops the finished moves of a game"""
+        with self.lock:
+            for key, (_, future) in list(self.entries.items()):
+                if key[0] == game_id and future.done():
+                    del self.entries[key]
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,155 @@
+from typing import Dict, List, Optional, Any, Iterator
+from array import array
+import threading
+
+PLAYERS = ("you", "opponent")
+"""Player names, indexed by the player stored for a node"""
+NO_NODE = -1
+"""Marks a missing parent, child or sibling"""
+UNEXPANDED = -1
+"""The pending moves of a node whose possible moves haven't been worked out yet"""
+
+
+def apply_move(game_state: Dict[str, Any], player: str, head: Dict[str, int], ate: bool) -> Dict[str, Any]:
+    """Gets the state after a snake moves its head to a cell, the same as main_game_theory.move_snake but only copying
+    what changes: the moving snake, its body and the food if it ate
+
+    Args:
+        game_state: The simplified game state before the move
+        player: The key of the snake that moves ("you" or "opponent")
+        head: The new head of the snake
+        ate: Whether there is food at the new head
+
+    Returns:
+        The simplified game state after the move
+    """
+    snake = game_state[player]
+    new_game_state = dict(game_state)
+    if ate:
+        board = game_state["board"]
+        new_game_state["board"] = {**board, "food": [food for food in board["food"] if food != head]}
+        new_game_state[player] = {**snake, "body": [head] + snake["body"], "length": snake["length"] + 1}
+    else:
+        new_game_state[player] = {**snake, "body": [head] + snake["body"][:-1]}
+    return new_game_state
+
+
+class NodeArena:
+    """A search tree stored in flat typed arrays, indexed by node
+
+    Only the root keeps a full game state. Every other node stores the move that led to it as a delta against its
+    parent (the cell the snake moved its head to, and whether it ate there), and the state of a node is rebuilt by
+    replaying the deltas on the path from the root. Children are linked through first child and next sibling indices,
+    so nodes can be added to any parent in any order.
+    """
+    def __init__(self, root_state: Dict[str, Any], player: int, reward: float, move: int = NO_NODE) -> None:
+        self.root_state = root_state
+        """The full game state at the root"""
+        self.width = root_state["board"]["width"]
+        """The width of the board, used to turn cells into coordinates"""
+        self.layers = 0
+        """The depth the tree may be expanded to"""
+        self.cancel: Optional[threading.Event] = None
+        """Stops expanding the tree when set"""
+        self.root_moves_first = False
+        """Whether the player at the root moves first, rather than the other player"""
+        self.parent = array("i")
+        """The parent of each node"""
+        self.first_child = array("i")
+        """The first child of each node"""
+        self.last_child = array("i")
+        """The last child of each node, so that children are added in order"""
+        self.next_sibling = array("i")
+        """The next sibling of each node"""
+        self.move = array("b")
+        """The move that led to each node, as an index into main_game_theory.Direction"""
+        self.player = array("b")
+        """The player that made the move, as an index into PLAYERS"""
+        self.depth = array("b")
+        """The depth of each node below the root"""
+        self.head = array("h")
+        """The cell the player moved its head to (x + y * width)"""
+        self.ate = array("b")
+        """Whether the player ate food in the move"""
+        self.pending = array("b")
+        """A bit mask of the moves of each node whose children haven't been added yet, or UNEXPANDED"""
+        self.reward = array("d")
+        """The reward the player got for the move"""
+        self.value = array("d")
+        """The backed-up value of each node, once a search has worked it out"""
+        self._add(NO_NODE, move, player, 0, 0, False, reward)
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    def _add(self, parent: int, move: int, player: int, depth: int, head: int, ate: bool, reward: float) -> int:
+        index = len(self.parent)
+        self.parent.append(parent)
+        self.first_child.append(NO_NODE)
+        self.last_child.append(NO_NODE)
+        self.next_sibling.append(NO_NODE)
+        self.move.append(move)
+        self.player.append(player)
+        self.depth.append(depth)
+        self.head.append(head)
+        self.ate.append(ate)
+        self.pending.append(UNEXPANDED)
+        self.reward.append(reward)
+        self.value.append(reward)
+        return index
+
+    def add_child(self, parent: int, move: int, player: int, head: Dict[str, int], ate: bool, reward: float) -> int:
+        """Adds a node after the last child of a parent
+
+        Args:
+            parent: The parent node
+            move: The move that led to the node
+            player: The player that made the move
+            head: The cell the player moved its head to
+            ate: Whether the player ate food in the move
+            reward: The reward the player got for the move
+
+        Returns:
+            The index of the new node
+        """
+        index = self._add(parent, move, player, self.depth[parent] + 1, head["x"] + head["y"] * self.width, ate, reward)
+        if self.last_child[parent] == NO_NODE:
+            self.first_child[parent] = index
+        else:
+            self.next_sibling[self.last_child[parent]] = index
+        self.last_child[parent] = index
+        return index
+
+    def children(self, index: int) -> Iterator[int]:
+        """Iterates over the children of a node that have been added so far"""
+        child = self.first_child[index]
+        while child != NO_NODE:
+            yield child
+            child = self.next_sibling[child]
+
+    def state(self, index: int) -> Dict[str, Any]:
+        """Rebuilds the game state of a node by replaying the moves from the root
+
+        Args:
+            index: The node
+
+        Returns:
+            The simplified game state of the node. Parts that didn't change since the root are shared with it, so treat it as read only
+        """
+        path: List[int] = []
+        while index > 0:
+            path.append(index)
+            index = self.parent[index]
+        game_state = self.root_state
+        for node in reversed(path):
+            cell = self.head[node]
+            head = {"x": cell % self.width, "y": cell // self.width}
+            game_state = apply_move(game_state, PLAYERS[self.player[node]], head, bool(self.ate[node]))
+        return game_state
+
+    def nbytes(self) -> int:
+        """Gets the memory used by the node arrays"""
+        return sum(a.itemsize * len(a) for a in (
+            self.parent, self.first_child, self.last_child, self.next_sibling, self.move, self.player, self.depth,
+            self.head, self.ate, self.pending, self.reward, self.value,
+        ))
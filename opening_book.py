@@ -0,0 +1,307 @@
+"""An offline-generated opening book and position value store for the game theory snake
+
+Positions are keyed by a canonical hash that is the same for every rotation and reflection of the board, so one entry
+covers up to 8 equivalent positions. The book is a sorted array of fixed size records in a shared table file (see
+shared_tables.py), so looking a position up is a binary search over pages the OS shares between processes, and a
+rebuilt book replaces the old one in running servers without a restart.
+
+Usage:
+    python opening_book.py build --turns 2 --layers 6
+"""
+from typing import Dict, List, Optional, Any, Tuple, Iterator
+import argparse
+import hashlib
+import itertools
+import struct
+
+from shared_tables import SharedTable, attach, publish
+
+DEFAULT_BOOK_PATH = "opening_book.bin"
+"""Where the opening book is stored"""
+BOOK_MAGIC = b"SNKBOOK2"
+"""Identifies an opening book file and the version of its layout"""
+HEADER = struct.Struct("<II")
+"""Book header, after the table header: number of records, last turn the book covers"""
+RECORD = struct.Struct("<QBBxxf")
+"""A record: position key, best move in the canonical frame, search depth of the move, value of the move"""
+DIRECTIONS = ("up", "down", "left", "right")
+"""Move names, indexed by the move stored in a record"""
+DIRECTION_VECTORS = {"up": (0, 1), "down": (0, -1), "left": (-1, 0), "right": (1, 0)}
+"""The change in head position for each move"""
+HUNGER_THRESHOLD = 20
+"""Mirrors main_game_theory.HUNGER_THRESHOLD. Health only affects the search through this threshold, so only which side of it each snake is on goes into the key"""
+BOARD_SIZES = (7, 11, 19)
+"""Board sizes the book is built for"""
+
+
+def transform(symmetry: int, x: int, y: int, width: int, height: int) -> Tuple[int, int]:
+    """Applies one of the symmetries of the board to a coordinate
+
+    Symmetries 0-3 are the identity, the two reflections and the half turn, which exist on every board. Symmetries 4-7
+    transpose the board first and only exist on square boards
+
+    Args:
+        symmetry: The symmetry to apply
+        x: The x coordinate
+        y: The y coordinate
+        width: The width of the board
+        height: The height of the board
+
+    Returns:
+        The transformed coordinate
+    """
+    if symmetry >= 4:
+        x, y = y, x
+    if symmetry & 1:
+        x = width - 1 - x
+    if symmetry & 2:
+        y = height - 1 - y
+    return x, y
+
+
+def transform_direction(symmetry: int, direction: str) -> str:
+    """Gets the move that a move turns into under a symmetry of the board"""
+    dx, dy = DIRECTION_VECTORS[direction]
+    ox, oy = transform(symmetry, 0, 0, 1, 1)
+    tx, ty = transform(symmetry, dx, dy, 1, 1)
+    vector = (tx - ox, ty - oy)
+    return next(name for name, v in DIRECTION_VECTORS.items() if v == vector)
+
+
+def inverse_direction(symmetry: int, direction: str) -> str:
+    """Gets the move that turns into the given move under a symmetry of the board"""
+    return next(name for name in DIRECTIONS if transform_direction(symmetry, name) == direction)
+
+
+def canonical_key(state: Dict[str, Any]) -> Tuple[int, int]:
+    """Gets the symmetry reduced hash of a position of the game theory snake
+
+    Args:
+        state: The simplified game state (see main_game_theory.simplify_game_state)
+
+    Returns:
+        The 64 bit key of the position and the symmetry that maps the position onto its canonical form
+    """
+    width = state["board"]["width"]
+    height = state["board"]["height"]
+    snakes = [state["you"]] + ([state["opponent"]] if "opponent" in state else [])
+    hungry = tuple(snake["health"] < HUNGER_THRESHOLD for snake in snakes)
+
+    best = None
+    best_symmetry = 0
+    for symmetry in range(8 if width == height else 4):
+        form = (
+            width, height, hungry,
+            tuple(tuple(transform(symmetry, c["x"], c["y"], width, height) for c in snake["body"]) for snake in snakes),
+            tuple(sorted(transform(symmetry, c["x"], c["y"], width, height) for c in state["board"]["food"])),
+        )
+        if best is None or form < best:
+            best = form
+            best_symmetry = symmetry
+    digest = hashlib.blake2b(repr(best).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little"), best_symmetry
+
+
+class OpeningBook(SharedTable):
+    """A read only view of an opening book file"""
+    def __init__(self, path: str) -> None:
+        super().__init__(path, BOOK_MAGIC)
+        self.count, self.max_turn = HEADER.unpack_from(self.data, self.offset)
+        self.records = self.offset + HEADER.size
+        """Where the records start"""
+
+    def find(self, key: int) -> Optional[Tuple[int, int, float]]:
+        """Binary searches for a position
+
+        Args:
+            key: The canonical key of the position
+
+        Returns:
+            The canonical move index, depth and value of the best move, or None if the position isn't in the book
+        """
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            record_key, move, depth, value = RECORD.unpack_from(self.data, self.records + mid * RECORD.size)
+            if record_key < key:
+                low = mid + 1
+            elif record_key > key:
+                high = mid
+            else:
+                return move, depth, value
+        return None
+
+    def lookup(self, state: Dict[str, Any]) -> Optional[Tuple[str, int, float]]:
+        """Looks up the best move for a position
+
+        Args:
+            state: The simplified game state
+
+        Returns:
+            The best move, its search depth and its value, or None if the position isn't in the book
+        """
+        if state["turn"] > self.max_turn:
+            return None
+        key, symmetry = canonical_key(state)
+        found = self.find(key)
+        if found is None:
+            return None
+        move, depth, value = found
+        return inverse_direction(symmetry, DIRECTIONS[move]), depth, value
+
+
+def write_book(path: str, entries: Dict[int, Tuple[int, int, float]], max_turn: int) -> int:
+    """Writes an opening book atomically. Servers using a book at the path switch to the new one within a second
+
+    Args:
+        path: Where to write the book
+        entries: The canonical move index, depth and value of the best move of every position, keyed by position key
+        max_turn: The last turn the book covers
+
+    Returns:
+        The version of the book
+    """
+    records = (RECORD.pack(key, *entries[key]) for key in sorted(entries))
+    return publish(path, BOOK_MAGIC, itertools.chain([HEADER.pack(len(entries), max_turn)], records))
+
+
+def load_book(path: str = DEFAULT_BOOK_PATH) -> Optional[OpeningBook]:
+    """Gets the latest opening book at a path, mapping it on first use and again whenever a new book is written there
+
+    Returns:
+        The book, or None if there is no book at the path
+    """
+    return attach(path, OpeningBook)
+
+
+def start_positions(size: int) -> Iterator[Dict[str, Any]]:
+    """Generates every standard two snake start position for a board size, following the fixed placement of the
+    Battlesnake standard rules: snakes start on the corner or the edge midpoints, one step in from the wall, with a food
+    diagonal to each head away from the center and one food in the center
+
+    Args:
+        size: The width and height of the board
+
+    Yields:
+        Simplified game states at turn 0
+    """
+    mn, md, mx = 1, (size - 1) // 2, size - 2
+    center = (md, md)
+    groups = [[(mn, mn), (mn, mx), (mx, mn), (mx, mx)], [(mn, md), (md, mn), (md, mx), (mx, md)]]
+
+    def food_options(head: Tuple[int, int]) -> List[Tuple[int, int]]:
+        options = []
+        for dx, dy in ((-1, -1), (-1, 1), (1, -1), (1, 1)):
+            p = (head[0] + dx, head[1] + dy)
+            away = (p[0] < head[0] < center[0] or center[0] < head[0] < p[0]
+                    or p[1] < head[1] < center[1] or center[1] < head[1] < p[1])
+            corner = p[0] in (0, size - 1) and p[1] in (0, size - 1)
+            if p != center and away and not corner:
+                options.append(p)
+        return options
+
+    for group in groups:
+        for you in group:
+            for opponent in group:
+                if you == opponent:
+                    continue
+                for you_food in food_options(you):
+                    for opponent_food in food_options(opponent):
+                        food = {you_food, opponent_food, center}
+                        yield {
+                            "turn": 0,
+                            "board": {"height": size, "width": size,
+                                      "food": [{"x": x, "y": y} for x, y in sorted(food)]},
+                            "you": {"health": 100, "length": 3, "latency": "0", "body": [{"x": you[0], "y": you[1]}] * 3},
+                            "opponent": {"health": 100, "length": 3, "latency": "0", "body": [{"x": opponent[0], "y": opponent[1]}] * 3},
+                        }
+
+
+def next_positions(state: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Generates the positions reachable in one turn, where both snakes move at once and neither dies. Food that spawns
+    during the turn is not modelled, since those positions can't be predicted
+
+    Args:
+        state: The simplified game state
+
+    Yields:
+        The simplified game state after every pair of safe moves
+    """
+    import main_game_theory as gt
+
+    root = gt.State(state, None, 0, gt.Player.YOU)
+    for you_move in gt.get_possible_moves(root, gt.Player.YOU):
+        for opponent_move in gt.get_possible_moves(root, gt.Player.OPPONENT):
+            heads = []
+            next_state = {"turn": state["turn"] + 1, "board": {**state["board"], "food": list(state["board"]["food"])}}
+            for player, direction in ((gt.Player.YOU, you_move), (gt.Player.OPPONENT, opponent_move)):
+                snake = state[player.value]
+                head = gt.get_snake_move_coord(state, direction, player)
+                ate = head in next_state["board"]["food"]
+                next_state[player.value] = {
+                    **snake,
+                    "health": 100 if ate else snake["health"] - 1,
+                    "length": snake["length"] + (1 if ate else 0),
+                    "body": [head] + (snake["body"] if ate else snake["body"][:-1]),
+                }
+                heads.append(head)
+            for head in heads:
+                if head in next_state["board"]["food"]:
+                    next_state["board"]["food"].remove(head)
+            you_body = next_state["you"]["body"]
+            opponent_body = next_state["opponent"]["body"]
+            if heads[0] == heads[1] or heads[0] in opponent_body[1:] or heads[1] in you_body[1:]:
+                continue
+            yield next_state
+
+
+def build_book(path: str, sizes: Tuple[int, ...], turns: int, layers: int):
+    """Searches every position reachable in the first turns of a standard game and writes the best moves to a book
+
+    Args:
+        path: Where to write the book
+        sizes: The board sizes to cover
+        turns: The number of turns after the start to cover
+        layers: The number of layers to search each position to
+    """
+    import main_game_theory as gt
+
+    entries: Dict[int, Tuple[int, int, float]] = {}
+    for size in sizes:
+        frontier = list(start_positions(size))
+        for turn in range(turns + 1):
+            next_frontier = []
+            for state in frontier:
+                key, symmetry = canonical_key(state)
+                if key in entries:
+                    continue
+                tree = gt.State(state, None, 0, gt.Player.YOU)
+                gt.generate_state_tree(tree, layers, is_root=True)
+                next_moves = gt.get_next_moves(tree)
+                if next_moves:
+                    best = max(next_moves, key=lambda k: next_moves.get(k, (0, 0)))
+                    depth, value = next_moves[best]
+                    entries[key] = (DIRECTIONS.index(transform_direction(symmetry, best.value)), depth, value)
+                if turn < turns:
+                    next_frontier.extend(next_positions(state))
+            frontier = next_frontier
+            print(f"{size}x{size} turn {turn}: {len(entries)} positions")
+    write_book(path, entries, turns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="search the opening positions and write the book")
+    build_parser.add_argument("--path", default=DEFAULT_BOOK_PATH)
+    build_parser.add_argument("--sizes", type=int, nargs="+", default=list(BOARD_SIZES))
+    build_parser.add_argument("--turns", type=int, default=2)
+    build_parser.add_argument("--layers", type=int, default=6)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_book(args.path, tuple(args.sizes), args.turns, args.layers)
+
+
+if __name__ == "__main__":
+    main()
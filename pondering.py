@@ -0,0 +1,160 @@
+from typing import Dict, List, Optional, Any, Tuple, Callable, Iterator
+import contextlib
+import threading
+
+import metrics
+from opening_book import DIRECTIONS, canonical_key, inverse_direction, transform_direction
+
+SearchFunction = Callable[[Dict[str, Any], "PonderSignal"], Optional[Tuple[str, int, float]]]
+"""Searches a position until done or until the signal is set. Returns the best move, its depth and its value, or None"""
+
+
+class PonderSignal:
+    """Stands in for the cancel event of a pondering run. The search checks is_set as it goes, and while any live move
+    is being searched the check waits for it to finish, so pondering only takes the CPU between moves
+
+    Args:
+        ponderer: The ponderer the run belongs to
+    """
+    def __init__(self, ponderer: "Ponderer") -> None:
+        self.ponderer = ponderer
+        """The ponderer the run belongs to"""
+        self.cancelled = threading.Event()
+        """Set once the run is cancelled"""
+
+    def set(self):
+        """Cancels the run, waking it if it is waiting for a live move"""
+        self.cancelled.set()
+        with self.ponderer.idle:
+            self.ponderer.idle.notify_all()
+
+    def is_set(self) -> bool:
+        """Whether the run was cancelled, after waiting for the live moves being searched, if there are any"""
+        if self.ponderer.live:
+            with self.ponderer.idle:
+                while self.ponderer.live and not self.cancelled.is_set():
+                    self.ponderer.idle.wait()
+        return self.cancelled.is_set()
+
+
+class Ponderer:
+    """Searches the positions the game could be in next turn while waiting for the next request
+
+    After a move is sent, the engine hands over the positions that follow each reply the opponent could make, most
+    likely first. A background thread for the game searches them one at a time and stores each finished result in a
+    cache for the game, keyed like the opening book so that a lookup is independent of rotations and reflections of the
+    board. Every game (or every snake, when one server plays several snakes in a game) ponders on its own, so a move of
+    one game never cancels the pondering of another. Live moves are searched under live_move: the game's own search is
+    cancelled and joined before the engine does anything else, and the other games' searches are paused until the move
+    is done, so pondering never competes with a live move for the CPU. A search that was cancelled halfway is thrown
+    away.
+    """
+    def __init__(self, search: SearchFunction) -> None:
+        self.search = search
+        """The search run on every position"""
+        self.results: Dict[str, Dict[int, Tuple[int, int, float]]] = {}
+        """The canonical move index, depth and value of every pondered position, keyed by game id then position key"""
+        self.runs: Dict[str, Tuple[threading.Thread, PonderSignal]] = {}
+        """The thread of the current pondering run of every game, and the signal that stops it"""
+        self.lock = threading.Lock()
+        """Guards the per-game caches and runs, since moves of different games (or of several snakes in one game) can
+        be handled at the same time"""
+        self.live = 0
+        """The number of live moves being searched. Pondering waits while there are any"""
+        self.idle = threading.Condition()
+        """Notified when the last live move is done, or a run is cancelled"""
+
+    @contextlib.contextmanager
+    def live_move(self, game_id: str) -> Iterator[None]:
+        """Stops pondering a game and pauses the pondering of every other game while one of its moves is searched
+
+        Args:
+            game_id: The game of the move
+        """
+        # Counted first, so the other games' searches pause while this game's search is stopped
+        with self.idle:
+            self.live += 1
+        try:
+            self.stop(game_id)
+            yield
+        finally:
+            with self.idle:
+                self.live -= 1
+                if not self.live:
+                    self.idle.notify_all()
+
+    def start(self, game_id: str, positions: List[Dict[str, Any]]):
+        """Starts pondering a game, replacing its cache with the results for these positions
+
+        Args:
+            game_id: The game the positions belong to
+            positions: The simplified game states to search, most likely first
+        """
+        self.stop(game_id)
+        results: Dict[int, Tuple[int, int, float]] = {}
+        # Every run gets its own signal, so a run that is still unwinding can never see a fresh, unset one
+        cancel = PonderSignal(self)
+        thread = threading.Thread(target=self._run, args=(positions, results, cancel), name=f"ponder-{game_id}", daemon=True)
+        with self.lock:
+            # A run started by another request of the game since the stop above is replaced too
+            previous = self.runs.get(game_id)
+            if previous is not None:
+                previous[1].set()
+            self.results[game_id] = results
+            self.runs[game_id] = (thread, cancel)
+            thread.start()
+
+    def _run(self, positions: List[Dict[str, Any]], results: Dict[int, Tuple[int, int, float]], cancel: PonderSignal):
+        for state in positions:
+            found = self.search(state, cancel)
+            if cancel.is_set():
+                metrics.inc("battlesnake_ponder_searches_total", 1, "Positions searched while waiting for the next request", result="aborted")
+                return
+            if found is None:
+                continue
+            move, depth, value = found
+            key, symmetry = canonical_key(state)
+            results[key] = (DIRECTIONS.index(transform_direction(symmetry, move)), depth, value)
+            metrics.inc("battlesnake_ponder_searches_total", 1, "Positions searched while waiting for the next request", result="completed")
+
+    def stop(self, game_id: str):
+        """Cancels the pondering run of a game and waits for it to finish. The results found so far are kept
+
+        Args:
+            game_id: The game to stop pondering
+        """
+        with self.lock:
+            run = self.runs.pop(game_id, None)
+        if run is None:
+            return
+        thread, cancel = run
+        cancel.set()
+        # Joined outside the lock, so other games can start and look up pondering in the meantime
+        thread.join()
+
+    def lookup(self, game_id: str, state: Dict[str, Any]) -> Optional[Tuple[str, int, float]]:
+        """Looks up a pondered position. Call stop first, since the cache is still being written while pondering
+
+        Args:
+            game_id: The game the position belongs to
+            state: The simplified game state
+
+        Returns:
+            The best move, its search depth and its value, or None if the position wasn't pondered
+        """
+        with self.lock:
+            results = self.results.get(game_id)
+        if not results:
+            return None
+        key, symmetry = canonical_key(state)
+        found = results.get(key)
+        if found is None:
+            return None
+        move, depth, value = found
+        return inverse_direction(symmetry, DIRECTIONS[move]), depth, value
+
+    def end_game(self, game_id: str):
+        """Stops pondering and drops the cache of a game that is over"""
+        self.stop(game_id)
+        with self.lock:
+            self.results.pop(game_id, None)
@@ -0,0 +1,285 @@
+"""A snake that picks the engine and search effort of every move from a learned model of how long each one takes
+
+The portfolio is a list of engine configurations, strongest first: the game theory search at several depths, then the
+metaheuristics. Every /move goes to the strongest configuration that is predicted to finish within the time left
+before the move's deadline (see deadline.remaining). Each configuration has its own cost model, which predicts the
+time of a move from the board size, the snake lengths and the number of snakes. The model is a least squares fit of
+the log of the time, weighted towards recent moves so that it follows the load on the machine, and its prediction is
+padded by the spread of the fit. Every move a configuration makes adds to its model.
+
+A configuration without enough moves to predict from is only tried once the configuration below it is predicted to
+take at most EXPLORE_FRACTION of the budget, so the portfolio works its way up from the cheapest search. The deadline
+guard answers for a configuration that still runs out of time, and the slow move is added to its model. One move in
+RETRY_EVERY tries the configuration above the one picked, so a model fitted under load catches up once the load has
+gone. The models are saved to COST_MODEL_PATH at the end of every game and loaded when the snake starts, since they
+only hold for the machine they were fitted on. Saved models that don't fit the current features are started again.
+
+Usage:
+    python portfolio.py
+    python server.py portfolio game_theory
+"""
+from typing import Dict, List, Optional, Any, Tuple
+from types import ModuleType
+import itertools
+import json
+import math
+import os
+import threading
+import time
+
+import deadline
+import engines
+import metrics
+
+PORTFOLIO = (
+    "game_theory:NUM_LAYERS=7,ENABLE_PONDERING=false",
+    "game_theory:NUM_LAYERS=6,ENABLE_PONDERING=false",
+    "game_theory:NUM_LAYERS=5,ENABLE_PONDERING=false",
+    "game_theory:NUM_LAYERS=4,ENABLE_PONDERING=false",
+    "game_theory:NUM_LAYERS=3,ENABLE_PONDERING=false",
+    "metaheuristics:GENERATIONS=10",
+)
+"""The engine specs the moves are shared between, strongest first. Pondering is off, since a game's moves can go to
+different configurations and a background search would skew the times of the others"""
+COST_MODEL_PATH = "cost_model.json"
+"""Where the cost models are saved between runs, or None to keep them in memory"""
+MIN_SAMPLES = 8
+"""The number of moves a configuration has to make before its model is used"""
+EXPLORE_FRACTION = 0.33
+"""The share of the budget the configuration below an untried one has to be predicted to fit in, for it to be tried.
+Every extra layer of the game theory search takes about three times as long"""
+SAFETY_Z = 1.65
+"""Standard deviations of the fit added to every prediction, so about 1 in 20 predictions is too low"""
+RETRY_EVERY = 10
+"""Every this many moves, the configuration above the one the models pick is tried if it is close to fitting. A
+configuration is only timed when it is picked, so without this a model fitted under load would never learn that the
+load has gone"""
+RETRY_MARGIN = 1.5
+"""How far over the budget a configuration can be predicted to take and still be retried"""
+DECAY = 0.97
+"""The weight kept by the moves already in a model when a new one is added"""
+RIDGE = 1.0
+"""Keeps the fit solvable while a model has few moves or features that don't vary"""
+NUM_FEATURES = 5
+"""The length of the feature vector (see features)"""
+
+
+def features(game_state: Dict[str, Any]) -> List[float]:
+    """Gets what the time of a move is predicted from: a constant, the logs of the number of cells, our length and the
+    total length of every snake, and the number of snakes"""
+    board = game_state["board"]
+    total_length = sum(len(snake["body"]) for snake in board["snakes"]) or len(game_state["you"]["body"])
+    return [1.0, math.log(board["width"] * board["height"]), math.log(len(game_state["you"]["body"])),
+            math.log(total_length), float(len(board["snakes"]))]
+
+
+def solve(matrix: List[List[float]], vector: List[float]) -> List[float]:
+    """Solves a small linear system by Gaussian elimination with partial pivoting"""
+    n = len(vector)
+    rows = [row[:] + [value] for row, value in zip(matrix, vector)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    solution = [0.0] * n
+    for r in reversed(range(n)):
+        solution[r] = (rows[r][n] - sum(rows[r][c] * solution[c] for c in range(r + 1, n))) / rows[r][r]
+    return solution
+
+
+class CostModel:
+    """Predicts the time of a move with one configuration, from an exponentially weighted least squares fit of the log of
+    the time against features. Only the sums of the fit are kept, so adding a move and predicting take constant time"""
+    def __init__(self) -> None:
+        self.xtx = [[0.0] * NUM_FEATURES for _ in range(NUM_FEATURES)]
+        """The weighted sum of the outer products of the features"""
+        self.xty = [0.0] * NUM_FEATURES
+        """The weighted sum of the features times the log time"""
+        self.yty = 0.0
+        """The weighted sum of the squared log times"""
+        self.weight = 0.0
+        """The total weight of the moves"""
+        self.samples = 0
+        """The number of moves added"""
+        self.fit: Optional[List[float]] = None
+        """The coefficients of the fit and the variance of its residuals, worked out on the first prediction after a move is added"""
+
+    def add(self, x: List[float], ms: float):
+        """Adds the time of a move"""
+        y = math.log(max(ms, 0.1))
+        for i in range(NUM_FEATURES):
+            row = self.xtx[i]
+            for j in range(NUM_FEATURES):
+                row[j] = row[j] * DECAY + x[i] * x[j]
+            self.xty[i] = self.xty[i] * DECAY + x[i] * y
+        self.yty = self.yty * DECAY + y * y
+        self.weight = self.weight * DECAY + 1
+        self.samples += 1
+        self.fit = None
+
+    def predict(self, x: List[float]) -> Optional[float]:
+        """Predicts the time of a move in milliseconds, padded by SAFETY_Z standard deviations, or None if the model
+        hasn't seen MIN_SAMPLES moves yet"""
+        if self.samples < MIN_SAMPLES:
+            return None
+        if self.fit is None:
+            regularised = [[value + (RIDGE if i == j else 0) for j, value in enumerate(row)] for i, row in enumerate(self.xtx)]
+            w = solve(regularised, self.xty)
+            # The residual sum of squares, expanded in terms of the sums that are kept
+            sse = self.yty - 2 * sum(wi * b for wi, b in zip(w, self.xty)) \
+                + sum(w[i] * self.xtx[i][j] * w[j] for i in range(NUM_FEATURES) for j in range(NUM_FEATURES))
+            self.fit = w + [max(sse, 0) / max(self.weight - NUM_FEATURES, 1)]
+        *w, variance = self.fit
+        return math.exp(sum(wi * xi for wi, xi in zip(w, x)) + SAFETY_Z * math.sqrt(variance))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"xtx": [row[:] for row in self.xtx], "xty": self.xty[:], "yty": self.yty, "weight": self.weight, "samples": self.samples}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CostModel":
+        """Reads a model written by to_dict
+
+        Raises:
+            ValueError: If the model has the wrong shape, e.g. it was saved with a different NUM_FEATURES
+        """
+        try:
+            xtx = [[float(value) for value in row] for row in data["xtx"]]
+            xty = [float(value) for value in data["xty"]]
+            yty, weight, samples = float(data["yty"]), float(data["weight"]), int(data["samples"])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"not a cost model: {e!r}") from e
+        if len(xty) != NUM_FEATURES or len(xtx) != NUM_FEATURES or any(len(row) != NUM_FEATURES for row in xtx):
+            raise ValueError(f"the cost model has {len(xty)} features instead of {NUM_FEATURES}")
+        model = cls()
+        model.xtx, model.xty, model.yty = xtx, xty, yty
+        model.weight, model.samples = weight, samples
+        return model
+
+
+_engines: Dict[str, ModuleType] = {}
+_models: Dict[str, CostModel] = {}
+_lock = threading.Lock()
+_save_lock = threading.Lock()
+_moves = itertools.count(1)
+
+
+def _load():
+    # Loads every configuration and the saved models on first use, so importing the portfolio stays cheap
+    with _lock:
+        if _engines:
+            return
+        saved: Dict[str, Any] = {}
+        if COST_MODEL_PATH is not None and os.path.exists(COST_MODEL_PATH):
+            try:
+                with open(COST_MODEL_PATH) as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                saved = {}
+        if not isinstance(saved, dict):
+            saved = {}
+        for spec in PORTFOLIO:
+            # A model saved by another version of the portfolio is fitted again from scratch
+            try:
+                _models[spec] = CostModel.from_dict(saved[spec]) if spec in saved else CostModel()
+            except ValueError:
+                _models[spec] = CostModel()
+            _engines[spec] = engines.load_engine(spec)
+
+
+def save_models():
+    """Writes the cost models to COST_MODEL_PATH atomically"""
+    if COST_MODEL_PATH is None:
+        return
+    with _lock:
+        data = {spec: model.to_dict() for spec, model in _models.items()}
+    # Games end on threads of their own, and in every worker process of the server
+    with _save_lock:
+        tmp_path = f"{COST_MODEL_PATH}.tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, COST_MODEL_PATH)
+
+
+def choose(game_state: Dict[str, Any], budget_ms: float, retry: bool = False) -> Tuple[str, Optional[float]]:
+    """Picks the strongest configuration that is predicted to finish within the budget
+
+    Args:
+        game_state: The game state of the move request
+        budget_ms: The time left for the move
+        retry: Whether to pick the configuration above that instead, if it is predicted to take at most RETRY_MARGIN
+            times the budget
+
+    Returns:
+        The spec of the configuration and its predicted time, or None if it hasn't made enough moves to predict
+    """
+    x = features(game_state)
+    with _lock:
+        predictions = [_models[spec].predict(x) for spec in PORTFOLIO]
+    chosen = len(PORTFOLIO) - 1
+    for i in reversed(range(len(PORTFOLIO) - 1)):
+        predicted, below = predictions[i], predictions[i + 1]
+        if predicted is not None and predicted <= budget_ms:
+            chosen = i
+        elif predicted is None and below is not None and below <= budget_ms * EXPLORE_FRACTION:
+            chosen = i
+    above = predictions[chosen - 1] if chosen > 0 else None
+    if retry and above is not None and above <= budget_ms * RETRY_MARGIN:
+        chosen -= 1
+    return PORTFOLIO[chosen], predictions[chosen]
+
+
+def info() -> Dict[str, Any]:
+    print("INFO")
+
+    return {
+        "apiversion": "1",
+        "author": "",
+        "color": "#d4a017",
+        "head": "default",
+        "tail": "default",
+    }
+
+
+def start(game_state: Dict[str, Any]):
+    _load()
+    for engine in _engines.values():
+        engine.start(game_state)
+
+
+def move(game_state: Dict[str, Any]) -> Dict[str, Any]:
+    _load()
+    left = deadline.remaining()
+    if left is None:
+        left = ((game_state["game"].get("timeout") or deadline.DEFAULT_TIMEOUT_MS) - deadline.DEFAULT_MARGIN_MS) / 1000
+    budget_ms = left * 1000
+    spec, predicted = choose(game_state, budget_ms, next(_moves) % RETRY_EVERY == 0)
+    engine = _engines[spec]
+
+    started = time.perf_counter()
+    response = engine.move(game_state)
+    ms = (time.perf_counter() - started) * 1000
+    stats = response.get("stats", {})
+    # Moves answered from the opening book didn't search, so they say nothing about the time of a search
+    if stats.get("source", "search") == "search":
+        with _lock:
+            _models[spec].add(features(game_state), ms)
+
+    metrics.inc("battlesnake_portfolio_moves_total", 1, "Moves made by each configuration of the portfolio", config=spec)
+    return {**response, "stats": {**stats, "config": spec, "predicted_ms": predicted, "budget_ms": budget_ms, "ms": ms}}
+
+
+def end(game_state: Dict[str, Any]):
+    _load()
+    for engine in _engines.values():
+        engine.end(game_state)
+    save_models()
+
+
+# Start server when `python portfolio.py` is run
+if __name__ == "__main__":
+    from server import run_server
+
+    run_server({"info": info, "start": start, "move": move, "end": end}, 8082)
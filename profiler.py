@@ -0,0 +1,204 @@
+from typing import Dict, Any, Optional
+from collections import Counter
+import math
+import os
+import re
+import sys
+import threading
+import time
+
+DEFAULT_INTERVAL_MS = 1.0
+"""How often the sampler looks at the stacks of the requests being profiled"""
+DEFAULT_OUTPUT_DIR = "profiles"
+"""Where per-request and per-game profiles are written"""
+SETTINGS = ("every_n", "slower_than_ms", "interval_ms")
+"""The settings that can be changed while the server is running. The output directory can't, since requests could
+then write files anywhere"""
+
+
+def safe_file_name(value: str) -> str:
+    """Turns a value from a request, such as a game id, into a name that can only refer to a file in the directory it is
+    joined to: every run of characters other than letters, digits, _, . and - is replaced by -, and leading dots are
+    dropped so that it can't be . or .."""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "-", value).lstrip(".") or "-"
+
+
+def collapse_stack(frame) -> str:
+    """Turns a frame into a single line of the collapsed stack format used by flamegraph.pl and speedscope
+
+    Args:
+        frame: The innermost frame of the stack
+
+    Returns:
+        The frames from outermost to innermost, separated by semicolons
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class ProfileSession:
+    """The samples taken while a single request was being handled"""
+    def __init__(self, game_id: str, turn: int, selected: bool) -> None:
+        self.game_id = game_id
+        """The game the request belongs to"""
+        self.turn = turn
+        """The turn of the request"""
+        self.selected = selected
+        """Whether the request was picked by the every Nth rule, in which case it is kept however fast it was"""
+        self.started = time.perf_counter()
+        """When the request started being profiled"""
+        self.stacks: Counter = Counter()
+        """The number of samples seen for each collapsed stack"""
+
+
+class Profiler:
+    """A low overhead sampling profiler for the move handler
+
+    A single background thread samples the stacks of the request threads that are currently being profiled, so a
+    request that is not selected only pays for a counter increment. Requests are selected if they are every Nth
+    request, or if sampling for slow requests is on, in which case every request is sampled and only kept if it took
+    longer than the threshold. The configuration can be changed at any time while the server is running.
+    """
+    def __init__(self, every_n: int = 0, slower_than_ms: float = 0, interval_ms: float = DEFAULT_INTERVAL_MS,
+                 output_dir: str = DEFAULT_OUTPUT_DIR) -> None:
+        self.every_n = every_n
+        """Profile every Nth move request. 0 disables it"""
+        self.slower_than_ms = slower_than_ms
+        """Keep the profile of any move request slower than this. 0 disables it"""
+        self.interval_ms = interval_ms
+        """The sampling interval"""
+        self.output_dir = output_dir
+        """Where profiles are written"""
+        self.requests = 0
+        """The number of move requests seen"""
+        self.active: Dict[int, ProfileSession] = {}
+        """The sessions being sampled, keyed by the thread handling the request"""
+        self.games: Dict[str, Counter] = {}
+        """The aggregated samples of every game with a kept profile"""
+        self.wakeup = threading.Event()
+        """Set while there is at least one session to sample"""
+        self.lock = threading.Lock()
+        """Guards the per-game aggregates, the start of the sampler and the active sessions with the wakeup event"""
+        self.sampler: Optional[threading.Thread] = None
+        """The background sampling thread, started on first use"""
+
+    @classmethod
+    def from_env(cls) -> "Profiler":
+        """Creates a profiler configured by the BATTLESNAKE_PROFILE_EVERY and BATTLESNAKE_PROFILE_SLOWER_THAN_MS environment variables"""
+        return cls(every_n=int(os.environ.get("BATTLESNAKE_PROFILE_EVERY", 0)),
+                   slower_than_ms=float(os.environ.get("BATTLESNAKE_PROFILE_SLOWER_THAN_MS", 0)),
+                   output_dir=os.environ.get("BATTLESNAKE_PROFILE_DIR", DEFAULT_OUTPUT_DIR))
+
+    @property
+    def enabled(self) -> bool:
+        return self.every_n > 0 or self.slower_than_ms > 0
+
+    def configure(self, config: Any) -> Dict[str, Any]:
+        """Updates the configuration at runtime. Nothing is changed if any of the settings is invalid
+
+        Args:
+            config: Any of SETTINGS. every_n is a whole number and slower_than_ms a number, both 0 or more, and
+                interval_ms is a number above 0
+
+        Returns:
+            The configuration after the update
+
+        Raises:
+            ValueError: If config isn't a dictionary of valid settings
+        """
+        if not isinstance(config, dict):
+            raise ValueError("the profiler configuration must be a JSON object")
+        unknown = sorted(set(config) - set(SETTINGS))
+        if unknown:
+            raise ValueError(f"unknown settings {', '.join(unknown)}, only {', '.join(SETTINGS)} can be changed")
+        for name, value in config.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+                raise ValueError(f"{name} must be a number, 0 or more")
+        if not isinstance(config.get("every_n", 0), int):
+            raise ValueError("every_n must be a whole number")
+        if config.get("interval_ms", 1) <= 0:
+            raise ValueError("interval_ms must be above 0")
+        self.every_n = config.get("every_n", self.every_n)
+        self.slower_than_ms = float(config.get("slower_than_ms", self.slower_than_ms))
+        self.interval_ms = float(config.get("interval_ms", self.interval_ms))
+        return self.config()
+
+    def config(self) -> Dict[str, Any]:
+        return {"every_n": self.every_n, "slower_than_ms": self.slower_than_ms, "interval_ms": self.interval_ms}
+
+    def begin(self, game_state: Dict[str, Any]) -> Optional[ProfileSession]:
+        """Starts sampling the current thread if this request is selected
+
+        Args:
+            game_state: The game state of the move request
+
+        Returns:
+            The session to pass to finish, or None if the request is not being profiled
+        """
+        if not self.enabled:
+            return None
+        self.requests += 1
+        selected = self.every_n > 0 and self.requests % self.every_n == 0
+        if not (selected or self.slower_than_ms > 0):
+            return None
+
+        session = ProfileSession(game_state["game"]["id"], game_state["turn"], selected)
+        with self.lock:
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                self.sampler.start()
+            self.active[threading.get_ident()] = session
+            self.wakeup.set()
+        return session
+
+    def finish(self, session: ProfileSession):
+        """Stops sampling a request and writes its profile if it should be kept
+
+        Args:
+            session: The session returned by begin
+        """
+        # Under the lock, so the event can't be cleared just after another request's begin has set it
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+            if not self.active:
+                self.wakeup.clear()
+
+        elapsed_ms = (time.perf_counter() - session.started) * 1000
+        if not (session.selected or (self.slower_than_ms > 0 and elapsed_ms >= self.slower_than_ms)) or not session.stacks:
+            return
+
+        game_dir = os.path.join(self.output_dir, safe_file_name(session.game_id))
+        os.makedirs(game_dir, exist_ok=True)
+        with open(os.path.join(game_dir, f"turn-{session.turn}-{elapsed_ms:.0f}ms.collapsed"), "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in session.stacks.items())
+        with self.lock:
+            self.games.setdefault(session.game_id, Counter()).update(session.stacks)
+
+    def end_game(self, game_id: str):
+        """Writes the aggregated profile of a game, ready to be fed to flamegraph.pl
+
+        Args:
+            game_id: The game that ended
+        """
+        with self.lock:
+            stacks = self.games.pop(game_id, None)
+        if not stacks:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, f"{safe_file_name(game_id)}.collapsed"), "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def _sample(self):
+        while True:
+            self.wakeup.wait()
+            frames = sys._current_frames()
+            for ident, session in list(self.active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    session.stacks[collapse_stack(frame)] += 1
+            del frames
+            time.sleep(self.interval_ms / 1000)
@@ -0,0 +1,310 @@
+"""Records every game a server plays to disk, for replay and debugging, without slowing the requests down
+
+Requests only put a frame (the game state, the response and the engine's stats, all by reference) on a bounded queue,
+which takes about a microsecond and never waits: when the queue is full, because the disk has fallen behind, the frame
+is dropped and counted in battlesnake_recorder_dropped_frames_total. A background thread takes the frames off the
+queue and encodes every turn as the changes from the last turn it encoded for the game: for each snake the new head
+and length (or the whole body if it didn't just move one step), changed fields such as health, snakes that are gone,
+and food that appeared or was eaten. A dropped turn only makes the next delta a little bigger. The turns of a game are
+kept in memory until its /end, then appended to the game's file (one per game and snake) as a gzip member. Games that
+stop getting requests without an /end are written once they have been idle for IDLE_TIMEOUT seconds. When the server
+runs several worker processes (see server.serve_workers), every worker that served a game appends the part it saw
+to the same file, and iter_game puts the parts back in order.
+
+Each file holds one JSON record per line:
+    {"type": "start", "time": ..., "state": ...}
+    {"type": "move", "time": ..., "delta": ..., "move": "up", "ms": 41.2, "stats": {"depth": 5, "value": 1.8, ...}}
+    {"type": "end", "time": ..., "delta": ...}
+The first record of every part has "state" instead of "delta" (a start, or the first move recorded if the start was
+dropped). iter_game reads a file back with the full state of every record, in the order of the turns.
+
+Usage:
+    BATTLESNAKE_RECORD_GAMES=games python main_game_theory.py
+    python recorder.py games/<game>.jsonl.gz
+"""
+from typing import Dict, List, Optional, Any, Iterator, Tuple
+from collections import deque
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import metrics
+
+DEFAULT_CAPACITY = 4096
+"""The number of frames the queue holds before new ones are dropped"""
+POLL_INTERVAL = 0.05
+"""Seconds the writer waits when the queue is empty. Requests never wake it, so that recording costs them nothing more"""
+IDLE_TIMEOUT = 60.0
+"""Seconds without a request after which a game that never got an /end is written"""
+
+Frame = Tuple[str, str, Dict[str, Any], Optional[Dict[str, Any]], Optional[float], Optional[Dict[str, Any]], float]
+"""The kind of request, the name of the snake, the game state, the response, the handling time in ms, the engine's stats
+and the time of the request"""
+
+
+def _cells(cells: List[Dict[str, int]]) -> List[List[int]]:
+    return [[cell["x"], cell["y"]] for cell in cells]
+
+
+def encode_delta(previous: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    """Encodes a game state as the changes from an earlier state of the same game
+
+    Args:
+        previous: The earlier compact game state (see decoding.compact_game_state)
+        state: The compact game state to encode
+
+    Returns:
+        The delta, which apply_delta turns back into the state
+    """
+    delta: Dict[str, Any] = {"turn": state["turn"]}
+    before = {snake["id"]: snake for snake in previous["board"]["snakes"]}
+    snakes: Dict[str, Any] = {}
+    for snake in state["board"]["snakes"]:
+        old = before.get(snake["id"])
+        if old is None:
+            snakes[snake["id"]] = {"full": snake}
+            continue
+        changes = {field: value for field, value in snake.items()
+                   if field not in ("body", "head") and value != old.get(field)}
+        body, old_body = snake["body"], old["body"]
+        if body != old_body:
+            if body and body[1:] == old_body[:len(body) - 1]:
+                # The usual turn: a new head, and the tail either followed or stayed since the snake ate
+                changes["step"] = [body[0]["x"], body[0]["y"], len(body)]
+            else:
+                changes["body"] = _cells(body)
+        if changes:
+            snakes[snake["id"]] = changes
+    if snakes:
+        delta["snakes"] = snakes
+    ids = [snake["id"] for snake in state["board"]["snakes"]]
+    gone = [snake_id for snake_id in before if snake_id not in ids]
+    if gone:
+        delta["gone"] = gone
+    if ids != [snake_id for snake_id in before if snake_id in ids]:
+        delta["ids"] = ids
+
+    food, old_food = _cells(state["board"]["food"]), _cells(previous["board"]["food"])
+    added = [cell for cell in food if cell not in old_food]
+    eaten = [cell for cell in old_food if cell not in food]
+    if added:
+        delta["food+"] = added
+    if eaten:
+        delta["food-"] = eaten
+    if [cell for cell in old_food if cell in food] + added != food:
+        delta["food"] = food
+
+    # "you" is nearly always the same as its snake on the board, so it is only stored when it isn't
+    you = state["you"]
+    if you != next((snake for snake in state["board"]["snakes"] if snake["id"] == you["id"]), None):
+        delta["you"] = you
+    return delta
+
+
+def apply_delta(previous: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Rebuilds a game state from an earlier state and the delta encode_delta made between them"""
+    before = {snake["id"]: snake for snake in previous["board"]["snakes"]}
+    changes = delta.get("snakes", {})
+    ids = delta.get("ids") or [snake_id for snake_id in before if snake_id not in delta.get("gone", ())]
+    snakes = []
+    for snake_id in ids:
+        change = changes.get(snake_id, {})
+        if "full" in change:
+            snakes.append(change["full"])
+            continue
+        snake = {**before[snake_id], **{field: value for field, value in change.items() if field not in ("step", "body")}}
+        if "step" in change:
+            x, y, length = change["step"]
+            snake["body"] = [{"x": x, "y": y}] + before[snake_id]["body"][:length - 1]
+        elif "body" in change:
+            snake["body"] = [{"x": x, "y": y} for x, y in change["body"]]
+        if "head" in snake:
+            snake["head"] = snake["body"][0]
+        snakes.append(snake)
+
+    if "food" in delta:
+        food = delta["food"]
+    else:
+        food = [cell for cell in _cells(previous["board"]["food"]) if cell not in delta.get("food-", ())] + delta.get("food+", [])
+    board = {**previous["board"], "food": [{"x": x, "y": y} for x, y in food], "snakes": snakes}
+    you = delta.get("you") or next(snake for snake in snakes if snake["id"] == previous["you"]["id"])
+    return {**previous, "turn": delta["turn"], "board": board, "you": you}
+
+
+class _GameLog:
+    # The records of one game and snake that haven't been written yet, and the last state they were encoded from
+    def __init__(self) -> None:
+        self.state: Optional[Dict[str, Any]] = None
+        self.lines: List[bytes] = []
+        self.seen = time.monotonic()
+
+
+class GameRecorder:
+    """Records the games a server plays, off the request threads (see the module docs)
+
+    Args:
+        out_dir: Where the game files are written
+        capacity: The number of frames queued before new ones are dropped
+    """
+    def __init__(self, out_dir: str, capacity: int = DEFAULT_CAPACITY) -> None:
+        self.out_dir = out_dir
+        """Where the game files are written"""
+        self.capacity = capacity
+        """The number of frames queued before new ones are dropped"""
+        # deque appends and pops are atomic, so requests and the writer share the queue without a lock
+        self.frames: "deque[Frame]" = deque()
+        """Frames waiting for the writer"""
+        self.dropped = 0
+        """The number of frames dropped because the queue was full"""
+        self.games: Dict[Tuple[str, str, str], _GameLog] = {}
+        """The games being recorded, by snake name, game id and snake id. Only used by the writer"""
+        self.writer: Optional[threading.Thread] = None
+        """The writer thread, started by the first frame so that it runs in the process that serves the requests"""
+        self.writer_lock = threading.Lock()
+        """Makes sure only one writer is started"""
+        self.stopping = threading.Event()
+        """Set to make the writer write everything and stop"""
+
+    def record(self, kind: str, name: str, game_state: Dict[str, Any], response: Optional[Dict[str, Any]] = None,
+               ms: Optional[float] = None, stats: Optional[Dict[str, Any]] = None):
+        """Queues a request to be recorded, or drops it if the queue is full. Never blocks
+
+        Args:
+            kind: "start", "move" or "end"
+            name: The name the snake is hosted under (see server.SnakeRegistry), or "" for the snake at the root
+            game_state: The game state of the request. It must not be changed afterwards
+            response: The response to a /move
+            ms: The time it took to handle the request
+            stats: The engine's stats of the move, such as its search depth
+        """
+        if self.writer is None:
+            self._start()
+        if len(self.frames) >= self.capacity:
+            self.dropped += 1
+            metrics.inc("battlesnake_recorder_dropped_frames_total", 1, "Requests not recorded because the recorder had fallen behind")
+            return
+        self.frames.append((kind, name, game_state, response, ms, stats, time.time()))
+
+    def _start(self):
+        with self.writer_lock:
+            if self.writer is None:
+                os.makedirs(self.out_dir, exist_ok=True)
+                self.writer = threading.Thread(target=self._run, name="recorder", daemon=True)
+                self.writer.start()
+
+    def _run(self):
+        idle_checked = time.monotonic()
+        while True:
+            # Idle games are swept on a timer rather than when the queue runs dry, which it rarely does under load
+            now = time.monotonic()
+            if now - idle_checked > IDLE_TIMEOUT / 4:
+                idle_checked = now
+                for key in [key for key, log in self.games.items() if now - log.seen > IDLE_TIMEOUT]:
+                    self._flush(key)
+            try:
+                frame = self.frames.popleft()
+            except IndexError:
+                if self.stopping.is_set():
+                    break
+                self.stopping.wait(POLL_INTERVAL)
+                continue
+            try:
+                self._encode(frame)
+            except Exception as e:
+                print(f"Couldn't record a frame: {type(e).__name__}: {e}")
+        for key in list(self.games):
+            self._flush(key)
+
+    def _encode(self, frame: Frame):
+        kind, name, game_state, response, ms, stats, at = frame
+        key = (name, game_state["game"]["id"], game_state["you"]["id"])
+        log = self.games.get(key)
+        if log is None:
+            log = self.games[key] = _GameLog()
+        log.seen = time.monotonic()
+        record: Dict[str, Any] = {"type": kind, "time": round(at, 3)}
+        if log.state is None:
+            record["state"] = game_state
+        else:
+            record["delta"] = encode_delta(log.state, game_state)
+        if response is not None:
+            record["move"] = response.get("move")
+        if ms is not None:
+            record["ms"] = round(ms, 2)
+        if stats:
+            record["stats"] = stats
+        log.state = game_state
+        log.lines.append(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        if kind == "end":
+            self._flush(key)
+
+    def _flush(self, key: Tuple[str, str, str]):
+        # Appends a game to its file and forgets it. The part is appended with a single write, so parts from other
+        # worker processes don't get mixed into it
+        log = self.games.pop(key)
+        name, game_id, snake_id = key
+        path = os.path.join(self.out_dir, game_path(name, game_id, snake_id))
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, gzip.compress(b"".join(log.lines), mtime=0))
+        finally:
+            os.close(fd)
+        metrics.inc("battlesnake_recorder_games_total", 1, "Games written by the recorder")
+
+    def close(self):
+        """Writes every game recorded so far and stops the writer"""
+        self.stopping.set()
+        if self.writer is not None:
+            self.writer.join()
+
+
+def game_path(name: str, game_id: str, snake_id: str) -> str:
+    """Gets the file name of a recorded game, with every character that can't go in a file name replaced by -"""
+    parts = [part for part in (name, game_id, snake_id) if part]
+    return re.sub(r"[^A-Za-z0-9_.-]+", "-", ".".join(parts)) + ".jsonl.gz"
+
+
+RECORD_ORDER = {"start": 0, "move": 1, "end": 2}
+"""The order of the records of a turn"""
+
+
+def iter_game(path: str) -> Iterator[Dict[str, Any]]:
+    """Reads a recorded game, with the full game state of every record in "state" in place of its delta
+
+    Args:
+        path: The game file
+
+    Yields:
+        The records of the game, in the order of the turns
+    """
+    records = []
+    state: Optional[Dict[str, Any]] = None
+    with gzip.open(path, "rb") as f:
+        # The parts of the game follow each other, and each starts from a full state
+        for line in f:
+            record = json.loads(line)
+            if "delta" in record:
+                record["state"] = state = apply_delta(state, record.pop("delta"))
+            else:
+                state = record["state"]
+            records.append(record)
+    records.sort(key=lambda record: (record["state"]["turn"], RECORD_ORDER[record["type"]], record["time"]))
+    yield from records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="a recorded game")
+    args = parser.parse_args()
+
+    for record in iter_game(args.path):
+        sys.stdout.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+if __name__ == "__main__":
+    main()
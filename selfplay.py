@@ -0,0 +1,255 @@
+"""Plays engines against each other across a process pool and streams every turn to disk, for tuning the engines
+
+Games are split into shards of a fixed number of games. Every shard is played by one worker and written to its own
+file as a series of gzip members, one per batch of records, so records reach the disk as they are played and a
+shard never has to be held in memory. A shard file only gets its final name once all its games are done, so an
+interrupted run can be resumed by running the same command again: finished shards are skipped and the others are
+replayed from the start, which gives the same games since every game is seeded from its index.
+
+Each shard holds one JSON record per line:
+    {"type": "turn", "game": ..., "turn": ..., "snake": ..., "engine": ..., "state": ..., "move": ..., "value": ..., "depth": ...}
+    {"type": "game", "game": ..., "turns": ..., "winner": ..., "engines": {snake: engine}, "eliminated": {snake: turn}}
+The game record comes after the turns of its game. iter_turns joins the outcome onto every turn.
+
+Usage:
+    python selfplay.py --out selfplay --games 200 --workers 4 --engines game_theory game_theory:AGGRESSION_MULTIPLIER=0.5
+"""
+from typing import Dict, List, Any, Iterator, Tuple
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import engines
+from decoding import compact_game_state
+from simulator import Game
+
+DEFAULT_OUT_DIR = "selfplay"
+"""Where shards are written by default"""
+DEFAULT_SHARD_SIZE = 25
+"""The number of games in a shard"""
+BATCH_SIZE = 256
+"""The number of records compressed and written together"""
+MANIFEST = "manifest.json"
+"""The settings of a run, checked when it is resumed"""
+
+_loaded: Dict[str, Any] = {}
+
+
+class ShardWriter:
+    """Writes records to a shard as gzip members of BATCH_SIZE records each"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        """Where the finished shard goes"""
+        self.tmp_path = f"{path}.tmp"
+        """Where the shard is written while it is being played"""
+        self.f = open(self.tmp_path, "wb")
+        """The open shard file"""
+        self.batch: List[bytes] = []
+        """Records that haven't been written yet"""
+        self.records = 0
+        """The number of records written"""
+
+    def write(self, record: Dict[str, Any]):
+        """Adds a record, writing the batch once it is full"""
+        self.batch.append(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Compresses and writes the records that haven't been written yet"""
+        if self.batch:
+            self.f.write(gzip.compress(b"".join(self.batch), mtime=0))
+            self.f.flush()
+            self.records += len(self.batch)
+            self.batch.clear()
+
+    def close(self):
+        """Writes what is left and gives the shard its final name"""
+        self.flush()
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def _init_worker(specs: List[str]):
+    # Engines print every move, which would only slow self-play down
+    sys.stdout = open(os.devnull, "w")
+    for spec in specs:
+        module = engines.load_engine(spec)
+        # Pondering would keep searching between moves and compete with the other workers for the CPU
+        if hasattr(module, "ENABLE_PONDERING"):
+            module.ENABLE_PONDERING = False
+        _loaded[spec] = module
+
+
+def play_game(writer: ShardWriter, game_id: str, seats: List[str], size: int, max_turns: int, rng: random.Random) -> Dict[str, Any]:
+    """Plays one game in process, writing a record for every move and one for the outcome
+
+    Args:
+        writer: Where records are written
+        game_id: The id of the game
+        seats: The engine spec playing each snake
+        size: The width and height of the board
+        max_turns: The turn at which the game is stopped as a draw
+        rng: The random stream of the game
+
+    Returns:
+        The game record
+    """
+    snakes = [(f"{game_id}-{i}", f"snake-{i}") for i in range(len(seats))]
+    game = Game(game_id, snakes, size, size, rng)
+    engine_of = {snake_id: spec for (snake_id, _), spec in zip(snakes, seats)}
+    for snake_id, spec in engine_of.items():
+        _loaded[spec].start(game.game_state(snake_id))
+
+    while not game.over and game.turn < max_turns:
+        moves = {}
+        for snake in list(game.snakes):
+            module = _loaded[engine_of[snake["id"]]]
+            game_state = game.game_state(snake["id"])
+            response = module.move(game_state)
+            moves[snake["id"]] = response["move"]
+            stats = response.get("stats", {})
+            writer.write({"type": "turn", "game": game_id, "turn": game.turn, "snake": snake["id"],
+                          "engine": engine_of[snake["id"]], "state": compact_game_state(game_state),
+                          "move": moves[snake["id"]], "value": stats.get("value"), "depth": stats.get("depth")})
+        game.step(moves)
+
+    for snake_id, spec in engine_of.items():
+        _loaded[spec].end(game.game_state(snake_id))
+    record = {"type": "game", "game": game_id, "turns": game.turn, "winner": game.winner,
+              "engines": engine_of, "eliminated": game.eliminated}
+    writer.write(record)
+    return record
+
+
+def play_shard(out_dir: str, shard: int, shard_size: int, games: int, specs: List[str], size: int, max_turns: int,
+               seed: int) -> Tuple[int, Dict[str, float]]:
+    """Plays the games of a shard and writes them to its file
+
+    Seats are rotated from game to game, so every engine plays every start position equally often
+
+    Returns:
+        The shard and the points of every engine in it (1 for a win, 0.5 each for a draw)
+    """
+    writer = ShardWriter(shard_path(out_dir, shard))
+    points = {spec: 0.0 for spec in specs}
+    for index in range(shard * shard_size, min((shard + 1) * shard_size, games)):
+        offset = index % len(specs)
+        seats = specs[offset:] + specs[:offset]
+        record = play_game(writer, f"selfplay-{seed}-{index}", seats, size, max_turns, random.Random(f"{seed}:{index}"))
+        if record["winner"] is None:
+            for spec in set(seats):
+                points[spec] += 0.5
+        else:
+            points[record["engines"][record["winner"]]] += 1
+    writer.close()
+    return shard, points
+
+
+def shard_path(out_dir: str, shard: int) -> str:
+    """Gets the path of a finished shard"""
+    return os.path.join(out_dir, f"shard-{shard:05d}.jsonl.gz")
+
+
+def iter_records(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    """Reads the records of shards one batch at a time"""
+    for path in paths:
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def iter_turns(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    """Reads the turns of shards with the outcome of their game attached as "outcome" ("win", "loss" or "draw").
+    Only one game is held in memory at a time
+
+    Args:
+        paths: The shard files
+
+    Yields:
+        Turn records
+    """
+    pending: List[Dict[str, Any]] = []
+    for record in iter_records(paths):
+        if record["type"] == "turn":
+            pending.append(record)
+            continue
+        for turn in pending:
+            if turn["game"] != record["game"]:
+                continue
+            winner = record["winner"]
+            turn["outcome"] = "draw" if winner is None else ("win" if winner == turn["snake"] else "loss")
+            yield turn
+        pending = [turn for turn in pending if turn["game"] != record["game"]]
+
+
+def run(out_dir: str, games: int, specs: List[str], workers: int, shard_size: int, size: int, max_turns: int, seed: int):
+    """Plays every shard that hasn't been finished yet and prints the points of every engine
+
+    Args:
+        out_dir: Where shards are written
+        games: The total number of games
+        specs: The engine spec of every seat
+        workers: The number of processes
+        shard_size: The number of games in a shard
+        size: The width and height of the board
+        max_turns: The turn at which games are stopped as a draw
+        seed: Seeds every game
+    """
+    for spec in specs:
+        engines.parse_spec(spec)
+    os.makedirs(out_dir, exist_ok=True)
+    settings = {"games": games, "engines": specs, "shard_size": shard_size, "size": size, "max_turns": max_turns, "seed": seed}
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous != settings:
+            raise SystemExit(f"{out_dir} holds a run with different settings: {previous}")
+    else:
+        with open(manifest_path, "w") as f:
+            json.dump(settings, f, indent=2)
+
+    num_shards = (games + shard_size - 1) // shard_size
+    todo = [shard for shard in range(num_shards) if not os.path.exists(shard_path(out_dir, shard))]
+    print(f"{num_shards - len(todo)}/{num_shards} shards already played")
+    started = time.perf_counter()
+    points = {spec: 0.0 for spec in specs}
+    args = [(out_dir, shard, shard_size, games, specs, size, max_turns, seed) for shard in todo]
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(specs,)) as pool:
+        for done, (shard, shard_points) in enumerate(pool.imap_unordered(_play_shard, args), 1):
+            for spec, value in shard_points.items():
+                points[spec] += value
+            print(f"shard {shard} done ({done}/{len(todo)}, {time.perf_counter() - started:.1f}s)")
+    played = sum(points.values())
+    for spec, value in points.items():
+        print(f"{spec}: {value:g} points" + (f" ({value / played:.1%})" if played else ""))
+
+
+def _play_shard(args: Tuple) -> Tuple[int, Dict[str, float]]:
+    return play_shard(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=DEFAULT_OUT_DIR, help="where shards are written")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--engines", nargs="+", default=["game_theory", "metaheuristics"],
+                        help="the engine spec of every seat, e.g. game_theory:AGGRESSION_MULTIPLIER=0.5")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE)
+    parser.add_argument("--size", type=int, default=11, help="board width and height")
+    parser.add_argument("--max-turns", type=int, default=300, help="games still going at this turn are draws")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    run(args.out, args.games, args.engines, args.workers, args.shard_size, args.size, args.max_turns, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,290 @@
+import argparse
 import logging
 import os
+import re
+import signal
+import socket
+import threading
+import time
 import typing
 
 from flask import Flask
+from flask import Response
+from flask import abort
 from flask import request
+from flask import stream_with_context
 
+import engines
+import metrics
+if typing.TYPE_CHECKING:
+    from batch import BatchEvaluator
+    from recorder import GameRecorder
+from deadline import DeadlineGuard
+from decoding import decode_game_state
+from move_cache import MoveCache, move_key
+from profiler import Profiler
 
-def run_server(handlers: typing.Dict, port: int = 8080):
+
+SNAKE_NAME = re.compile(r"[A-Za-z0-9_.-]+")
+"""The names a snake can be registered under, which are used in its routes"""
+
+
+def spec_name(spec: str) -> str:
+    """Gets the default name of an engine spec, with every run of characters that can't go in a route replaced by -"""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "-", spec).strip("-")
+
+
+class SnakeRegistry:
+    """Named snake configurations hosted by one server. Every snake gets the routes of a Battlesnake server under
+    /snakes/<name>/ (/snakes/<name>/ for info, then /snakes/<name>/start, /snakes/<name>/move and /snakes/<name>/end),
+    so its URL in a game is http://<host>:<port>/snakes/<name>. Snakes can be registered while the server is running
+    """
+    def __init__(self) -> None:
+        self.snakes: typing.Dict[str, typing.Dict[str, typing.Callable]] = {}
+        """The handlers of every snake, by name"""
+
+    def register(self, name: str, handlers: typing.Dict[str, typing.Callable]):
+        """Hosts a snake
+
+        Args:
+            name: The name in the snake's routes
+            handlers: The info, start, move and end handlers of the snake, and optionally the spec of its engine to serve /move/batch
+        """
+        if not SNAKE_NAME.fullmatch(name):
+            raise ValueError(f"{name!r} can't be used in a route, use letters, digits, _, . and -")
+        if name in self.snakes:
+            raise ValueError(f"a snake called {name} is already registered")
+        self.snakes[name] = handlers
+
+    def register_spec(self, spec: str, name: typing.Optional[str] = None) -> str:
+        """Hosts an engine, or a variant of one with its own settings (see engines.py)
+
+        Args:
+            spec: The engine spec, e.g. game_theory:AGGRESSION_MULTIPLIER=0.5
+            name: The name in the snake's routes. Defaults to spec_name(spec)
+
+        Returns:
+            The name of the snake
+        """
+        name = name or spec_name(spec)
+        # The spec lets the server start worker processes with the same engine for /move/batch
+        self.register(name, {**engines.handlers(engines.load_engine(spec)), "spec": spec})
+        return name
+
+    def get(self, name: str) -> typing.Optional[typing.Dict[str, typing.Callable]]:
+        """Gets the handlers of a snake, or None if there is no snake with that name"""
+        return self.snakes.get(name)
+
+
+def run_server(handlers: typing.Optional[typing.Dict], port: int = 8080, enable_metrics: bool = True, profiler: typing.Optional[Profiler] = None,
+               move_cache: typing.Optional[MoveCache] = None, guard: typing.Optional[DeadlineGuard] = None,
+               registry: typing.Optional[SnakeRegistry] = None, batch_workers: int = 0, workers: int = 1,
+               recorder: typing.Optional["GameRecorder"] = None):
+    """Serves snakes over HTTP until the process ends. Requests are handled on a thread each, in one process or in a
+    number of worker processes forked from this one (see serve_workers)
+
+    Args:
+        handlers: The handlers of the snake served at the root (/, /start, /move and /end), or None to only serve the registry
+        port: The port to listen on
+        enable_metrics: Whether to record metrics and serve them on /metrics
+        profiler: Profiles slow moves. Configured from the environment by default
+        move_cache: Answers retried /move requests. A new cache by default
+        guard: Runs moves under their deadline. A new guard by default
+        registry: More snakes to serve, each under /snakes/<name>/
+        batch_workers: The worker processes of each engine that serves /move/batch. Defaults to one per CPU
+        workers: The number of processes that serve requests
+        recorder: Records every game to disk. Configured from the environment by default
+    """
     app = Flask("Battlesnake")
+    metrics.enabled = enable_metrics
+    profiler = profiler or Profiler.from_env()
+    # Retried or duplicated /move requests get the move of the first one instead of searching again
+    if move_cache is None:
+        move_cache = MoveCache()
+    # Moves the engine can't work out within the game's timeout are answered with a quick safe move instead
+    if guard is None:
+        guard = DeadlineGuard()
+    timers: typing.Dict[str, metrics.RouteTimer] = {}
+    # Move requests are saved to the benchmark corpus when a directory is given
+    corpus_dir = os.environ.get("BATTLESNAKE_RECORD_CORPUS")
+    if corpus_dir:
+        from benchmark import record_position
+    # Every game is recorded when a directory is given
+    games_dir = os.environ.get("BATTLESNAKE_RECORD_GAMES")
+    if recorder is None and games_dir:
+        from recorder import GameRecorder
+        recorder = GameRecorder(games_dir)
+
+    # The worker pool of every engine spec that has been sent a batch, started on the first one
+    evaluators: typing.Dict[str, "BatchEvaluator"] = {}
+    evaluators_lock = threading.Lock()
 
-    @app.get("/")
-    def on_info():
-        return handlers["info"]()
+    def timer(route: str) -> metrics.RouteTimer:
+        if route not in timers:
+            timers[route] = metrics.RouteTimer(route)
+        return timers[route]
 
-    @app.post("/start")
-    def on_start():
-        game_state = request.get_json()
-        handlers["start"](game_state)
+    def decode_request() -> typing.Dict[str, typing.Any]:
+        # A malformed body is the client's mistake, so it gets a 400 as it did when Flask decoded it
+        try:
+            return decode_game_state(request.get_data())
+        except ValueError as e:
+            abort(400, f"invalid game state: {e}")
+
+    def handle_start(snake: typing.Dict[str, typing.Callable], route: str, name: str = ""):
+        started = time.perf_counter()
+        game_state = decode_request()
+        parsed = time.perf_counter()
+        snake["start"](game_state)
+        handled = time.perf_counter()
+        if enable_metrics:
+            timer(route).record(started, parsed, handled, handled)
+        if recorder is not None:
+            recorder.record("start", name, game_state)
         return "ok"
 
-    @app.post("/move")
-    def on_move():
-        game_state = request.get_json()
-        return handlers["move"](game_state)
+    def handle_move(snake: typing.Dict[str, typing.Callable], route: str, name: str = ""):
+        started = time.perf_counter()
+        game_state = decode_request()
+        parsed = time.perf_counter()
+        if corpus_dir:
+            # Written in the background, so the disk doesn't count against the move's deadline
+            threading.Thread(target=record_position, args=(corpus_dir, game_state), name="corpus", daemon=True).start()
+        # The move the engine answered with and the stats it returned with it
+        found: typing.List[typing.Tuple[typing.Dict[str, typing.Any], typing.Dict[str, typing.Any]]] = []
+
+        def search():
+            # Runs on the guard's thread, which is the one the profiler has to sample
+            session = profiler.begin(game_state)
+            try:
+                move = snake["move"](game_state)
+            finally:
+                if session is not None:
+                    profiler.finish(session)
+            # The stats aren't part of the Battlesnake response
+            if "stats" in move:
+                move = dict(move)
+                found.append((move, move.pop("stats")))
+            return move
+
+        move = move_cache.get_or_compute(move_key(game_state, name), lambda: guard.run(game_state, search, started))
+        handled = time.perf_counter()
+        response = app.json.response(move)
+        if enable_metrics:
+            timer(route).record(started, parsed, handled, time.perf_counter(), game_state["game"]["timeout"])
+        if recorder is not None:
+            # Only the stats of the move that was sent are recorded, not those of a search the guard gave up on and
+            # answered with a fallback move. They are copied, so nothing the engine does later can change the frame
+            stats = dict(found[0][1]) if found and found[0][0] is move else {}
+            recorder.record("move", name, game_state, move, (handled - started) * 1000, stats)
+        return response
 
-    @app.post("/end")
-    def on_end():
-        game_state = request.get_json()
-        handlers["end"](game_state)
+    def handle_end(snake: typing.Dict[str, typing.Callable], route: str, name: str = ""):
+        started = time.perf_counter()
+        game_state = decode_request()
+        parsed = time.perf_counter()
+        snake["end"](game_state)
+        handled = time.perf_counter()
+        if enable_metrics:
+            timer(route).record(started, parsed, handled, handled)
+        if recorder is not None:
+            recorder.record("end", name, game_state)
+        profiler.end_game(game_state["game"]["id"])
+        move_cache.end_game(game_state["game"]["id"])
         return "ok"
 
+    def handle_batch(snake: typing.Dict[str, typing.Callable]):
+        # Imported here since most servers never get a batch, and multiprocessing would slow their start down
+        from batch import BatchEvaluator, encode_result
+
+        spec = snake.get("spec")
+        if spec is None:
+            abort(404, "this snake doesn't serve /move/batch, host it by engine spec to do so")
+        with evaluators_lock:
+            if spec not in evaluators:
+                evaluators[spec] = BatchEvaluator(spec, batch_workers or None)
+            evaluator = evaluators[spec]
+
+        # Positions are read from the request as results are sent, so a slow client slows the reading down
+        @stream_with_context
+        def results():
+            for result in evaluator.evaluate(request.stream):
+                metrics.inc("battlesnake_batch_positions_total", 1, "Positions evaluated through /move/batch", engine=spec)
+                yield encode_result(result)
+
+        return Response(results(), mimetype="application/x-ndjson")
+
+    if handlers is not None:
+        @app.get("/")
+        def on_info():
+            return handlers["info"]()
+
+        @app.post("/start")
+        def on_start():
+            return handle_start(handlers, "/start")
+
+        @app.post("/move")
+        def on_move():
+            return handle_move(handlers, "/move")
+
+        @app.post("/end")
+        def on_end():
+            return handle_end(handlers, "/end")
+
+        @app.post("/move/batch")
+        def on_move_batch():
+            return handle_batch(handlers)
+
+    if registry is not None:
+        def registered(name: str) -> typing.Dict[str, typing.Callable]:
+            snake = registry.get(name)
+            if snake is None:
+                abort(404, f"there is no snake called {name}")
+            return snake
+
+        @app.get("/snakes")
+        def on_snakes():
+            return {"snakes": sorted(registry.snakes)}
+
+        @app.get("/snakes/<name>/")
+        @app.get("/snakes/<name>")
+        def on_snake_info(name: str):
+            return registered(name)["info"]()
+
+        @app.post("/snakes/<name>/start")
+        def on_snake_start(name: str):
+            return handle_start(registered(name), f"/snakes/{name}/start", name)
+
+        @app.post("/snakes/<name>/move")
+        def on_snake_move(name: str):
+            return handle_move(registered(name), f"/snakes/{name}/move", name)
+
+        @app.post("/snakes/<name>/end")
+        def on_snake_end(name: str):
+            return handle_end(registered(name), f"/snakes/{name}/end", name)
+
+        @app.post("/snakes/<name>/move/batch")
+        def on_snake_move_batch(name: str):
+            return handle_batch(registered(name))
+
+    if enable_metrics:
+        @app.get("/metrics")
+        def on_metrics():
+            return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    # The profiler can be switched on and off without restarting, e.g.
+    # curl -X POST localhost:8080/profiler -H 'Content-Type: application/json' -d '{"every_n": 10}'
+    @app.get("/profiler")
+    def on_profiler_config():
+        return profiler.config()
+
+    @app.post("/profiler")
+    def on_profiler_configure():
+        try:
+            return profiler.configure(request.get_json(silent=True))
+        except ValueError as e:
+            abort(400, str(e))
+
     @app.after_request
     def identify_server(response):
         response.headers.set(
@@ -41,5 +296,92 @@ def run_server(handlers: typing.Dict, port: int = 8080):
 
     logging.getLogger("werkzeug").setLevel(logging.ERROR)
 
-    print(f"\nRunning Battlesnake at http://{host}:{port}")
-    app.run(host=host, port=port)
\ No newline at end of file
+    print(f"\nRunning Battlesnake at http://{host}:{port}" + (f" with {workers} workers" if workers > 1 else ""))
+    if registry is not None:
+        for name in registry.snakes:
+            print(f"  {name} at http://{host}:{port}/snakes/{name}")
+    # Games still being recorded are written when the server is stopped
+    on_exit = recorder.close if recorder is not None else None
+    if workers > 1:
+        serve_workers(app, host, port, workers, on_exit)
+    else:
+        # SIGTERM stops the server the same way as an interrupt from the terminal. Signal handlers can only be set from
+        # the main thread, and a server started on another thread (as the tuner does) is stopped with its process
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+        app.run(host=host, port=port)
+        if on_exit is not None:
+            on_exit()
+
+
+def serve_workers(app: Flask, host: str, port: int, workers: int, on_exit: typing.Optional[typing.Callable[[], None]] = None):
+    """Serves an app from worker processes forked after the snakes have been loaded, which all accept connections from
+    one listening socket
+
+    Everything the parent built before the fork, the engines and their tables, is shared with the workers page by page
+    until a worker writes to it, and tables published through shared_tables.py stay shared since they are only read.
+    State built while serving (the move cache, pondering, metrics) belongs to each worker, so a retried move or the
+    next turn of a game can land on a worker that hasn't seen the game. Returns once every worker has stopped
+
+    Args:
+        app: The app to serve
+        host: The address to listen on
+        port: The port to listen on
+        workers: The number of worker processes
+        on_exit: Called in every worker once it has stopped serving
+    """
+    from werkzeug.serving import make_server
+
+    listener = socket.create_server((host, port), backlog=128)
+    children: typing.List[int] = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # A worker stops when it is sent SIGTERM or the server is interrupted from the terminal
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+                if on_exit is not None:
+                    on_exit()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+    listener.close()
+    # The workers are stopped with the server, whether it is interrupted from the terminal or sent SIGTERM
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves any number of engines and engine variants from one process, "
+                                                 "each at http://<host>:<port>/snakes/<name>")
+    parser.add_argument("snakes", nargs="+", metavar="[NAME=]SPEC",
+                        help="an engine spec (see engines.py) to serve, optionally named, e.g. aggressive=game_theory:AGGRESSION_MULTIPLIER=0.5")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="processes that serve requests, forked once the snakes are loaded")
+    args = parser.parse_args()
+
+    registry = SnakeRegistry()
+    for snake in args.snakes:
+        name, _, spec = snake.partition("=")
+        # The = of a setting comes after the engine name and its :, the = of a name comes before them
+        if not spec or ":" in name:
+            name, spec = "", snake
+        registry.register_spec(spec, name or None)
+    run_server(None, args.port, registry=registry, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Large read-only tables shared by every worker process through memory-mapped files
+
+A table is built once, offline or by the parent process, and published as a file. Every process that uses it maps
+the file read only, so its pages live once in the OS page cache however many workers attach, and attaching copies
+nothing. A table file starts with a common header: a magic that names the kind of table and the layout of its
+contents, and a version that identifies the build. Tables are published with an atomic rename, so a new deployment
+swaps a table by publishing a new file over the old one. Processes notice the new file on their next lookup (checked
+at most every CHECK_INTERVAL seconds) and map it, while lookups already running on the old mapping finish on it.
+"""
+from typing import Dict, Optional, Iterable, Callable, Generic, TypeVar, Tuple
+import mmap
+import os
+import struct
+import threading
+import time
+
+TABLE_HEADER = struct.Struct("<8sQ")
+"""The header every table file starts with: the magic of the table kind and layout, and the version of the build"""
+CHECK_INTERVAL = 1.0
+"""Seconds between checks for a newly published table"""
+
+T = TypeVar("T", bound="SharedTable")
+
+
+class SharedTable:
+    """A read-only table file mapped into memory. Subclasses read their own header and records after TABLE_HEADER
+
+    Args:
+        path: The table file
+        magic: The magic the file must start with
+    """
+    def __init__(self, path: str, magic: bytes) -> None:
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            """The memory-mapped contents of the file"""
+        file_magic, self.version = TABLE_HEADER.unpack_from(self.data, 0)
+        if file_magic != magic:
+            raise ValueError(f"{path} is not a {magic.decode(errors='replace')} table")
+        self.path = path
+        """Where the table was mapped from"""
+        self.offset = TABLE_HEADER.size
+        """Where the contents of the table start"""
+
+
+def publish(path: str, magic: bytes, chunks: Iterable[bytes], version: Optional[int] = None) -> int:
+    """Writes a table file and swaps it in atomically
+
+    Args:
+        path: Where to publish the table
+        magic: The magic of the table kind and layout
+        chunks: The contents of the table, after the header
+        version: The version of the build. Defaults to the current time in nanoseconds
+
+    Returns:
+        The version of the table
+    """
+    version = time.time_ns() if version is None else version
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(TABLE_HEADER.pack(magic, version))
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, path)
+    return version
+
+
+class TableHandle(Generic[T]):
+    """The current version of a published table, mapped on first use and mapped again when a new version is published
+
+    Args:
+        path: The table file
+        open_table: Maps the table file
+        check_interval: Seconds between checks for a new version
+    """
+    def __init__(self, path: str, open_table: Callable[[str], T], check_interval: float = CHECK_INTERVAL) -> None:
+        self.path = path
+        """The table file"""
+        self.open_table = open_table
+        """Maps the table file"""
+        self.check_interval = check_interval
+        """Seconds between checks for a new version"""
+        self.table: Optional[T] = None
+        """The mapped table, or None if there is no table file"""
+        self.identity: Optional[Tuple[int, int, int]] = None
+        """The device, inode and modification time of the mapped file, which change when a new version is published"""
+        self.checked = float("-inf")
+        """When the file was last checked"""
+        self.lock = threading.Lock()
+        """Makes sure only one thread maps a new version"""
+
+    def get(self) -> Optional[T]:
+        """Gets the current version of the table, or None if there is no table file"""
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return self.table
+        with self.lock:
+            if now - self.checked < self.check_interval:
+                return self.table
+            self.checked = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self.table, self.identity = None, None
+                return None
+            identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+            if identity != self.identity:
+                # A lookup still holding the old table keeps its mapping alive until it is done
+                self.table, self.identity = self.open_table(self.path), identity
+            return self.table
+
+
+_handles: Dict[str, TableHandle] = {}
+_handles_lock = threading.Lock()
+
+
+def attach(path: str, open_table: Callable[[str], T]) -> Optional[T]:
+    """Gets the current version of a table, sharing one handle per path across the process
+
+    Args:
+        path: The table file
+        open_table: Maps the table file. Only used for the first call for a path
+
+    Returns:
+        The table, or None if there is no table file
+    """
+    handle = _handles.get(path)
+    if handle is None:
+        with _handles_lock:
+            handle = _handles.setdefault(path, TableHandle(path, open_table))
+    return handle.get()
@@ -0,0 +1,184 @@
+"""A local stand-in for the Battlesnake engine's standard rules, used to drive games without the engine binaries
+
+Games follow the standard ruleset: snakes start on the fixed start points with food next to them and in the center,
+all snakes move at once, eat, starve, collide and lose head-to-heads against longer or equal snakes, and food spawns
+to keep a minimum on the board plus at random. Hazards and other game modes are not modelled.
+"""
+from typing import Dict, List, Optional, Any, Tuple
+import random
+
+DEFAULT_TIMEOUT_MS = 500
+"""The move timeout sent in game states, the same as the engine's default"""
+MINIMUM_FOOD = 1
+"""The food the board is topped up to every turn"""
+FOOD_SPAWN_CHANCE = 15
+"""The percent chance of an extra food spawning every turn"""
+START_HEALTH = 100
+"""The health of a snake at the start and after eating"""
+START_LENGTH = 3
+"""The length of a snake at the start"""
+DIRECTION_VECTORS = {"up": (0, 1), "down": (0, -1), "left": (-1, 0), "right": (1, 0)}
+"""The change in head position for each move"""
+
+
+class Game:
+    """A game in progress under the standard rules
+
+    Args:
+        game_id: The id sent in every game state
+        snakes: The id and name of every snake
+        width: The width of the board
+        height: The height of the board
+        rng: The random stream used for start positions and food
+        timeout: The move timeout sent in game states
+    """
+    def __init__(self, game_id: str, snakes: List[Tuple[str, str]], width: int = 11, height: int = 11,
+                 rng: Optional[random.Random] = None, timeout: int = DEFAULT_TIMEOUT_MS) -> None:
+        self.game_id = game_id
+        """The id of the game"""
+        self.width = width
+        """The width of the board"""
+        self.height = height
+        """The height of the board"""
+        self.rng = rng or random.Random()
+        """The random stream used for start positions and food"""
+        self.timeout = timeout
+        """The move timeout sent in game states"""
+        self.turn = 0
+        """The current turn"""
+        self.snakes: List[Dict[str, Any]] = []
+        """Every snake that is still alive, in the same format as the engine sends"""
+        self.eliminated: Dict[str, int] = {}
+        """The turn each eliminated snake died on, keyed by snake id"""
+        self.food: List[Dict[str, int]] = []
+        """The food on the board"""
+        self._place(snakes)
+
+    def _place(self, snakes: List[Tuple[str, str]]):
+        mn, mx = 1, self.width - 2
+        mid_x, mid_y = (self.width - 1) // 2, (self.height - 1) // 2
+        corners = [(mn, mn), (mn, self.height - 2), (mx, mn), (mx, self.height - 2)]
+        edges = [(mn, mid_y), (mid_x, mn), (mid_x, self.height - 2), (mx, mid_y)]
+        self.rng.shuffle(corners)
+        self.rng.shuffle(edges)
+        points = corners + edges if self.rng.random() < 0.5 else edges + corners
+        if len(snakes) > len(points):
+            raise ValueError(f"at most {len(points)} snakes can start on a {self.width}x{self.height} board")
+
+        center = {"x": mid_x, "y": mid_y}
+        for (snake_id, name), (x, y) in zip(snakes, points):
+            body = [{"x": x, "y": y} for _ in range(START_LENGTH)]
+            self.snakes.append({"id": snake_id, "name": name, "health": START_HEALTH, "body": body, "latency": "0",
+                                "head": body[0], "length": START_LENGTH, "shout": "", "squad": "",
+                                "customizations": {"color": "#888888", "head": "default", "tail": "default"}})
+            # One food diagonal to each snake, away from the center
+            options = [{"x": x + dx, "y": y + dy} for dx, dy in ((-1, -1), (-1, 1), (1, -1), (1, 1))
+                       if abs(x + dx - mid_x) + abs(y + dy - mid_y) > abs(x - mid_x) + abs(y - mid_y)]
+            options = [food for food in options if food not in self.food and self._in_bounds(food)]
+            if options:
+                self.food.append(self.rng.choice(options))
+        if center not in self.food and not self._occupied(center):
+            self.food.append(center)
+
+    def _in_bounds(self, cell: Dict[str, int]) -> bool:
+        return 0 <= cell["x"] < self.width and 0 <= cell["y"] < self.height
+
+    def _occupied(self, cell: Dict[str, int]) -> bool:
+        return any(cell in snake["body"] for snake in self.snakes)
+
+    @property
+    def over(self) -> bool:
+        """Whether the game has ended: one snake is left in a multi-snake game, or none in a solo game"""
+        started_with = len(self.snakes) + len(self.eliminated)
+        return len(self.snakes) <= (1 if started_with > 1 else 0)
+
+    @property
+    def winner(self) -> Optional[str]:
+        """The id of the last snake alive, or None for a draw or while the game is running"""
+        return self.snakes[0]["id"] if self.over and self.snakes else None
+
+    def game_state(self, snake_id: str) -> Dict[str, Any]:
+        """Builds the game state the engine would send to a snake
+
+        The snakes on the board are listed with the receiving snake first, since the game theory snake treats the
+        second snake as its opponent
+
+        Args:
+            snake_id: The snake receiving the request. It may already be eliminated, e.g. for /end
+
+        Returns:
+            The game state in the format sent by the Battlesnake engine
+        """
+        snakes = sorted(self.snakes, key=lambda snake: snake["id"] != snake_id)
+        you = snakes[0] if snakes and snakes[0]["id"] == snake_id else {"id": snake_id, "name": snake_id, "health": 0,
+                                                                      "body": [], "latency": "0", "length": 0}
+        return {
+            "game": {"id": self.game_id, "ruleset": {"name": "standard", "version": "v1.2.3", "settings": {
+                        "foodSpawnChance": FOOD_SPAWN_CHANCE, "minimumFood": MINIMUM_FOOD}},
+                     "map": "standard", "source": "custom", "timeout": self.timeout},
+            "turn": self.turn,
+            "board": {"height": self.height, "width": self.width, "food": list(self.food), "hazards": [], "snakes": snakes},
+            "you": you,
+        }
+
+    def default_move(self, snake_id: str) -> str:
+        """Gets the move the engine makes for a snake that timed out or sent an invalid move: its last move, or up"""
+        snake = next(snake for snake in self.snakes if snake["id"] == snake_id)
+        head, neck = snake["body"][0], snake["body"][1]
+        vector = (head["x"] - neck["x"], head["y"] - neck["y"])
+        return next((name for name, v in DIRECTION_VECTORS.items() if v == vector), "up")
+
+    def step(self, moves: Dict[str, str]):
+        """Plays one turn
+
+        Args:
+            moves: The move of every live snake, keyed by snake id. Missing or invalid moves use default_move
+        """
+        for snake in self.snakes:
+            move = moves.get(snake["id"])
+            if move not in DIRECTION_VECTORS:
+                move = self.default_move(snake["id"])
+            dx, dy = DIRECTION_VECTORS[move]
+            head = {"x": snake["body"][0]["x"] + dx, "y": snake["body"][0]["y"] + dy}
+            snake["body"] = [head] + snake["body"][:-1]
+            snake["head"] = head
+            snake["health"] -= 1
+
+        for snake in self.snakes:
+            if snake["body"][0] in self.food:
+                snake["health"] = START_HEALTH
+                snake["body"].append(snake["body"][-1])
+        eaten = [snake["body"][0] for snake in self.snakes]
+        self.food = [food for food in self.food if food not in eaten]
+        for snake in self.snakes:
+            snake["length"] = len(snake["body"])
+
+        self.turn += 1
+        dead = [snake["id"] for snake in self.snakes if self._eliminated(snake)]
+        self.snakes = [snake for snake in self.snakes if snake["id"] not in dead]
+        for snake_id in dead:
+            self.eliminated[snake_id] = self.turn
+        self._spawn_food()
+
+    def _eliminated(self, snake: Dict[str, Any]) -> bool:
+        head = snake["body"][0]
+        if snake["health"] <= 0 or not self._in_bounds(head) or head in snake["body"][1:]:
+            return True
+        for other in self.snakes:
+            if other is snake:
+                continue
+            if head in other["body"][1:]:
+                return True
+            if head == other["body"][0] and snake["length"] <= other["length"]:
+                return True
+        return False
+
+    def _spawn_food(self):
+        missing = MINIMUM_FOOD - len(self.food)
+        if missing <= 0 and self.rng.randrange(100) < FOOD_SPAWN_CHANCE:
+            missing = 1
+        if missing <= 0:
+            return
+        free = [{"x": x, "y": y} for x in range(self.width) for y in range(self.height)]
+        free = [cell for cell in free if cell not in self.food and not self._occupied(cell)]
+        self.food.extend(self.rng.sample(free, min(missing, len(free))))
@@ -0,0 +1,132 @@
+from typing import Dict, List, Optional, Tuple, Any, Sequence
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def board_masks(width: int, height: int) -> int:
+    """Gets the bit mask of every cell of a board. Cell (x, y) is bit x + y * (width + 1): every row is followed by a
+    bit that is never set, so a shift by one can't carry a cell from the end of one row to the start of the next
+
+    Args:
+        width: The width of the board
+        height: The height of the board
+
+    Returns:
+        The mask of every cell
+    """
+    row = (1 << width) - 1
+    return sum(row << (y * (width + 1)) for y in range(height))
+
+
+def to_mask(cells: Sequence[Dict[str, int]], width: int) -> int:
+    """Gets the bit mask of a list of coordinates, laid out as in board_masks"""
+    stride = width + 1
+    mask = 0
+    for cell in cells:
+        mask |= 1 << (cell["x"] + cell["y"] * stride)
+    return mask
+
+
+class Territory:
+    """What each snake controls on the board, found by a simultaneous BFS from every head"""
+    def __init__(self, territory: List[int], reachable: List[int], nearest_food: List[int]) -> None:
+        self.territory = territory
+        """The number of cells each snake reaches strictly before every other snake"""
+        self.reachable = reachable
+        """The number of free cells each snake can reach at all, counted up to the limit passed to evaluate_territory"""
+        self.nearest_food = nearest_food
+        """The distance to the closest food each snake reaches first, or -1 if it reaches none first"""
+
+
+def evaluate_territory(width: int, height: int, bodies: Sequence[Sequence[Dict[str, int]]], food: Sequence[Dict[str, int]],
+                       limit: Optional[int] = None) -> Territory:
+    """Computes each snake's territory, reachable area and nearest food with a simultaneous BFS from every head
+
+    The board is held as bit masks, so each BFS layer moves every frontier cell at once with a handful of shifts.
+    All heads are expanded together, and every free cell is owned by the snake that gets there first (cells reached
+    by two snakes on the same layer belong to nobody). A snake's nearest food is the first layer on which it owns food.
+    Then each snake's reach is flooded without regard for the other snakes, which gives the area it can reach at all.
+    Every row of the masks ends in a bit that is never free, so a frontier can be shifted without masking off the
+    edges. Tails are treated as free since they move away.
+
+    Args:
+        width: The width of the board
+        height: The height of the board
+        bodies: The body of each snake, head first
+        food: The food on the board
+        limit: Stop flooding a snake's reach once it has reached this many cells, and don't flood it at all if the
+            snake owns that many. Checking whether a snake fits in its space only needs its length
+
+    Returns:
+        The territory of each snake, in the same order as the bodies
+    """
+    full = board_masks(width, height)
+    stride = width + 1
+
+    blocked = 0
+    for body in bodies:
+        blocked |= to_mask(body[:-1], width)
+    free = full & ~blocked
+    food_mask = to_mask(food, width)
+    if limit is None:
+        limit = width * height
+
+    num_snakes = len(bodies)
+    snakes = range(num_snakes)
+    heads = [to_mask(body[:1], width) for body in bodies]
+    frontiers = list(heads)
+    territory = [0] * num_snakes
+    nearest_food = [-1] * num_snakes
+    unvisited = free
+
+    depth = 0
+    while any(frontiers):
+        depth += 1
+        # The padding bit after every row isn't free, so the shifts only need masking with the unvisited cells
+        claims = [((f << 1) | (f >> 1) | (f << stride) | (f >> stride)) & unvisited if f else 0 for f in frontiers]
+        if num_snakes == 2:
+            contested = claims[0] & claims[1]
+            unvisited &= ~(claims[0] | claims[1])
+        else:
+            contested = seen = 0
+            for claim in claims:
+                contested |= seen & claim
+                seen |= claim
+            unvisited &= ~seen
+        for i in snakes:
+            owned = claims[i] & ~contested if contested else claims[i]
+            frontiers[i] = owned
+            if owned:
+                territory[i] += owned.bit_count()
+                if nearest_food[i] == -1 and owned & food_mask:
+                    nearest_food[i] = depth
+
+    # A snake's territory is part of what it can reach, so its reach only needs flooding when its territory is small
+    reached = []
+    for i in snakes:
+        count = territory[i]
+        if count < limit:
+            frontier = reach = heads[i]
+            count = 0
+            while frontier and count < limit:
+                frontier = ((frontier << 1) | (frontier >> 1) | (frontier << stride) | (frontier >> stride)) & free & ~reach
+                reach |= frontier
+                count += frontier.bit_count()
+        reached.append(count)
+
+    return Territory(territory, reached, nearest_food)
+
+
+def evaluate_state(state: Dict[str, Any], limit: Optional[int] = None) -> Tuple[Territory, List[str]]:
+    """Evaluates the territory of a simplified game state (see main_game_theory.simplify_game_state)
+
+    Args:
+        state: The simplified game state
+        limit: Passed on to evaluate_territory
+
+    Returns:
+        The territory and the key ("you" or "opponent") of the snake at each index
+    """
+    players = ["you", "opponent"] if "opponent" in state else ["you"]
+    board = state["board"]
+    return evaluate_territory(board["width"], board["height"], [state[p]["body"] for p in players], board["food"], limit), players
@@ -0,0 +1,121 @@
+import contextlib
+import io
+import random
+import threading
+import time
+import unittest
+
+import deadline
+import main_metaheuristics
+from benchmark import generate_position
+from deadline import DeadlineGuard, fallback_move
+
+
+def snake(snake_id, *cells):
+    return {"id": snake_id, "body": [{"x": x, "y": y} for x, y in cells]}
+
+
+def game_state(you, *others, width=11, height=11, timeout=500):
+    return {"game": {"id": "game", "timeout": timeout}, "turn": 1, "you": you,
+            "board": {"width": width, "height": height, "food": [], "snakes": [you, *others]}}
+
+
+class FallbackMoveTest(unittest.TestCase):
+    def test_stays_on_the_board(self):
+        you = snake("you", (0, 0), (1, 0), (2, 0))
+        self.assertEqual(fallback_move(game_state(you)), "up")
+
+    def test_stays_out_of_bodies(self):
+        you = snake("you", (5, 5), (5, 4), (5, 3))
+        other = snake("other", (4, 7), (5, 6), (6, 6), (6, 5), (6, 4))
+        self.assertEqual(fallback_move(game_state(you, other)), "left")
+
+    def test_moves_into_a_tail_that_moves_away(self):
+        you = snake("you", (0, 0), (0, 1), (0, 2))
+        other = snake("other", (3, 0), (2, 0), (1, 0))
+        self.assertEqual(fallback_move(game_state(you, other)), "right")
+
+    def test_avoids_a_tail_that_stays_after_eating(self):
+        you = snake("you", (0, 0), (0, 1), (0, 2))
+        other = snake("other", (3, 0), (2, 0), (1, 0), (1, 0))
+        self.assertEqual(fallback_move(game_state(you, other)), "up")
+
+    def test_avoids_the_head_of_a_longer_snake(self):
+        you = snake("you", (5, 5), (5, 4), (5, 3))
+        other = snake("other", (5, 7), (5, 8), (5, 9), (5, 10))
+        self.assertNotEqual(fallback_move(game_state(you, other)), "up")
+
+    def test_every_move_deadly(self):
+        you = snake("you", (0, 0), (0, 1), (1, 1), (1, 0), (2, 0))
+        self.assertEqual(fallback_move(game_state(you)), "up")
+
+
+class DeadlineGuardTest(unittest.TestCase):
+    def setUp(self):
+        # The guard prints every fallback move
+        self.output = contextlib.redirect_stdout(io.StringIO())
+        self.output.__enter__()
+
+    def tearDown(self):
+        self.output.__exit__(None, None, None)
+
+    def test_answers_with_the_engine_in_time(self):
+        guard = DeadlineGuard()
+        you = snake("you", (5, 5), (5, 4))
+        self.assertEqual(guard.run(game_state(you), lambda: {"move": "left"}, time.perf_counter()), {"move": "left"})
+        self.assertEqual(guard.fallbacks, 0)
+
+    def test_falls_back_and_cancels_a_slow_engine(self):
+        guard = DeadlineGuard(margin_ms=0)
+        you = snake("you", (0, 0), (1, 0))
+        stopped = threading.Event()
+
+        def search():
+            while not deadline.cancelled():
+                time.sleep(0.001)
+            stopped.set()
+            return {"move": "down"}
+
+        self.assertEqual(guard.run(game_state(you, timeout=20), search, time.perf_counter()), {"move": "up"})
+        self.assertTrue(stopped.wait(1))
+        self.assertEqual(guard.fallbacks, 1)
+
+    def test_cancels_a_genetic_search_between_generations(self):
+        guard = DeadlineGuard(margin_ms=0)
+        position = generate_position(random.Random(0), "mid", 11, 2, 0)
+        position["game"]["timeout"] = 20
+        planned = []
+
+        def search():
+            # Without the cancellation this would run for minutes
+            planned.append(main_metaheuristics.plan(position, random.Random(0), 10**6, 0.3))
+            return {"move": planned[0]["move"]}
+
+        guard.run(position, search, time.perf_counter())
+        deadline_passed = time.perf_counter()
+        while not planned and time.perf_counter() - deadline_passed < 5:
+            time.sleep(0.01)
+        self.assertTrue(planned)
+        self.assertLess(planned[0]["generations"], 10**6)
+        self.assertEqual(guard.fallbacks, 1)
+
+    def test_falls_back_when_the_engine_fails(self):
+        guard = DeadlineGuard()
+        you = snake("you", (0, 0), (1, 0))
+
+        def search():
+            raise RuntimeError("engine failed")
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(guard.run(game_state(you), search, time.perf_counter()), {"move": "up"})
+
+    def test_remaining_counts_down_to_the_deadline(self):
+        guard = DeadlineGuard(margin_ms=100)
+        you = snake("you", (5, 5), (5, 4))
+        left = guard.run(game_state(you, timeout=500), lambda: {"move": deadline.remaining()}, time.perf_counter())["move"]
+        self.assertTrue(0.3 < left <= 0.4)
+        self.assertIsNone(deadline.remaining())
+
+
+if __name__ == "__main__":
+    unittest.main()
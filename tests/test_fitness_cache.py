@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from fitness_cache import FitnessCache, engine_version, quantize_params
+
+PARAMS = {"iter": 5, "mutation_prob": 0.503, "food_benefit": 5}
+METRICS = {"turns_alive": 40, "won_game": False}
+
+
+class FitnessCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "fitness_cache.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip_through_file(self):
+        cache = FitnessCache(self.path, version="v1")
+        cache.put(PARAMS, 3, "none", 12.5, METRICS)
+        cache.save()
+
+        loaded = FitnessCache(self.path, version="v1")
+        self.assertEqual(loaded.get(PARAMS, 3, "none"), {"fitness": 12.5, "metrics": METRICS})
+        self.assertIsNone(loaded.get(PARAMS, 4, "none"))
+        self.assertIsNone(loaded.get(PARAMS, 3, "enemy_snake"))
+        self.assertEqual(loaded.stats(), (1, 2, 1))
+
+    def test_other_version_is_invalidated_on_load(self):
+        cache = FitnessCache(self.path, version="v1")
+        cache.put(PARAMS, 3, "none", 12.5, METRICS)
+        cache.save()
+
+        self.assertIsNone(FitnessCache(self.path, version="v2").get(PARAMS, 3, "none"))
+
+    def test_nearby_floats_share_an_entry(self):
+        cache = FitnessCache(None)
+        cache.put(PARAMS, 1, "none", 1.0, METRICS)
+        self.assertIsNotNone(cache.get({**PARAMS, "mutation_prob": 0.4999}, 1, "none"))
+        self.assertEqual(quantize_params(PARAMS)["mutation_prob"], 0.5)
+
+    def test_unseeded_games_are_not_cached(self):
+        cache = FitnessCache(None)
+        cache.put(PARAMS, None, "none", 1.0, METRICS)
+        self.assertIsNone(cache.get(PARAMS, None, "none"))
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = FitnessCache(None, max_entries=2)
+        cache.put(PARAMS, 1, "none", 1.0, METRICS)
+        cache.put(PARAMS, 2, "none", 2.0, METRICS)
+        cache.get(PARAMS, 1, "none")
+        cache.put(PARAMS, 3, "none", 3.0, METRICS)
+        self.assertIsNotNone(cache.get(PARAMS, 1, "none"))
+        self.assertIsNone(cache.get(PARAMS, 2, "none"))
+
+    def test_engine_version_covers_every_file(self):
+        first, second = (os.path.join(self.dir.name, name) for name in ("a.py", "b.py"))
+        for path in (first, second):
+            with open(path, "w") as f:
+                f.write("x = 1\n")
+        version = engine_version(first, second)
+        with open(second, "w") as f:
+            f.write("x = 2\n")
+        self.assertNotEqual(engine_version(first, second), version)
+        self.assertNotEqual(engine_version(first, os.path.join(self.dir.name, "missing")), engine_version(first))
+
+
+if __name__ == "__main__":
+    unittest.main()
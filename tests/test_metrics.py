@@ -0,0 +1,35 @@
+import threading
+import unittest
+
+from metrics import Registry
+
+
+class RegistryTest(unittest.TestCase):
+    def test_concurrent_increments_of_a_new_series_are_not_lost(self):
+        registry = Registry()
+        start = threading.Barrier(8)
+
+        def work():
+            start.wait()
+            for _ in range(2000):
+                registry.counter("requests_total", "Requests", route="move").inc()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        instances = registry.metrics["requests_total"][2]
+        self.assertEqual(len(instances), 1)
+        self.assertEqual(registry.counter("requests_total", route="move").value, 16000)
+
+    def test_label_values_are_escaped(self):
+        registry = Registry()
+        registry.counter("errors_total", "Errors\nby \\ kind", kind='a"b\n').inc()
+        text = registry.render()
+        self.assertIn("# HELP errors_total Errors\\nby \\\\ kind", text)
+        self.assertIn('errors_total{kind="a\\"b\\n"} 1', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
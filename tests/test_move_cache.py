@@ -0,0 +1,78 @@
+import threading
+import unittest
+
+from move_cache import MoveCache, move_key
+
+GAME_STATE = {"game": {"id": "game"}, "turn": 3, "you": {"id": "snake"}}
+
+
+class MoveCacheTest(unittest.TestCase):
+    def test_retry_gets_the_cached_move(self):
+        cache = MoveCache()
+        calls = []
+        key = move_key(GAME_STATE)
+        self.assertEqual(cache.get_or_compute(key, lambda: calls.append(1) or {"move": "up"}), {"move": "up"})
+        self.assertEqual(cache.get_or_compute(key, lambda: calls.append(1) or {"move": "down"}), {"move": "up"})
+        self.assertEqual(len(calls), 1)
+
+    def test_duplicate_waits_for_the_running_search(self):
+        cache = MoveCache()
+        key = move_key(GAME_STATE)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def search():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"move": "left"}
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(cache.get_or_compute(key, search)))
+        first.start()
+        started.wait(5)
+        duplicate = threading.Thread(target=lambda: results.append(cache.get_or_compute(key, search)))
+        duplicate.start()
+        release.set()
+        first.join(5)
+        duplicate.join(5)
+        self.assertEqual(results, [{"move": "left"}, {"move": "left"}])
+        self.assertEqual(len(calls), 1)
+
+    def test_failed_move_is_not_cached(self):
+        cache = MoveCache()
+        key = move_key(GAME_STATE)
+
+        def fail():
+            raise RuntimeError("search failed")
+
+        with self.assertRaises(RuntimeError):
+            cache.get_or_compute(key, fail)
+        self.assertEqual(cache.get_or_compute(key, lambda: {"move": "up"}), {"move": "up"})
+
+    def test_snakes_and_configurations_are_kept_apart(self):
+        cache = MoveCache()
+        cache.get_or_compute(move_key(GAME_STATE, "a"), lambda: {"move": "up"})
+        self.assertEqual(cache.get_or_compute(move_key(GAME_STATE, "b"), lambda: {"move": "down"}), {"move": "down"})
+
+    def test_expired_and_finished_games_are_dropped(self):
+        cache = MoveCache(ttl=-1)
+        key = move_key(GAME_STATE)
+        cache.get_or_compute(key, lambda: {"move": "up"})
+        self.assertEqual(cache.get_or_compute(key, lambda: {"move": "down"}), {"move": "down"})
+
+        cache = MoveCache()
+        cache.get_or_compute(key, lambda: {"move": "up"})
+        cache.end_game("game")
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = MoveCache(max_entries=2)
+        for turn in range(3):
+            cache.get_or_compute(move_key({**GAME_STATE, "turn": turn}), lambda: {"move": "up"})
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_or_compute(move_key({**GAME_STATE, "turn": 0}), lambda: {"move": "down"}), {"move": "down"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import copy
+import os
+import random
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from decoding import compact_game_state
+from recorder import GameRecorder, apply_delta, encode_delta, game_path, iter_game
+from simulator import Game
+
+
+def play(seed: int, snakes: int = 4):
+    """Plays a game of random moves and returns the compact game state the first snake got every turn"""
+    rng = random.Random(seed)
+    game = Game(f"game-{seed}", [(f"snake-{i}", f"snake {i}") for i in range(snakes)], rng=rng)
+    states = []
+    while not game.over:
+        states.append(compact_game_state(copy.deepcopy(game.game_state("snake-0"))))
+        game.step({snake["id"]: rng.choice(["up", "down", "left", "right"]) for snake in game.snakes})
+    states.append(compact_game_state(copy.deepcopy(game.game_state("snake-0"))))
+    return states
+
+
+class DeltaTest(unittest.TestCase):
+    def assertRoundTrip(self, previous, state):
+        self.assertEqual(apply_delta(previous, encode_delta(previous, state)), state)
+
+    def test_simulated_games_round_trip(self):
+        for seed in range(20):
+            states = play(seed)
+            for previous, state in zip(states, states[1:]):
+                self.assertRoundTrip(previous, state)
+            # A dropped turn only makes the delta bigger
+            for previous, state in zip(states, states[3:]):
+                self.assertRoundTrip(previous, state)
+
+    def test_usual_turn_is_a_step(self):
+        states = play(1)
+        delta = encode_delta(states[0], states[1])
+        self.assertTrue(all("step" in change and "body" not in change for change in delta["snakes"].values()))
+
+    def test_snakes_gone_added_and_reordered(self):
+        state = play(2)[0]
+        a, b, c, d = state["board"]["snakes"]
+        new = copy.deepcopy(a)
+        new["id"] = "snake-new"
+        later = {**state, "board": {**state["board"], "snakes": [c, new, a]}}
+        delta = encode_delta(state, later)
+        self.assertEqual(sorted(delta["gone"]), sorted([b["id"], d["id"]]))
+        self.assertEqual(delta["snakes"]["snake-new"], {"full": new})
+        self.assertRoundTrip(state, later)
+
+    def test_you_differs_from_the_board(self):
+        state = play(3)[0]
+        you = {**state["you"], "health": 1}
+        later = {**state, "turn": state["turn"] + 1, "you": you}
+        self.assertEqual(encode_delta(state, later)["you"], you)
+        self.assertRoundTrip(state, later)
+
+    def test_food_reordered(self):
+        state = play(4)[0]
+        later = {**state, "board": {**state["board"], "food": list(reversed(state["board"]["food"]))}}
+        self.assertRoundTrip(state, later)
+
+
+class GameRecorderTest(unittest.TestCase):
+    def test_recorded_game_reads_back(self):
+        states = play(5, snakes=2)
+        with tempfile.TemporaryDirectory() as out_dir:
+            recorder = GameRecorder(out_dir)
+            recorder.record("start", "", states[0])
+            for turn, state in enumerate(states[:-1]):
+                recorder.record("move", "", state, {"move": "up"}, 12.5, {"depth": turn})
+            recorder.record("end", "", states[-1])
+            recorder.close()
+
+            path = os.path.join(out_dir, game_path("", "game-5", "snake-0"))
+            records = list(iter_game(path))
+        self.assertEqual([record["type"] for record in records], ["start"] + ["move"] * (len(states) - 1) + ["end"])
+        self.assertEqual([record["state"] for record in records], [states[0]] + states)
+        self.assertEqual([record["stats"]["depth"] for record in records[1:-1]], list(range(len(states) - 1)))
+        self.assertTrue(all(record["move"] == "up" and record["ms"] == 12.5 for record in records[1:-1]))
+
+    def test_idle_game_is_written_while_other_games_keep_the_queue_busy(self):
+        quiet, busy = play(6, snakes=2), play(7, snakes=2)
+        with tempfile.TemporaryDirectory() as out_dir:
+            recorder = GameRecorder(out_dir)
+            path = os.path.join(out_dir, game_path("", "game-6", "snake-0"))
+            with mock.patch("recorder.IDLE_TIMEOUT", 0.2):
+                recorder.record("start", "", quiet[0])
+                stop = time.monotonic() + 5
+                # The queue stays full, so the writer never finds it empty
+                while not os.path.exists(path) and time.monotonic() < stop:
+                    recorder.record("move", "", busy[0], {"move": "up"}, 1.0)
+                written = os.path.exists(path)
+            recorder.close()
+        self.assertTrue(written)
+        self.assertGreater(recorder.dropped, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from shared_tables import TABLE_HEADER, SharedTable, TableHandle, attach, publish
+
+MAGIC = b"TESTTBL1"
+
+
+class Table(SharedTable):
+    def __init__(self, path):
+        super().__init__(path, MAGIC)
+
+
+class SharedTablesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "table.bin")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_publish_and_map(self):
+        version = publish(self.path, MAGIC, [b"abc", b"def"], version=7)
+        table = Table(self.path)
+        self.assertEqual(version, 7)
+        self.assertEqual(table.version, 7)
+        self.assertEqual(table.data[table.offset:], b"abcdef")
+        self.assertEqual(table.offset, TABLE_HEADER.size)
+        self.assertEqual(os.listdir(self.dir.name), ["table.bin"])
+
+    def test_wrong_magic_is_rejected(self):
+        publish(self.path, b"OTHERTBL", [b"abc"])
+        with self.assertRaises(ValueError):
+            Table(self.path)
+
+    def test_handle_swaps_to_a_new_version(self):
+        handle = TableHandle(self.path, Table, check_interval=0)
+        self.assertIsNone(handle.get())
+
+        publish(self.path, MAGIC, [b"old"], version=1)
+        old = handle.get()
+        self.assertEqual(old.version, 1)
+        self.assertIs(handle.get(), old)
+
+        publish(self.path, MAGIC, [b"new"], version=2)
+        new = handle.get()
+        self.assertEqual(new.version, 2)
+        self.assertEqual(new.data[new.offset:], b"new")
+        # A lookup still holding the old table keeps reading the old version
+        self.assertEqual(old.data[old.offset:], b"old")
+
+        os.remove(self.path)
+        self.assertIsNone(handle.get())
+
+    def test_handle_waits_for_the_check_interval(self):
+        handle = TableHandle(self.path, Table, check_interval=3600)
+        publish(self.path, MAGIC, [b"old"], version=1)
+        self.assertEqual(handle.get().version, 1)
+        publish(self.path, MAGIC, [b"new"], version=2)
+        self.assertEqual(handle.get().version, 1)
+
+    def test_attach_shares_one_handle_per_path(self):
+        publish(self.path, MAGIC, [b"abc"], version=3)
+        self.assertIs(attach(self.path, Table), attach(self.path, Table))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+from territory import evaluate_territory
+
+
+def cells(*coordinates):
+    return [{"x": x, "y": y} for x, y in coordinates]
+
+
+class TerritoryTest(unittest.TestCase):
+    def test_cells_are_split_between_the_heads(self):
+        # Two one-cell snakes facing each other across a 5x1 corridor: the middle cell is contested
+        result = evaluate_territory(5, 1, [cells((0, 0), (0, 0)), cells((4, 0), (4, 0))], [])
+        self.assertEqual(result.territory, [1, 1])
+        self.assertEqual(result.reachable, [3, 3])
+
+    def test_rows_do_not_wrap(self):
+        # A wall splits a 3x3 board. Without the padding bit (2, 0) would spill into (0, 1)
+        wall = cells((1, 0), (1, 1), (1, 2), (1, 2))
+        result = evaluate_territory(3, 3, [cells((0, 0), (0, 0)), wall], [])
+        self.assertEqual(result.territory[0], 2)
+        self.assertEqual(result.reachable[0], 2)
+
+    def test_nearest_food_is_the_closest_food_reached_first(self):
+        food = cells((1, 0), (6, 0))
+        result = evaluate_territory(7, 1, [cells((0, 0), (0, 0)), cells((3, 0), (3, 0))], food)
+        self.assertEqual(result.nearest_food, [1, 3])
+        result = evaluate_territory(7, 1, [cells((0, 0), (0, 0)), cells((2, 0), (2, 0))], cells((1, 0)))
+        self.assertEqual(result.nearest_food, [-1, -1])
+
+    def test_reachable_stops_at_the_limit(self):
+        bodies = [cells((0, 0), (0, 0))]
+        self.assertEqual(evaluate_territory(11, 11, bodies, []).reachable, [120])
+        self.assertGreaterEqual(evaluate_territory(11, 11, bodies, [], limit=5).reachable[0], 5)
+        # A snake boxed into a corner reaches less than its length whatever the limit
+        boxed = [cells((0, 0), (0, 1), (1, 1), (1, 0), (2, 0), (2, 0))]
+        self.assertEqual(evaluate_territory(11, 11, boxed, [], limit=6).reachable, [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+"""Compact on-disk traces of the game theory snake's search trees, and a viewer for them
+
+A trace holds every turn of a game. Each turn stores its root position and its tree in breadth-first order, with the
+number of nodes on every layer, so showing a turn to some depth only reads that many records from the start of the
+turn. An index at the end of the file gives the offset of every turn, so nothing else is read.
+
+Usage:
+    python tracing.py list traces/<game id>.<snake id>.trace
+    python tracing.py view traces/<game id>.<snake id>.trace --turn 12 --depth 3
+    python tracing.py view traces/<game id>.<snake id>.trace --turn 12 --depth 3 --graphviz
+"""
+from typing import Dict, List, Optional, Any, Tuple, BinaryIO
+from collections import deque
+import argparse
+import json
+import os
+import struct
+
+DEFAULT_TRACE_DIR = "traces"
+"""Where traces are written"""
+TRACE_MAGIC = b"SNKTRCE1"
+"""Identifies a trace file and the version of its layout"""
+HEADER = struct.Struct("<8s")
+"""File header: magic"""
+FOOTER = struct.Struct("<QI")
+"""File footer: offset of the turn index, number of turns"""
+TURN_HEADER = struct.Struct("<iIH")
+"""Turn header: turn number, size of the root position in bytes, number of layers. Followed by the node count of each
+layer (uint32), the root position as JSON and then the node records"""
+NODE = struct.Struct("<iBBbbbbf")
+"""A node: index of its parent in the turn (-1 for the root), move, player, head of each snake (-1 if there is no
+opponent) and reward"""
+MOVES = ("up", "down", "left", "right")
+"""Move names, indexed by the move stored in a node. NO_MOVE marks the root"""
+NO_MOVE = 255
+PLAYERS = ("you", "opponent")
+"""Player names, indexed by the player stored in a node"""
+
+
+class TraceNode:
+    """A node of a search tree read back from a trace"""
+    def __init__(self, move: Optional[str], player: str, heads: List[Tuple[int, int]], reward: float) -> None:
+        self.move = move
+        """The move that was made to get to this node, None for the root"""
+        self.player = player
+        """The player that made the move"""
+        self.heads = heads
+        """The head of each snake after the move"""
+        self.reward = reward
+        """The reward the player got for making the move"""
+        self.children: List[TraceNode] = []
+        """The children of the node that were loaded"""
+
+
+def _layers(tree) -> List[List[Tuple[int, Any]]]:
+    """Splits a tree of main_game_theory.State into layers of (parent index, state) in breadth-first order. Only the
+    states the search generated are included"""
+    layers = [[(-1, tree)]]
+    index = 0
+    while True:
+        layer = []
+        for _, state in layers[-1]:
+            for child in state.expanded_states:
+                layer.append((index, child))
+            index += 1
+        if not layer:
+            return layers
+        layers.append(layer)
+
+
+def _write_turn(f: BinaryIO, tree):
+    layers = _layers(tree)
+    root = json.dumps(tree.state, separators=(",", ":")).encode()
+    f.write(TURN_HEADER.pack(tree.state["turn"], len(root), len(layers)))
+    f.write(struct.pack(f"<{len(layers)}I", *(len(layer) for layer in layers)))
+    f.write(root)
+    records = bytearray()
+    for layer in layers:
+        for parent, state in layer:
+            opponent = state.state.get("opponent")
+            you_head = state.state["you"]["body"][0]
+            opponent_head = opponent["body"][0] if opponent else {"x": -1, "y": -1}
+            records += NODE.pack(parent,
+                                 NO_MOVE if state.move_made is None else MOVES.index(state.move_made.value),
+                                 PLAYERS.index(state.player_turn.value),
+                                 you_head["x"], you_head["y"], opponent_head["x"], opponent_head["y"],
+                                 state.reward)
+    f.write(records)
+
+
+def write_trace(path: str, trees: List[Any]):
+    """Writes the search trees of a game to a trace file atomically
+
+    Args:
+        path: Where to write the trace
+        trees: The root main_game_theory.State of every turn
+    """
+    tmp_path = f"{path}.tmp"
+    offsets = []
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(TRACE_MAGIC))
+        for tree in trees:
+            offsets.append(f.tell())
+            _write_turn(f, tree)
+        index = f.tell()
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        f.write(FOOTER.pack(index, len(offsets)))
+    os.replace(tmp_path, path)
+
+
+class TraceReader:
+    """Reads turns of a trace on demand"""
+    def __init__(self, path: str) -> None:
+        self.f = open(path, "rb")
+        """The open trace file"""
+        magic, = HEADER.unpack(self.f.read(HEADER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a trace")
+        self.f.seek(-FOOTER.size, os.SEEK_END)
+        index, count = FOOTER.unpack(self.f.read(FOOTER.size))
+        self.f.seek(index)
+        self.offsets = struct.unpack(f"<{count}Q", self.f.read(count * 8))
+        """The offset of every turn"""
+
+    def __enter__(self) -> "TraceReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+    def _turn_header(self, index: int) -> Tuple[int, int, List[int]]:
+        self.f.seek(self.offsets[index])
+        turn, root_size, num_layers = TURN_HEADER.unpack(self.f.read(TURN_HEADER.size))
+        layer_sizes = list(struct.unpack(f"<{num_layers}I", self.f.read(num_layers * 4)))
+        return turn, root_size, layer_sizes
+
+    def summary(self) -> List[Tuple[int, List[int]]]:
+        """Gets the turn number and the number of nodes on every layer of each turn, without reading any nodes"""
+        summary = []
+        for index in range(len(self.offsets)):
+            turn, _, layer_sizes = self._turn_header(index)
+            summary.append((turn, layer_sizes))
+        return summary
+
+    def load(self, index: int, depth: int) -> Tuple[Dict[str, Any], TraceNode]:
+        """Loads the root position and the top of the tree of one turn
+
+        Args:
+            index: The index of the turn in the trace
+            depth: The number of layers to load, counting the root
+
+        Returns:
+            The simplified game state at the root and the root node
+        """
+        _, root_size, layer_sizes = self._turn_header(index)
+        root_state = json.loads(self.f.read(root_size))
+        count = sum(layer_sizes[:max(depth, 1)])
+        data = self.f.read(count * NODE.size)
+        nodes: List[TraceNode] = []
+        for parent, move, player, yx, yy, ox, oy, reward in NODE.iter_unpack(data):
+            heads = [(yx, yy)] if ox < 0 else [(yx, yy), (ox, oy)]
+            node = TraceNode(None if move == NO_MOVE else MOVES[move], PLAYERS[player], heads, reward)
+            if parent >= 0:
+                nodes[parent].children.append(node)
+            nodes.append(node)
+        return root_state, nodes[0]
+
+
+def format_tree(root: TraceNode) -> str:
+    """Formats a loaded tree as indented text, one node per line"""
+    lines = []
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        heads = " ".join(f"({x},{y})" for x, y in node.heads)
+        lines.append(f"{'  ' * depth}{node.move or 'root'} [{node.player}] reward {node.reward:3f} heads {heads}")
+        stack.extend((child, depth + 1) for child in reversed(node.children))
+    return "\n".join(lines)
+
+
+def render_tree(root: TraceNode, path: str):
+    """Renders a loaded tree with graphviz, with the same labels as main_game_theory.visualize_game_state"""
+    from graphviz import Digraph
+
+    dot = Digraph(comment="Game State")
+    q = deque([root])
+    while q:
+        node = q.popleft()
+        snake_positions = "\n".join(str({"x": x, "y": y}) for x, y in node.heads)
+        dot.node(str(id(node)), f"Snake heads: {snake_positions}\nReward: {node.reward:3f}\nMove: {node.move}\nPlayer: {node.player}")
+        for child in node.children:
+            q.append(child)
+            dot.edge(str(id(node)), str(id(child)))
+    dot.render(path, view=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list", help="show the turns in a trace and the size of their trees")
+    list_parser.add_argument("path")
+    view_parser = subparsers.add_parser("view", help="show the top of the tree of one turn")
+    view_parser.add_argument("path")
+    view_parser.add_argument("--turn", type=int, required=True, help="the turn number")
+    view_parser.add_argument("--depth", type=int, default=2, help="the number of layers to show, counting the root")
+    view_parser.add_argument("--graphviz", action="store_true", help="render with graphviz instead of printing")
+    args = parser.parse_args()
+
+    with TraceReader(args.path) as reader:
+        summary = reader.summary()
+        if args.command == "list":
+            for turn, layer_sizes in summary:
+                print(f"turn {turn}: {sum(layer_sizes)} nodes, layers {layer_sizes}")
+            return
+
+        turns = [turn for turn, _ in summary]
+        if args.turn not in turns:
+            parser.error(f"turn {args.turn} is not in the trace")
+        root_state, root = reader.load(turns.index(args.turn), args.depth)
+        print(json.dumps(root_state))
+        if args.graphviz:
+            render_tree(root, "game_state.gv")
+        else:
+            print(format_tree(root))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+from typing import Dict, List
+import math
+import statistics
+
+CONFIDENCE_Z = 1.96
+"""Z score used for the 95% confidence intervals in the reports"""
+
+
+def paired_report(baseline: List[float], candidate: List[float]) -> Dict[str, float]:
+    """Compares two parameter sets that were evaluated on the same game seeds
+
+    The games are paired by seed, so the noise that both parameter sets share (food spawns, start positions) cancels
+    out in the per-seed differences. The report shows how much variance that removed compared to treating the two
+    samples as independent.
+
+    Args:
+        baseline: The fitness of the baseline parameter set for each seed
+        candidate: The fitness of the candidate parameter set for the same seeds, in the same order
+
+    Raises:
+        ValueError: If the samples are not the same length or have fewer than two games
+
+    Returns:
+        A dictionary with the mean difference (candidate - baseline), its confidence interval half width, the
+        variances under paired and independent evaluation and the resulting reduction in games needed
+    """
+    if len(baseline) != len(candidate):
+        raise ValueError("Paired samples must have the same length")
+    n = len(baseline)
+    if n < 2:
+        raise ValueError("At least two paired games are needed")
+
+    differences = [c - b for b, c in zip(baseline, candidate)]
+    var_paired = statistics.variance(differences)
+    var_independent = statistics.variance(baseline) + statistics.variance(candidate)
+
+    return {
+        "games": n,
+        "baseline_mean": statistics.fmean(baseline),
+        "candidate_mean": statistics.fmean(candidate),
+        "mean_difference": statistics.fmean(differences),
+        "half_width": CONFIDENCE_Z * math.sqrt(var_paired / n),
+        "var_paired": var_paired,
+        "var_independent": var_independent,
+        "variance_reduction": 1 - var_paired / var_independent if var_independent > 0 else 0.0,
+        "games_ratio": var_paired / var_independent if var_independent > 0 else 1.0,
+    }
+
+
+def format_report(report: Dict[str, float]) -> str:
+    """Formats a paired report for printing
+
+    Args:
+        report: The report returned by paired_report
+
+    Returns:
+        A single line summary of the comparison
+    """
+    return (f"n={report['games']} diff={report['mean_difference']:.3f}±{report['half_width']:.3f} "
+            f"var paired/independent={report['var_paired']:.3f}/{report['var_independent']:.3f} "
+            f"variance reduction={report['variance_reduction']:.1%} "
+            f"games needed vs independent={report['games_ratio']:.2f}x")